@@ -1,16 +1,21 @@
 import pathlib
 import shutil
-import tempfile
 from customdataclasses import ValheimConfig
 from gameHandler import GameHandler
 import base64
 import json
 from portchecker import get_available_ports
-from typing import List, Dict
-from jinja2 import Environment, select_autoescape, FileSystemLoader
+from typing import List, Dict, Optional, Tuple
 import os
 
-from setup_server import GameServerManager
+# Game port inside the container; the compose template publishes it and
+# the query port (+1) on the subscription's reserved host ports
+CONTAINER_PORT = 2456
+
+# Steam datagram messages a client opens a connection with on the game
+# port (ChallengeRequest, ConnectRequest), padded to at least 512 bytes
+STEAM_CONNECT_MESSAGES = (32, 34)
+STEAM_PADDED_SIZE = 512
 
 
 class ValheimHandler(GameHandler):
@@ -25,9 +30,59 @@ class ValheimHandler(GameHandler):
 
     @property
     def default_ports(self) -> List[int]:
-        ports = get_available_ports(n=2)
+        ports = get_available_ports(n=self.port_count)
         return ports
 
+    @property
+    def port_count(self) -> int:
+        return 2
+
+    @property
+    def contiguous_ports(self) -> bool:
+        # Steam clients query the game port + 1
+        return True
+
+    @property
+    def backup_paths(self) -> List[str]:
+        # World saves and the BepInEx dirs users customize
+        return [
+            "saves",
+            "BepInEx/config",
+            "BepInEx/plugins",
+            "BepInEx/patchers",
+        ]
+
+    def server_log_path(self, server_dir: str) -> Optional[str]:
+        # LOGFILE in the compose template, mounted from <server_dir>/logs
+        return os.path.join(server_dir, "logs", "valheim.log")
+
+    @property
+    def query_port_index(self) -> Optional[int]:
+        # SUBSCRIPTION_PORT_1, mapped to the query port 2457
+        return 1
+
+    def is_wake_packet(self, port_index: int, data: bytes) -> bool:
+        if port_index == 0:
+            return (
+                len(data) >= STEAM_PADDED_SIZE
+                and data[0] in STEAM_CONNECT_MESSAGES
+            )
+        return super().is_wake_packet(port_index, data)
+
+    @property
+    def config_change_levels(self) -> Dict[str, str]:
+        # Every key start.sh reads is a launch argument. Ports and volumes
+        # live in the compose file, so no env key needs a rebuilt container.
+        # MAX_PLAYERS is recorded only: Valheim has no such flag
+        return {
+            "MAX_PLAYERS": "noop",
+            "SERVER_NAME": "restart",
+            "PASSWORD": "restart",
+            "PUBLIC": "restart",
+            "WORLD": "restart",
+            "CROSSPLAY": "restart",
+        }
+
     def get_env_file_format(self, subscription_id) -> str:
         return f".{self.game_type}_{subscription_id}_env"
 
@@ -69,62 +124,59 @@ class ValheimHandler(GameHandler):
     def generate_env_vars(
         self, config: ValheimConfig, subscription_id: str
     ) -> Dict[str, str]:
-        """Generate Valheim-specific environment variables"""
+        """Generate the environment scripts/start.sh reads"""
+        # "normal" is the game's default and has no -modifier value
+        modifiers = {
+            "combat": config.modifier_combat,
+            "deathpenalty": config.modifier_death,
+            "resources": config.modifier_resources,
+            "raids": config.modifier_raids,
+            "portals": config.modifier_portals,
+        }
+        setkeys = {
+            "nomap": config.no_map,
+            "playerevents": config.player_events,
+            "passivemobs": config.passive_mobs,
+            "nobuildcost": config.no_build_cost,
+        }
         return {
-            "PORT": str(config.port),
+            # The host port is reserved per subscription, not configured
+            "PORT": str(CONTAINER_PORT),
             "SERVER_NAME": config.name,
-            "SERVER_PASSWORD": config.password,
-            "CROSSPLAY_ENABLED": str(config.crossplay).lower(),
-            "WORLD_NAME": config.world,
+            "PASSWORD": config.password,
+            "WORLD": config.world,
             "PUBLIC": str(int(config.public)),
-            "SAVE_DIR": "/valheim/saves",
-            "SAVE_INTERVAL": str(config.save_interval),
-            "KEEP_BACKUPS": str(config.backups),
-            "BACKUPS_SHORT": str(config.backup_short),
-            "BACKUPS_LONG": str(config.backup_long),
-            "SERVER_PRESET": config.preset,
-            "MODIFIER_COMBAT": config.modifier_combat,
-            "MODIFIER_DEATH": config.modifier_death,
-            "MODIFIER_RESOURCES": config.modifier_resources,
-            "MODIFIER_RAIDS": config.modifier_raids,
-            "MODIFIER_PORTALS": config.modifier_portals,
-            # Individual setkey properties
-            "NO_MAP": str(config.no_map).lower(),
-            "PLAYER_EVENTS": str(config.player_events).lower(),
-            "PASSIVE_MOBS": str(config.passive_mobs).lower(),
-            "NO_BUILD_COST": str(config.no_build_cost).lower(),
+            # The save volume's mount point in the compose template
+            "SAVEDIR": "/valheim-saves",
+            "SAVEINTERVAL": str(config.save_interval),
+            "BACKUPS": str(config.backups),
+            "BACKUPSHORT": str(config.backup_short),
+            "BACKUPLONG": str(config.backup_long),
+            "CROSSPLAY": str(config.crossplay).lower(),
+            "PRESET": config.preset.lower(),
+            "MODIFIER": " ".join(
+                f"{key}:{value.lower()}"
+                for key, value in modifiers.items()
+                if value and value.lower() != "normal"
+            ),
+            "SETKEY": " ".join(key for key, enabled in setkeys.items() if enabled),
+            "MAX_PLAYERS": str(config.max_players),
         }
 
     def fill_compose_file(self, defaults: Dict, src_template_path:str,target_compose_file:str):
-        src_path = pathlib.Path(src_template_path)
-        j_env = Environment(
-            loader=FileSystemLoader(str(src_path.absolute().parent)),
-            autoescape=select_autoescape(),
-        )
-        j_template = j_env.get_template(src_path.name)
-        s = j_template.render(defaults)
-        os.makedirs("./tmp", exist_ok=True)
-        with tempfile.NamedTemporaryFile(delete=False, mode="w", dir="./temp") as f:
-            f.write(s)
-
-        shutil.move(f.name, target_compose_file)
+        self.render_template(src_template_path, defaults, target_compose_file)
         if not pathlib.Path(target_compose_file).exists():
-            raise FileNotFoundError(compose_file)
+            raise FileNotFoundError(target_compose_file)
 
     def update_config_file(
         self, env_vars: Dict, subscription_path: str, subscription_id: str
-    ):
+    ) -> Dict[str, Tuple[Optional[str], Optional[str]]]:
         # Write environment file
         env_file = os.path.join(
             subscription_path,
             self.get_env_file_format(subscription_id),
         )
-        os.makedirs("./tmp", exist_ok=True)
-        with tempfile.NamedTemporaryFile(delete=False, mode="w", dir="./temp") as f:
-            for key, value in env_vars.items():
-                f.write(f"{key}={value}\n")
-
-        shutil.move(src=f.name, dst=env_file)
+        return self.write_env_file(env_file, env_vars)
 
     def create_default_subscription_config_file(
         self,
@@ -144,8 +196,7 @@ class ValheimHandler(GameHandler):
             subscription_path, self.get_env_file_format(subscription_id)
         )
         # Copy environment template
-        return_code, _, stderr = GameServerManager.run_command(
-            f"cp -r {src_env_template_file} {target_env_subscription_file}"
-        )
-        if return_code != 0:
-            raise Exception(f"Unable to copy env template file: {stderr}")
+        try:
+            shutil.copy2(src_env_template_file, target_env_subscription_file)
+        except OSError as e:
+            raise Exception(f"Unable to copy env template file: {e}")
@@ -0,0 +1,185 @@
+"""
+Steam A2S_INFO queries over UDP with asyncio.
+
+A server that answers A2S_INFO has loaded its world and accepts players,
+unlike a container that merely runs. Queries follow the current protocol:
+the server may first answer with an S2C_CHALLENGE, in which case the
+request is repeated with the challenge appended. Every probe is a
+coroutine on one event loop, so hundreds of servers are polled at once
+from a single thread.
+"""
+
+import asyncio
+import logging
+import struct
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger("game-server-setup")
+
+HEADER = b"\xff\xff\xff\xff"
+INFO_REQUEST = HEADER + b"TSource Engine Query\x00"
+INFO_RESPONSE = 0x49
+CHALLENGE_RESPONSE = 0x41
+
+
+class A2SError(Exception):
+    """Raised when a server does not answer or answers garbage"""
+
+    pass
+
+
+def info_request(challenge: Optional[bytes] = None) -> bytes:
+    return INFO_REQUEST + (challenge or b"")
+
+
+def is_info_request(data: bytes) -> bool:
+    """True for an A2S_INFO query, with or without a challenge"""
+    return data.startswith(INFO_REQUEST)
+
+
+def _read_string(data: bytes, offset: int) -> Tuple[str, int]:
+    end = data.index(b"\x00", offset)
+    return data[offset:end].decode(errors="replace"), end + 1
+
+
+def parse_info(data: bytes) -> Dict:
+    """Fields of an A2S_INFO response packet"""
+    if not data.startswith(HEADER) or len(data) < 6 or data[4] != INFO_RESPONSE:
+        raise A2SError("Not an A2S_INFO response")
+    try:
+        offset = 6  # header, type byte, protocol version
+        name, offset = _read_string(data, offset)
+        map_name, offset = _read_string(data, offset)
+        folder, offset = _read_string(data, offset)
+        game, offset = _read_string(data, offset)
+        app_id, players, max_players, bots = struct.unpack_from("<hBBB", data, offset)
+    except (ValueError, struct.error) as e:
+        raise A2SError(f"Truncated A2S_INFO response: {e}")
+    return {
+        "name": name,
+        "map": map_name,
+        "folder": folder,
+        "game": game,
+        "app_id": app_id,
+        "players": players,
+        "max_players": max_players,
+        "bots": bots,
+    }
+
+
+class _QueryProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.packets: "asyncio.Queue[bytes]" = asyncio.Queue()
+        self.error: Optional[Exception] = None
+
+    def datagram_received(self, data: bytes, addr):
+        self.packets.put_nowait(data)
+
+    def error_received(self, exc: Exception):
+        # ICMP port unreachable: nothing listens yet
+        self.error = exc
+        self.packets.put_nowait(b"")
+
+
+async def query_info(host: str, port: int, timeout: float = 1.0) -> Dict:
+    """One A2S_INFO exchange, following a challenge if the server sends one"""
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        _QueryProtocol, remote_addr=(host, port)
+    )
+    try:
+        transport.sendto(info_request())
+        for _ in range(2):
+            try:
+                data = await asyncio.wait_for(protocol.packets.get(), timeout)
+            except asyncio.TimeoutError:
+                raise A2SError(f"No answer from {host}:{port}")
+            if not data:
+                raise A2SError(f"{host}:{port} unreachable: {protocol.error}")
+            if len(data) >= 9 and data[4] == CHALLENGE_RESPONSE:
+                transport.sendto(info_request(data[5:9]))
+                continue
+            return parse_info(data)
+        raise A2SError(f"{host}:{port} repeated its challenge")
+    finally:
+        transport.close()
+
+
+async def wait_ready(
+    host: str,
+    port: int,
+    timeout: float = 300,
+    query_timeout: float = 1.0,
+    initial_delay: float = 1.0,
+    max_delay: float = 10.0,
+) -> Dict:
+    """
+    Query until the server answers or timeout seconds pass
+
+    Returns:
+        Dict: ready, time_to_ready, attempts and, once ready, players and
+            max_players
+    """
+    started = time.monotonic()
+    delay = initial_delay
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            info = await query_info(host, port, query_timeout)
+            return {
+                "ready": True,
+                "time_to_ready": round(time.monotonic() - started, 3),
+                "attempts": attempts,
+                "players": info["players"],
+                "max_players": info["max_players"],
+            }
+        except (A2SError, OSError):
+            pass
+        remaining = timeout - (time.monotonic() - started)
+        if remaining <= 0:
+            return {"ready": False, "time_to_ready": None, "attempts": attempts}
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
+
+def probe_many(
+    targets: Dict[str, Tuple[str, int]], timeout: float = 300, **kwargs
+) -> Dict[str, Dict]:
+    """wait_ready for every target at once, keyed like targets"""
+    if not targets:
+        return {}
+
+    async def run():
+        results = await asyncio.gather(
+            *(
+                wait_ready(host, port, timeout, **kwargs)
+                for host, port in targets.values()
+            )
+        )
+        return dict(zip(targets, results))
+
+    return asyncio.run(run())
+
+
+def player_counts(
+    targets: Dict[str, Tuple[str, int]], query_timeout: float = 1.0
+) -> Dict[str, int]:
+    """Current players of every target answering one query"""
+    if not targets:
+        return {}
+
+    async def one(host: str, port: int) -> Optional[int]:
+        try:
+            return (await query_info(host, port, query_timeout))["players"]
+        except (A2SError, OSError):
+            return None
+
+    async def run():
+        counts = await asyncio.gather(
+            *(one(host, port) for host, port in targets.values())
+        )
+        return {key: n for key, n in zip(targets, counts) if n is not None}
+
+    return asyncio.run(run())
@@ -0,0 +1,302 @@
+"""
+Streaming tar archives compressed on a worker pool.
+
+tarfile writes the archive as a stream into ParallelCompressor, which cuts
+it into fixed-size blocks and compresses every block independently on a
+thread pool (zlib and zstd release the GIL). Each block becomes its own gzip
+member or zstd frame; concatenated members are a valid .tar.gz / .tar.zst
+that `tar -xf` reads as usual. Finished blocks are written in order straight
+into a temp file in the destination directory, which is renamed into place
+once complete, so the archive is written exactly once.
+
+extract_archive reads such an archive back as a single stream, checking the
+gzip CRC or zstd checksum of every member as it goes.
+"""
+
+import collections
+import fnmatch
+import gzip
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO, Callable, Deque, Dict, Optional, Sequence
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger("game-server-setup")
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+DEFAULT_LEVELS = {"gzip": 6, "zstd": 3}
+EXTENSIONS = {"gzip": ".tar.gz", "zstd": ".tar.zst"}
+
+
+class ArchiveError(Exception):
+    """Raised when an archive cannot be written"""
+
+    pass
+
+
+def block_compressor(codec: str, level: int) -> Callable[[bytes], bytes]:
+    """Function compressing one block into a self-contained member/frame"""
+    if codec == "gzip":
+        # wbits=31 writes a gzip header and trailer around the deflate data
+        return lambda block: zlib.compress(block, level, wbits=31)
+    if codec == "zstd":
+        if zstandard is None:
+            raise ArchiveError("zstd compression needs the zstandard package")
+        compressor = zstandard.ZstdCompressor(level=level, write_checksum=True)
+        return compressor.compress
+    raise ArchiveError(f"Unknown compression: {codec}")
+
+
+class ParallelCompressor:
+    """Write-only stream compressing fixed-size blocks in parallel"""
+
+    def __init__(
+        self,
+        out: BinaryIO,
+        compress: Callable[[bytes], bytes],
+        workers: int,
+        block_size: int = BLOCK_SIZE,
+    ):
+        self.out = out
+        self.compress = compress
+        self.block_size = block_size
+        self.max_pending = 2 * workers
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="compress"
+        )
+        self.pending: Deque[Future] = collections.deque()
+        self.buffer = bytearray()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[: self.block_size]))
+            del self.buffer[: self.block_size]
+        return len(data)
+
+    def _submit(self, block: bytes):
+        self.bytes_in += len(block)
+        self.pending.append(self.executor.submit(self.compress, block))
+        # Bound memory: at most max_pending blocks in flight
+        while len(self.pending) > self.max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        compressed = self.pending.popleft().result()
+        self.out.write(compressed)
+        self.bytes_out += len(compressed)
+
+    def close(self):
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self._write_next()
+        finally:
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+
+
+def write_archive(
+    source_dir: str,
+    target_path: str,
+    exclude: Sequence[str] = (),
+    codec: str = "gzip",
+    level: Optional[int] = None,
+    workers: Optional[int] = None,
+    arcname: Optional[str] = None,
+) -> Dict:
+    """
+    Archive source_dir into target_path
+
+    Args:
+        source_dir: Directory to archive; stored without its leading "/"
+            like `tar -c` does
+        target_path: Final archive path, may lie inside source_dir
+        exclude: Basename patterns left out of the archive
+        codec: "gzip" or "zstd"
+        level: Compression level, the codec's default when None
+        workers: Compression threads, all cores when None
+        arcname: Name stored for source_dir, e.g. the live path when
+            archiving a snapshot of it
+
+    Returns:
+        Dict: Size, ratio, duration and throughput of the archive
+    """
+    level = DEFAULT_LEVELS.get(codec) if level is None else level
+    workers = workers or os.cpu_count() or 1
+    compress = block_compressor(codec, level)
+    directory = os.path.dirname(os.path.abspath(target_path))
+    exclude = list(exclude) + [".backup-*.tmp"]
+
+    def skip_excluded(info: tarfile.TarInfo) -> Optional[tarfile.TarInfo]:
+        name = os.path.basename(info.name)
+        if any(fnmatch.fnmatch(name, pattern) for pattern in exclude):
+            return None
+        return info
+
+    started = time.monotonic()
+    with tempfile.NamedTemporaryFile(
+        delete=False, dir=directory, prefix=".backup-", suffix=".tmp"
+    ) as tmp_file:
+        tmp_path = tmp_file.name
+        stream = ParallelCompressor(tmp_file, compress, workers)
+        try:
+            try:
+                with tarfile.open(fileobj=stream, mode="w|") as tar:
+                    tar.add(
+                        source_dir,
+                        arcname=(arcname or source_dir).lstrip("/"),
+                        filter=skip_excluded,
+                    )
+            finally:
+                stream.close()
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        except BaseException as e:
+            tmp_file.close()
+            os.unlink(tmp_path)
+            if isinstance(e, (OSError, tarfile.TarError)):
+                raise ArchiveError(f"Failed to archive {source_dir}: {e}")
+            raise
+    os.replace(tmp_path, target_path)
+
+    duration = time.monotonic() - started
+    metrics = {
+        "backup_file": target_path,
+        "size": stream.bytes_out,
+        "bytes_in": stream.bytes_in,
+        "ratio": round(stream.bytes_in / stream.bytes_out, 3)
+        if stream.bytes_out
+        else None,
+        "duration": round(duration, 3),
+        "throughput_mb_s": round(stream.bytes_in / duration / 1e6, 2)
+        if duration
+        else None,
+        "codec": codec,
+        "level": level,
+        "workers": workers,
+    }
+    logger.info(
+        f"Archived {source_dir} to {target_path}: {metrics['bytes_in']} -> "
+        f"{metrics['size']} bytes in {metrics['duration']}s"
+    )
+    return metrics
+
+
+def _decompressing_reader(archive_path: str, raw: BinaryIO) -> BinaryIO:
+    """Reader over every member/frame of the archive open as raw"""
+    if archive_path.endswith(EXTENSIONS["zstd"]):
+        if zstandard is None:
+            raise ArchiveError("zstd archives need the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(
+            raw, read_across_frames=True, closefd=False
+        )
+    # GzipFile reads concatenated members and checks each one's CRC
+    return gzip.GzipFile(fileobj=raw, mode="rb")
+
+
+def extract_archive(
+    archive_path: str,
+    target_dir: str,
+    strip: str = "",
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> Dict:
+    """
+    Extract the regular files and directories of an archive into target_dir
+
+    Args:
+        archive_path: .tar.gz or .tar.zst written by write_archive
+        target_dir: Directory to extract into; existing files are replaced
+            through a temp file and a rename, others are left alone
+        strip: Leading member path removed before extracting, e.g. the
+            arcname the archive was written with
+        progress: Called with (archive bytes read, archive size)
+
+    Returns:
+        Dict: File count, bytes and duration of the extraction
+    """
+    started = time.monotonic()
+    prefix = strip.strip("/") + "/" if strip.strip("/") else ""
+    target_root = os.path.realpath(target_dir)
+    total = os.path.getsize(archive_path)
+    files = 0
+    done = 0
+    try:
+        with open(archive_path, "rb") as raw, _decompressing_reader(
+            archive_path, raw
+        ) as stream, tarfile.open(fileobj=stream, mode="r|") as tar:
+            for member in tar:
+                name = member.name.lstrip("/")
+                if prefix and not name.startswith(prefix):
+                    continue
+                rel_path = name[len(prefix) :]
+                if not rel_path or fnmatch.fnmatch(
+                    os.path.basename(rel_path), ".backup-*.tmp"
+                ):
+                    continue
+                dst = os.path.realpath(os.path.join(target_root, rel_path))
+                if not dst.startswith(target_root + os.sep):
+                    raise ArchiveError(f"Path escapes the target: {member.name}")
+                if member.isdir():
+                    os.makedirs(dst, exist_ok=True)
+                    continue
+                if not member.isfile():
+                    continue
+                directory = os.path.dirname(dst)
+                os.makedirs(directory, exist_ok=True)
+                source = tar.extractfile(member)
+                with tempfile.NamedTemporaryFile(
+                    delete=False, dir=directory, suffix=".restore.tmp"
+                ) as tmp_file:
+                    try:
+                        shutil.copyfileobj(source, tmp_file, BLOCK_SIZE)
+                    except BaseException:
+                        tmp_file.close()
+                        os.unlink(tmp_file.name)
+                        raise
+                os.chmod(tmp_file.name, member.mode & 0o7777)
+                os.utime(tmp_file.name, (member.mtime, member.mtime))
+                os.replace(tmp_file.name, dst)
+                files += 1
+                done += member.size
+                if progress is not None:
+                    progress(raw.tell(), total)
+            # tar stops at its end-of-archive blocks; reading on to the end
+            # checks the last member's CRC or checksum too
+            while stream.read(BLOCK_SIZE):
+                pass
+    except (OSError, EOFError, zlib.error, tarfile.TarError) as e:
+        raise ArchiveError(f"Failed to extract {archive_path}: {e}")
+    except Exception as e:
+        if zstandard is not None and isinstance(e, zstandard.ZstdError):
+            raise ArchiveError(f"Failed to extract {archive_path}: {e}")
+        raise
+
+    duration = time.monotonic() - started
+    logger.info(
+        f"Extracted {archive_path} into {target_dir}: {files} files, "
+        f"{done} bytes in {duration:.1f}s"
+    )
+    return {
+        "backup_file": archive_path,
+        "files": files,
+        "bytes": done,
+        "duration": round(duration, 3),
+        "throughput_mb_s": round(done / duration / 1e6, 2) if duration else None,
+    }
@@ -0,0 +1,244 @@
+"""
+Backup scheduler run by the manager daemon.
+
+Every subscription is backed up once per interval at a fixed offset derived
+from a hash of its id, so a fleet's backups spread over the whole interval
+instead of all firing on the hour. At most `max_concurrent` backups run on
+the host and `per_disk` write to the filesystem holding the backup store.
+Backup threads run at idle CPU niceness, and all of them together read at
+most `read_rate` bytes per second, so game servers' own world saves keep
+the disk. The rate is enforced in the read loop because IO priorities do
+nothing under the mq-deadline and none schedulers common on NVMe.
+
+Durations are tracked per subscription (moving average, persisted). Inside
+the quiet hours the longest backups go first; outside them a backup
+expected to take longer than `large_backup` seconds waits for the quiet
+hours unless its last success is older than `large_max_age`.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Set, Tuple
+
+from customdataclasses import ServerResult
+from offload import TokenBucket
+
+logger = logging.getLogger("game-server-setup")
+
+CPU_NICE = 10
+
+
+def schedule_offset(subscription_id: str, interval: int) -> int:
+    """Stable offset of a subscription's backups within the interval"""
+    digest = hashlib.sha1(subscription_id.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % interval
+
+
+def lower_thread_priority():
+    """Give the calling thread idle-ish CPU priority"""
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), CPU_NICE)
+    except OSError as e:
+        logger.warning(f"Unable to renice backup thread: {e}")
+
+
+def device_of(path: str) -> Optional[int]:
+    """st_dev of the filesystem path is or would be created on"""
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except FileNotFoundError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+
+class BackupScheduler(threading.Thread):
+    """Staggered, capped backups of every subscription"""
+
+    def __init__(
+        self,
+        manager,
+        state_path: str,
+        interval: int = 3600,
+        max_concurrent: int = 2,
+        per_disk: int = 2,
+        read_rate: float = 50 * 1024 * 1024,
+        quiet_hours: Tuple[int, int] = (3, 6),
+        large_backup: float = 300,
+        large_max_age: float = 86400,
+        tick: float = 5,
+    ):
+        super().__init__(name="backup-scheduler", daemon=True)
+        self.manager = manager
+        self.state_path = state_path
+        self.interval = interval
+        self.max_concurrent = max_concurrent
+        self.per_disk = per_disk
+        self.throttle = TokenBucket(read_rate, 1024 * 1024) if read_rate else None
+        self.quiet_hours = quiet_hours
+        self.large_backup = large_backup
+        self.large_max_age = large_max_age
+        self.tick = tick
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrent,
+            thread_name_prefix="backup",
+            initializer=lower_thread_priority,
+        )
+        self._state: Dict[str, Dict] = self._load_state()
+        # subscription -> st_dev of its destination
+        self._running: Dict[str, Optional[int]] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    # State
+
+    def _load_state(self) -> Dict[str, Dict]:
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable backup schedule state: {e}")
+            return {}
+
+    def _save_state(self):
+        directory = os.path.dirname(os.path.abspath(self.state_path))
+        with self._lock:
+            content = json.dumps(self._state, indent=1)
+        with tempfile.NamedTemporaryFile(
+            mode="w", delete=False, dir=directory, suffix=".tmp"
+        ) as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_file.name, self.state_path)
+
+    def expected_duration(self, subscription_id: str) -> float:
+        with self._lock:
+            return self._state.get(subscription_id, {}).get("duration", 0.0)
+
+    def state(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {sub: dict(entry) for sub, entry in self._state.items()}
+
+    # Scheduling
+
+    def stop(self):
+        self._stop_event.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.schedule_once()
+            except Exception as e:
+                logger.error(f"Backup scheduling failed: {e}")
+            self._stop_event.wait(self.tick)
+
+    def in_quiet_hours(self, now: float) -> bool:
+        start, end = self.quiet_hours
+        hour = time.localtime(now).tm_hour
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def due_since(self, subscription_id: str, now: float) -> float:
+        """Start of the subscription's current slot"""
+        offset = schedule_offset(subscription_id, self.interval)
+        return now - (now - offset) % self.interval
+
+    def schedule_once(self, now: Optional[float] = None):
+        """Start every due backup that fits under the caps"""
+        now = now if now is not None else time.time()
+        quiet = self.in_quiet_hours(now)
+        # Every scheduled backup goes to the manager's dedup store
+        device = device_of(self.manager.backup_store.root)
+        candidates = []
+        for game_type, subscription_id, _ in self.manager.list_subscriptions():
+            with self._lock:
+                if subscription_id in self._running:
+                    continue
+                # New subscriptions wait for their first slot instead of all
+                # running the moment the daemon starts
+                entry = self._state.setdefault(subscription_id, {"first_seen": now})
+            slot = self.due_since(subscription_id, now)
+            if max(entry.get("last_run", 0), entry.get("first_seen", 0)) >= slot:
+                continue
+            duration = entry.get("duration", 0.0)
+            stale = now - entry.get("last_success", 0) > self.large_max_age
+            if not quiet and duration > self.large_backup and not stale:
+                continue
+            if not os.path.isdir(f"/srv/allservers/{subscription_id}"):
+                continue
+            candidates.append((slot, duration, game_type, subscription_id))
+
+        if quiet:
+            candidates.sort(key=lambda c: -c[1])
+        else:
+            candidates.sort(key=lambda c: c[0])
+
+        for _, _, game_type, subscription_id in candidates:
+            with self._lock:
+                if len(self._running) >= self.max_concurrent:
+                    break
+                on_disk = sum(1 for d in self._running.values() if d == device)
+                if on_disk >= self.per_disk:
+                    continue
+                self._running[subscription_id] = device
+                self._state.setdefault(subscription_id, {})["last_run"] = now
+            self.executor.submit(self._run_backup, game_type, subscription_id)
+
+    def _run_backup(self, game_type: str, subscription_id: str):
+        started = time.monotonic()
+        status = "failed"
+        try:
+            try:
+                result = self.manager.backup(
+                    subscription_id,
+                    game_type,
+                    throttle=self.throttle.consume if self.throttle else None,
+                )
+            except Exception as e:
+                result = ServerResult(
+                    action="backup",
+                    subscription_id=subscription_id,
+                    status="failed",
+                    error=str(e),
+                )
+            status = result.status
+            if result.status != "completed":
+                logger.error(
+                    f"Scheduled backup of {subscription_id} failed: {result.error}"
+                )
+            # Indexed and reported like a backup action run from the CLI
+            self.manager.record(result, game_type)
+            self.manager.report(result)
+        except Exception as e:
+            logger.error(f"Failed to record backup of {subscription_id}: {e}")
+        finally:
+            duration = time.monotonic() - started
+            with self._lock:
+                self._running.pop(subscription_id, None)
+                entry = self._state.setdefault(subscription_id, {})
+                entry["status"] = status
+                if status == "completed":
+                    entry["last_success"] = time.time()
+                    previous = entry.get("duration")
+                    if previous is not None:
+                        duration = 0.7 * previous + 0.3 * duration
+                    entry["duration"] = round(duration, 3)
+            try:
+                self._save_state()
+            except OSError as e:
+                logger.warning(f"Unable to save backup schedule state: {e}")
+
+    def running(self) -> Set[str]:
+        with self._lock:
+            return set(self._running)
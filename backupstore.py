@@ -0,0 +1,591 @@
+"""
+Incremental, deduplicated backups in a per-host content-addressed store.
+
+Files are split into content-defined chunks, so an edit in the middle of a
+world .db only changes the chunks around it. Each chunk is stored once,
+zlib-compressed, under chunks/<sha256[:2]>/<sha256>; a backup is a JSON
+manifest listing every file and its chunk hashes:
+
+    <root>/chunks/ab/ab12...
+    <root>/manifests/<subscription_id>/<backup_id>.json
+
+Files whose size and mtime match the previous manifest reuse its chunk list
+without being read. Retention keeps the newest backup of each of the last N
+hours, days and weeks; garbage collection then deletes chunks no manifest
+references. Backups hold the store lock shared and collection holds it
+exclusively, so a chunk can never be collected while a backup reuses it.
+"""
+
+import collections
+import datetime
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import (
+    BinaryIO,
+    Callable,
+    Container,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from filelock import FileLock
+
+logger = logging.getLogger("game-server-setup")
+
+BACKUP_ROOT = "/srv/backups"
+
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 256 * 1024
+
+# A chunk ends after a run of MARKER_RUN bytes from a fixed random set of 16
+# byte values (1/16 each), i.e. on average every 16**4 = 64 KiB past
+# MIN_CHUNK. translate() + find() keep the scan in C, where a per-byte
+# rolling hash in Python manages only a few MB/s.
+_markers = random.Random(0x5EED).sample(range(1, 255), 16)
+MARKER_TABLE = bytes(1 if b in _markers else 0 for b in range(256))
+MARKER_RUN = b"\x01" * 4
+
+COMPRESS_LEVEL = 3
+
+# Bytes read from a file at a time while chunking
+READ_SIZE = 4 * MAX_CHUNK
+
+
+class BackupError(Exception):
+    """Raised when a backup cannot be written or read"""
+
+    pass
+
+
+def chunk_boundaries(data: bytes) -> Iterator[Tuple[int, int]]:
+    """(start, end) offsets of the content-defined chunks of data"""
+    size = len(data)
+    marks = data.translate(MARKER_TABLE)
+    start = 0
+    while start < size:
+        end = min(start + MAX_CHUNK, size)
+        cut = end
+        if start + MIN_CHUNK < end:
+            found = marks.find(MARKER_RUN, start + MIN_CHUNK, end)
+            if found >= 0:
+                cut = found + len(MARKER_RUN)
+        yield start, cut
+        start = cut
+
+
+def iter_chunks(f: BinaryIO, read_size: int = READ_SIZE) -> Iterator[bytes]:
+    """
+    Content-defined chunks of a file read read_size bytes at a time
+
+    The cuts are those chunk_boundaries makes on the whole content: a chunk
+    ending at the end of what was read so far, short of MAX_CHUNK, is
+    carried over and scanned again with the next read.
+    """
+    pending = b""
+    while True:
+        block = f.read(read_size)
+        data = pending + block if pending else block
+        if not block:
+            for start, end in chunk_boundaries(data):
+                yield data[start:end]
+            return
+        pending = b""
+        for start, end in chunk_boundaries(data):
+            if end == len(data) and end - start < MAX_CHUNK:
+                pending = data[start:]
+                break
+            yield data[start:end]
+
+
+@dataclass
+class RetentionPolicy:
+    """How many hourly, daily and weekly backups to keep"""
+
+    hourly: int = 24
+    daily: int = 7
+    weekly: int = 4
+
+    def keep(self, timestamps: Sequence[float]) -> Set[float]:
+        """The timestamps to keep, the newest always included"""
+        newest_first = sorted(timestamps, reverse=True)
+        kept = set(newest_first[:1])
+        for count, period in (
+            (self.hourly, 3600),
+            (self.daily, 86400),
+            (self.weekly, 7 * 86400),
+        ):
+            buckets: Set[int] = set()
+            for ts in newest_first:
+                if len(buckets) >= count:
+                    break
+                bucket = int(ts // period)
+                if bucket not in buckets:
+                    buckets.add(bucket)
+                    kept.add(ts)
+        return kept
+
+
+class BackupStore:
+    """Content-addressed chunk store with per-subscription manifests"""
+
+    def __init__(
+        self,
+        root: str = BACKUP_ROOT,
+        policy: Optional[RetentionPolicy] = None,
+        workers: int = 4,
+    ):
+        self.root = root
+        self.policy = policy or RetentionPolicy()
+        self.workers = workers
+        self.chunks_path = os.path.join(root, "chunks")
+        self.manifests_path = os.path.join(root, "manifests")
+        self.lock_path = os.path.join(root, ".store.lock")
+
+    # Chunks
+
+    def chunk_path(self, digest: str) -> str:
+        return os.path.join(self.chunks_path, digest[:2], digest)
+
+    def _has_chunk(self, digest: str) -> bool:
+        return os.path.exists(self.chunk_path(digest))
+
+    def _store_chunk(self, data: bytes) -> Tuple[str, int]:
+        """Store one chunk, returns its hash and the bytes newly written"""
+        digest = hashlib.sha256(data).hexdigest()
+        if self._has_chunk(digest):
+            return digest, 0
+        compressed = zlib.compress(data, COMPRESS_LEVEL)
+        self._write_atomic(self.chunk_path(digest), compressed)
+        return digest, len(compressed)
+
+    def read_chunk(self, digest: str) -> bytes:
+        """Decompressed chunk, verified against its hash"""
+        try:
+            with open(self.chunk_path(digest), "rb") as f:
+                data = zlib.decompress(f.read())
+        except (OSError, zlib.error) as e:
+            raise BackupError(f"Unreadable chunk {digest}: {e}")
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise BackupError(f"Chunk {digest} is corrupt")
+        return data
+
+    @staticmethod
+    def _write_atomic(path: str, data: bytes):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            delete=False, dir=directory, suffix=".tmp"
+        ) as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_file.name, path)
+
+    # Manifests
+
+    def _manifest_dir(self, subscription_id: str) -> str:
+        return os.path.join(self.manifests_path, subscription_id)
+
+    def list_backups(self, subscription_id: str) -> List[Dict]:
+        """Manifests of a subscription without their file lists, oldest first"""
+        backups = []
+        directory = self._manifest_dir(subscription_id)
+        if not os.path.isdir(directory):
+            return backups
+        for name in os.listdir(directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                manifest = self.load_manifest(subscription_id, name[:-5])
+            except BackupError as e:
+                logger.warning(str(e))
+                continue
+            manifest.pop("files", None)
+            backups.append(manifest)
+        return sorted(backups, key=lambda m: m["timestamp"])
+
+    def manifest_path(self, subscription_id: str, backup_id: str) -> str:
+        return os.path.join(self._manifest_dir(subscription_id), f"{backup_id}.json")
+
+    def load_manifest(self, subscription_id: str, backup_id: str) -> Dict:
+        path = self.manifest_path(subscription_id, backup_id)
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            raise BackupError(f"Unreadable manifest {path}: {e}")
+
+    def find_backup(self, subscription_id: str, ref: Optional[str] = None) -> str:
+        """
+        Id of the backup a reference points at
+
+        ref is a backup id, or a point in time (unix seconds or ISO 8601,
+        UTC unless it has an offset) resolving to the newest backup taken
+        at or before it. None means the newest backup.
+        """
+        backups = self.list_backups(subscription_id)
+        if not backups:
+            raise BackupError(f"No backups of {subscription_id}")
+        if ref is None:
+            return backups[-1]["id"]
+        if any(b["id"] == ref for b in backups):
+            return ref
+        try:
+            point = float(ref)
+        except ValueError:
+            try:
+                stamp = datetime.datetime.fromisoformat(ref)
+            except ValueError:
+                raise BackupError(f"Unknown backup: {ref}")
+            if stamp.tzinfo is None:
+                stamp = stamp.replace(tzinfo=datetime.timezone.utc)
+            point = stamp.timestamp()
+        earlier = [b for b in backups if b["timestamp"] <= point]
+        if not earlier:
+            raise BackupError(f"No backup of {subscription_id} before {ref}")
+        return earlier[-1]["id"]
+
+    def _latest_manifest(self, subscription_id: str) -> Optional[Dict]:
+        backups = self.list_backups(subscription_id)
+        if not backups:
+            return None
+        return self.load_manifest(subscription_id, backups[-1]["id"])
+
+    def _new_backup_id(self, subscription_id: str, now: float) -> str:
+        stamp = datetime.datetime.fromtimestamp(now, datetime.timezone.utc)
+        backup_id = stamp.strftime("%Y%m%dT%H%M%SZ")
+        directory = self._manifest_dir(subscription_id)
+        suffix = 1
+        candidate = backup_id
+        while os.path.exists(os.path.join(directory, f"{candidate}.json")):
+            candidate = f"{backup_id}-{suffix}"
+            suffix += 1
+        return candidate
+
+    # Backup
+
+    @staticmethod
+    def _walk(
+        source_dir: str, paths: Sequence[str], exclude: Sequence[str]
+    ) -> Iterator[Tuple[str, str]]:
+        """(relative path, absolute path) of every regular file to back up"""
+        for rel_root in paths:
+            top = os.path.normpath(os.path.join(source_dir, rel_root))
+            for dirpath, dirnames, filenames in os.walk(top):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    if any(fnmatch.fnmatch(name, pattern) for pattern in exclude):
+                        continue
+                    full = os.path.join(dirpath, name)
+                    if os.path.islink(full) or not os.path.isfile(full):
+                        continue
+                    yield os.path.relpath(full, source_dir), full
+
+    def _store_file(
+        self,
+        f: BinaryIO,
+        executor: Executor,
+        throttle: Optional[Callable[[int], None]] = None,
+    ) -> Tuple[List[Tuple[str, int]], int, int]:
+        """
+        Chunk and store a file as it is read, with at most two chunks per
+        worker in memory; returns (hash, bytes written) of every chunk, the
+        file's size and the bytes newly written
+        """
+        size = 0
+
+        def pieces() -> Iterator[bytes]:
+            nonlocal size
+            for piece in iter_chunks(f):
+                if throttle is not None:
+                    throttle(len(piece))
+                size += len(piece)
+                yield piece
+
+        chunks = list(
+            self._ordered(executor, self._store_chunk, pieces(), 2 * self.workers)
+        )
+        return chunks, size, sum(n for _, n in chunks)
+
+    def backup(
+        self,
+        subscription_id: str,
+        source_dir: str,
+        paths: Sequence[str] = (".",),
+        exclude: Sequence[str] = (),
+        throttle: Optional[Callable[[int], None]] = None,
+    ) -> Dict:
+        """
+        Back up paths (relative to source_dir) of one subscription
+
+        Args:
+            throttle: Called with the size of every chunk read, blocking
+                to cap the read rate
+
+        Returns:
+            Dict: The manifest header with size and dedup statistics
+        """
+        started = time.monotonic()
+        now = time.time()
+        previous = self._latest_manifest(subscription_id)
+        previous_files = {
+            entry["path"]: entry for entry in (previous or {}).get("files", [])
+        }
+
+        files = []
+        stats = {
+            "file_count": 0,
+            "files_reused": 0,
+            "bytes_total": 0,
+            "bytes_read": 0,
+            "bytes_stored": 0,
+            "chunks_total": 0,
+            "chunks_new": 0,
+        }
+        with FileLock(self.lock_path, shared=True), ThreadPoolExecutor(
+            max_workers=self.workers
+        ) as executor:
+            for rel_path, full_path in self._walk(source_dir, paths, exclude):
+                try:
+                    st = os.stat(full_path)
+                    entry = {
+                        "path": rel_path,
+                        "size": st.st_size,
+                        "mtime_ns": st.st_mtime_ns,
+                        "mode": st.st_mode & 0o7777,
+                    }
+                    old = previous_files.get(rel_path)
+                    if (
+                        old is not None
+                        and old["size"] == st.st_size
+                        and old["mtime_ns"] == st.st_mtime_ns
+                        and all(map(self._has_chunk, old["chunks"]))
+                    ):
+                        entry["chunks"] = old["chunks"]
+                        stats["files_reused"] += 1
+                    else:
+                        with open(full_path, "rb") as f:
+                            chunks, size, written = self._store_file(
+                                f, executor, throttle
+                            )
+                        entry["chunks"] = [digest for digest, _ in chunks]
+                        entry["size"] = size
+                        stats["bytes_read"] += size
+                        stats["bytes_stored"] += written
+                        stats["chunks_new"] += sum(1 for _, n in chunks if n)
+                except FileNotFoundError:
+                    # Deleted while walking, e.g. a save's .new file
+                    continue
+                except OSError as e:
+                    raise BackupError(f"Failed to back up {full_path}: {e}")
+                files.append(entry)
+                stats["file_count"] += 1
+                stats["bytes_total"] += entry["size"]
+                stats["chunks_total"] += len(entry["chunks"])
+
+            backup_id = self._new_backup_id(subscription_id, now)
+            manifest = {
+                "id": backup_id,
+                "subscription_id": subscription_id,
+                "timestamp": now,
+                "source": source_dir,
+                **stats,
+                "files": files,
+            }
+            directory = self._manifest_dir(subscription_id)
+            self._write_atomic(
+                os.path.join(directory, f"{backup_id}.json"),
+                json.dumps(manifest).encode(),
+            )
+
+        manifest.pop("files")
+        manifest["duration"] = round(time.monotonic() - started, 3)
+        logger.info(
+            f"Backup {backup_id} of {subscription_id}: {stats['file_count']} files, "
+            f"{stats['bytes_total']} bytes, {stats['bytes_stored']} bytes new"
+        )
+        return manifest
+
+    # Retention
+
+    def prune(
+        self, subscription_id: str, protected: Container[str] = ()
+    ) -> List[str]:
+        """
+        Delete manifests the retention policy no longer keeps
+
+        Args:
+            protected: Backup ids kept regardless, e.g. not yet offloaded
+        """
+        backups = self.list_backups(subscription_id)
+        kept = self.policy.keep([b["timestamp"] for b in backups])
+        pruned = []
+        for backup in backups:
+            if backup["timestamp"] in kept or backup["id"] in protected:
+                continue
+            path = self.manifest_path(subscription_id, backup["id"])
+            try:
+                os.unlink(path)
+                pruned.append(backup["id"])
+            except FileNotFoundError:
+                continue
+        if pruned:
+            logger.info(f"Pruned {len(pruned)} backups of {subscription_id}")
+        return pruned
+
+    def gc(self) -> Dict[str, int]:
+        """Mark every chunk referenced by a manifest, sweep the rest"""
+        with FileLock(self.lock_path):
+            referenced: Set[str] = set()
+            if os.path.isdir(self.manifests_path):
+                for subscription_id in os.listdir(self.manifests_path):
+                    directory = self._manifest_dir(subscription_id)
+                    for name in os.listdir(directory):
+                        if not name.endswith(".json"):
+                            continue
+                        try:
+                            manifest = self.load_manifest(subscription_id, name[:-5])
+                        except BackupError as e:
+                            # Keep everything rather than lose chunks it needs
+                            logger.error(f"Skipping garbage collection: {e}")
+                            return {"chunks_removed": 0, "bytes_freed": 0}
+                        for entry in manifest["files"]:
+                            referenced.update(entry["chunks"])
+
+            removed = freed = 0
+            if os.path.isdir(self.chunks_path):
+                for prefix in os.listdir(self.chunks_path):
+                    directory = os.path.join(self.chunks_path, prefix)
+                    for name in os.listdir(directory):
+                        if name in referenced:
+                            continue
+                        path = os.path.join(directory, name)
+                        try:
+                            freed += os.path.getsize(path)
+                            os.unlink(path)
+                            removed += 1
+                        except FileNotFoundError:
+                            continue
+        logger.info(f"Backup GC removed {removed} chunks, {freed} bytes")
+        return {"chunks_removed": removed, "bytes_freed": freed}
+
+    # Restore
+
+    @staticmethod
+    def _ordered(
+        executor: Executor, fn: Callable, items: Iterable, window: int
+    ) -> Iterator:
+        """executor.map with at most `window` results in flight"""
+        pending: collections.deque = collections.deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def restore(
+        self,
+        subscription_id: str,
+        backup_id: str,
+        target_dir: str,
+        workers: Optional[int] = None,
+        progress: Optional[Callable[[int, int], None]] = None,
+    ) -> Dict:
+        """
+        Write every file of a backup into target_dir
+
+        Files are restored in parallel, and the chunks of each file are
+        decompressed and checked against their hash on a second pool while
+        earlier chunks are written. Every file lands through a temp file
+        and a rename with its original mode and mtime. Files missing from
+        the backup are left alone.
+
+        Args:
+            progress: Called with (bytes restored, total bytes)
+        """
+        started = time.monotonic()
+        manifest = self.load_manifest(subscription_id, backup_id)
+        files = manifest["files"]
+        total = sum(entry["size"] for entry in files)
+        workers = workers or os.cpu_count() or 1
+        target_root = os.path.realpath(target_dir)
+        done = [0]
+        done_lock = threading.Lock()
+
+        def restore_file(entry: Dict, chunk_pool: Executor):
+            dst = os.path.realpath(os.path.join(target_root, entry["path"]))
+            if not dst.startswith(target_root + os.sep):
+                raise BackupError(f"Path escapes the target: {entry['path']}")
+            directory = os.path.dirname(dst)
+            os.makedirs(directory, exist_ok=True)
+            written = 0
+            with tempfile.NamedTemporaryFile(
+                delete=False, dir=directory, suffix=".restore.tmp"
+            ) as tmp_file:
+                try:
+                    for data in self._ordered(
+                        chunk_pool, self.read_chunk, entry["chunks"], 2 * workers
+                    ):
+                        tmp_file.write(data)
+                        written += len(data)
+                        with done_lock:
+                            done[0] += len(data)
+                            if progress is not None:
+                                progress(done[0], total)
+                    if written != entry["size"]:
+                        raise BackupError(
+                            f"{entry['path']}: restored {written} of "
+                            f"{entry['size']} bytes"
+                        )
+                except BaseException:
+                    tmp_file.close()
+                    os.unlink(tmp_file.name)
+                    raise
+            os.chmod(tmp_file.name, entry["mode"])
+            os.utime(tmp_file.name, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+            os.replace(tmp_file.name, dst)
+
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="restore-chunk"
+        ) as chunk_pool, ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="restore-file"
+        ) as file_pool:
+            futures = [
+                file_pool.submit(restore_file, entry, chunk_pool) for entry in files
+            ]
+            try:
+                for future in futures:
+                    future.result()
+            except OSError as e:
+                raise BackupError(f"Restore of {backup_id} failed: {e}")
+            finally:
+                for future in futures:
+                    future.cancel()
+
+        duration = time.monotonic() - started
+        logger.info(
+            f"Restored {backup_id} of {subscription_id}: {len(files)} files, "
+            f"{total} bytes in {duration:.1f}s"
+        )
+        return {
+            "backup_id": backup_id,
+            "files": len(files),
+            "bytes": total,
+            "duration": round(duration, 3),
+            "throughput_mb_s": round(total / duration / 1e6, 2) if duration else None,
+        }
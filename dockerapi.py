@@ -0,0 +1,368 @@
+"""
+Minimal Docker Engine API client over the local Unix socket.
+
+Keeps a small pool of kept-alive HTTP connections to /var/run/docker.sock so
+container lookups cost one round trip instead of forking the docker CLI.
+Compose itself has no Engine API, so `docker compose up/down` stays on the
+CLI and this client covers the per-container calls around it.
+"""
+
+import http.client
+import json
+import logging
+import os
+import queue
+import socket
+import urllib.parse
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+DOCKER_SOCKET = os.environ.get("DOCKER_SOCKET", "/var/run/docker.sock")
+API_VERSION = "v1.41"
+
+logger = logging.getLogger("game-server-setup")
+
+
+class DockerAPIError(Exception):
+    """Raised when the Docker Engine API returns an error or is unreachable"""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection that talks to a Unix domain socket"""
+
+    def __init__(self, socket_path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class EventStream:
+    """
+    Decoded /events stream held on its own connection
+
+    close() may be called from another thread to end the iteration.
+    """
+
+    def __init__(self, conn: UnixHTTPConnection, response: http.client.HTTPResponse):
+        self.conn = conn
+        self.response = response
+
+    def __iter__(self) -> Iterator[Dict]:
+        try:
+            for line in self.response:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            raise DockerAPIError(f"Event stream ended: {e}")
+
+    def close(self):
+        if self.conn.sock is not None:
+            try:
+                self.conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.conn.close()
+
+
+class DockerClient:
+    """Thread-safe Docker Engine API client with pooled connections"""
+
+    def __init__(
+        self,
+        socket_path: str = DOCKER_SOCKET,
+        pool_size: int = 8,
+        timeout: Optional[float] = 30,
+    ):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._pool: "queue.LifoQueue[UnixHTTPConnection]" = queue.LifoQueue(
+            maxsize=pool_size
+        )
+
+    @classmethod
+    def from_socket(cls, socket_path: str = DOCKER_SOCKET) -> Optional["DockerClient"]:
+        """Return a client if the daemon answers on socket_path, else None"""
+        if not os.path.exists(socket_path):
+            return None
+        client = cls(socket_path)
+        try:
+            client.ping()
+        except DockerAPIError as e:
+            logger.warning(f"Docker Engine API unavailable, using CLI: {e}")
+            return None
+        return client
+
+    def _get_connection(self) -> UnixHTTPConnection:
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+
+    def _put_connection(self, conn: UnixHTTPConnection):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        body: Optional[Dict] = None,
+        timeout: Optional[float] = None,
+        raw: bool = False,
+    ) -> Any:
+        """Perform one API call and return the decoded JSON body (or None)"""
+        url = f"/{API_VERSION}{path}"
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        payload = json.dumps(body).encode() if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload else {}
+
+        # A pooled connection may have been closed by the daemon; retry once
+        for attempt in range(2):
+            conn = self._get_connection()
+            if timeout is not None:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+            try:
+                conn.request(method, url, body=payload, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (
+                http.client.RemoteDisconnected,
+                BrokenPipeError,
+                ConnectionResetError,
+            ):
+                conn.close()
+                if attempt == 0:
+                    continue
+                raise DockerAPIError(f"{method} {path}: connection lost")
+            except OSError as e:
+                conn.close()
+                raise DockerAPIError(f"{method} {path}: {e}")
+            break
+
+        if timeout is not None:
+            conn.timeout = self.timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(self.timeout)
+        self._put_connection(conn)
+
+        if response.status >= 400:
+            try:
+                message = json.loads(data).get("message", data.decode())
+            except ValueError:
+                message = data.decode(errors="replace")
+            raise DockerAPIError(f"{method} {path}: {message}", response.status)
+        if raw:
+            return data
+        if not data:
+            return None
+        try:
+            return json.loads(data)
+        except ValueError:
+            return data.decode(errors="replace")
+
+    def events(
+        self,
+        filters: Optional[Dict[str, List[str]]] = None,
+        since: Optional[float] = None,
+    ) -> EventStream:
+        """Subscribe to daemon events; blocks on reads until an event arrives"""
+        params: Dict[str, Any] = {}
+        if filters:
+            params["filters"] = json.dumps(filters)
+        if since is not None:
+            params["since"] = f"{since:.9f}"
+        url = f"/{API_VERSION}/events"
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        # Never pooled: the connection is held for the life of the stream
+        conn = UnixHTTPConnection(self.socket_path, timeout=None)
+        try:
+            conn.request("GET", url)
+            response = conn.getresponse()
+        except OSError as e:
+            conn.close()
+            raise DockerAPIError(f"GET /events: {e}")
+        if response.status >= 400:
+            data = response.read()
+            conn.close()
+            raise DockerAPIError(
+                f"GET /events: {data.decode(errors='replace')}", response.status
+            )
+        return EventStream(conn, response)
+
+    def close(self):
+        """Close all pooled connections"""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    # Containers
+
+    def ping(self) -> bool:
+        return self.request("GET", "/_ping") == "OK"
+
+    def list_containers(
+        self, all: bool = True, filters: Optional[Dict[str, List[str]]] = None
+    ) -> List[Dict]:
+        params: Dict[str, Any] = {"all": int(all)}
+        if filters:
+            params["filters"] = json.dumps(filters)
+        return self.request("GET", "/containers/json", params=params)
+
+    def project_containers(self, project: str) -> List[Dict]:
+        """Containers that docker compose created for project"""
+        return self.list_containers(
+            filters={"label": [f"com.docker.compose.project={project}"]}
+        )
+
+    def inspect_container(self, container: str) -> Dict:
+        return self.request("GET", f"/containers/{container}/json")
+
+    def create_container(self, name: str, config: Dict) -> str:
+        created = self.request(
+            "POST", "/containers/create", params={"name": name}, body=config
+        )
+        return created["Id"]
+
+    def start_container(self, container: str):
+        try:
+            self.request("POST", f"/containers/{container}/start")
+        except DockerAPIError as e:
+            # 304: already started
+            if e.status != 304:
+                raise
+
+    def stop_container(self, container: str, timeout: int = 30):
+        try:
+            self.request(
+                "POST",
+                f"/containers/{container}/stop",
+                params={"t": timeout},
+                timeout=timeout + (self.timeout or 0),
+            )
+        except DockerAPIError as e:
+            # 304: already stopped
+            if e.status != 304:
+                raise
+
+    def restart_container(self, container: str, timeout: int = 30):
+        self.request(
+            "POST",
+            f"/containers/{container}/restart",
+            params={"t": timeout},
+            timeout=timeout + (self.timeout or 0),
+        )
+
+    def remove_container(self, container: str, force: bool = False):
+        try:
+            self.request(
+                "DELETE", f"/containers/{container}", params={"force": int(force)}
+            )
+        except DockerAPIError as e:
+            if e.status != 404:
+                raise
+
+    def exec_run(self, container: str, cmd: List[str]) -> Tuple[int, str]:
+        """Run cmd inside a running container, returns (exit code, output)"""
+        created = self.request(
+            "POST",
+            f"/containers/{container}/exec",
+            body={"Cmd": cmd, "AttachStdout": True, "AttachStderr": True},
+        )
+        stream = self.request(
+            "POST",
+            f"/exec/{created['Id']}/start",
+            body={"Detach": False, "Tty": False},
+            raw=True,
+        )
+        inspect = self.request("GET", f"/exec/{created['Id']}/json")
+        return inspect.get("ExitCode") or 0, demux_stream(stream)
+
+    def container_stats(self, container: str) -> Dict:
+        """One stats sample including precpu_stats for CPU deltas"""
+        return self.request(
+            "GET", f"/containers/{container}/stats", params={"stream": "false"}
+        )
+
+
+def demux_stream(data: bytes) -> str:
+    """Join stdout/stderr frames of a non-TTY attach stream"""
+    out = []
+    offset = 0
+    # Each frame: 1 byte stream type, 3 zero bytes, 4 byte big-endian size
+    while offset + 8 <= len(data):
+        size = int.from_bytes(data[offset + 4 : offset + 8], "big")
+        out.append(data[offset + 8 : offset + 8 + size])
+        offset += 8 + size
+    return b"".join(out).decode(errors="replace")
+
+
+def container_ip(summary: Dict) -> str:
+    """IP address from a /containers/json or inspect NetworkSettings block"""
+    networks = (summary.get("NetworkSettings") or {}).get("Networks") or {}
+    return "".join(n.get("IPAddress", "") for n in networks.values())
+
+
+def cpu_percent(stats: Dict) -> float:
+    """CPU percentage from a stats sample, computed like `docker stats`"""
+    cpu = stats.get("cpu_stats") or {}
+    precpu = stats.get("precpu_stats") or {}
+    cpu_delta = (cpu.get("cpu_usage") or {}).get("total_usage", 0) - (
+        precpu.get("cpu_usage") or {}
+    ).get("total_usage", 0)
+    system_delta = cpu.get("system_cpu_usage", 0) - precpu.get("system_cpu_usage", 0)
+    online_cpus = cpu.get("online_cpus") or len(
+        (cpu.get("cpu_usage") or {}).get("percpu_usage") or [1]
+    )
+    if cpu_delta <= 0 or system_delta <= 0:
+        return 0.0
+    return cpu_delta / system_delta * online_cpus * 100.0
+
+
+def memory_usage(stats: Dict) -> Dict[str, int]:
+    """Used and limit bytes from a stats sample, minus page cache like the CLI"""
+    memory = stats.get("memory_stats") or {}
+    detail = memory.get("stats") or {}
+    usage = memory.get("usage", 0) - detail.get(
+        "inactive_file", detail.get("total_inactive_file", 0)
+    )
+    return {"usage": max(usage, 0), "limit": memory.get("limit", 0)}
+
+
+def stats_metrics(stats: Dict) -> Dict:
+    """Numeric metrics from a stats sample, same keys as cgroupmetrics"""
+    memory = memory_usage(stats)
+    read_bytes = write_bytes = 0
+    for entry in (stats.get("blkio_stats") or {}).get(
+        "io_service_bytes_recursive"
+    ) or []:
+        op = entry.get("op", "").lower()
+        if op == "read":
+            read_bytes += entry.get("value", 0)
+        elif op == "write":
+            write_bytes += entry.get("value", 0)
+    return {
+        "cpu_percent": round(cpu_percent(stats), 2),
+        "memory_bytes": memory["usage"],
+        "memory_limit_bytes": memory["limit"] or None,
+        "io_read_bytes": read_bytes,
+        "io_write_bytes": write_bytes,
+        "pids": (stats.get("pids_stats") or {}).get("current", 0),
+    }
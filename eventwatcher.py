@@ -0,0 +1,309 @@
+"""
+Container state tracking from the Docker events stream.
+
+The watcher lists the fleet's containers once, then follows /events and
+keeps a live cache of each subscription's container id, IP, state and
+health. Containers map to subscriptions by their compose project label, or
+by the `<game>_<subscription>` container name the templates use. While the
+stream is connected, GameServerManager.project_containers() answers from
+the cache instead of listing containers.
+
+Crashes, OOM kills, restarts and health changes are pushed to HOST_API as
+"event" results the moment they happen. The compose templates use
+`restart: always`, so a crashing server dies and restarts in a loop: the
+first crash in `crash_window` seconds is reported at once, repeats are
+counted and reported as one "crash_loop" event per window once
+`crash_threshold` is reached. A die preceded by kill/stop is an ordinary
+stop and not reported as a crash.
+"""
+
+import collections
+import logging
+import re
+import sqlite3
+import threading
+import time
+from typing import Deque, Dict, Optional, Tuple
+
+import dockerapi
+from customdataclasses import ServerResult
+from dockerapi import DockerAPIError
+
+logger = logging.getLogger("game-server-setup")
+
+PROJECT_LABEL = "com.docker.compose.project"
+
+EVENTS = [
+    "start",
+    "kill",
+    "stop",
+    "die",
+    "oom",
+    "restart",
+    "destroy",
+    "health_status",
+]
+
+
+class DockerEventWatcher(threading.Thread):
+    """Follows container events and keeps a per-subscription cache"""
+
+    def __init__(
+        self,
+        manager,
+        crash_window: float = 300,
+        crash_threshold: int = 3,
+        reconnect_max: float = 60,
+    ):
+        super().__init__(name="docker-events", daemon=True)
+        self.manager = manager
+        self.docker = manager.docker
+        self.crash_window = crash_window
+        self.crash_threshold = crash_threshold
+        self.reconnect_max = reconnect_max
+        games = "|".join(re.escape(g) for g in manager.registry.get_supported_games())
+        self._name_pattern = re.compile(rf"^/?(?:{games})_(.+)$")
+        self._cache: Dict[str, Dict] = {}
+        self._crashes: Dict[str, Deque[float]] = {}
+        self._loop_reported: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._stream: Optional[dockerapi.EventStream] = None
+        self._stop_event = threading.Event()
+        self.synced = False
+
+    # Cache
+
+    def subscription_of(self, attributes: Dict) -> Optional[str]:
+        """Subscription a container belongs to, from its name or labels"""
+        match = self._name_pattern.match(attributes.get("name", ""))
+        if match:
+            return match.group(1)
+        # Other compose projects on the host (the SFTP server) are skipped
+        project = attributes.get(PROJECT_LABEL)
+        if project and self.manager.state.get(project) is not None:
+            return project
+        return None
+
+    def get(self, subscription_id: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._cache.get(subscription_id)
+            return dict(entry) if entry is not None else None
+
+    def project_containers(self) -> Dict[str, Tuple[str, str]]:
+        """Same shape as GameServerManager.project_containers()"""
+        with self._lock:
+            return {
+                sub: (entry["container_id"], entry["state"])
+                for sub, entry in self._cache.items()
+            }
+
+    def _prime(self):
+        """Rebuild the cache from one container listing"""
+        cache = {}
+        for summary in self.docker.list_containers(
+            filters={"label": [PROJECT_LABEL]}
+        ):
+            attributes = dict(summary.get("Labels") or {})
+            attributes["name"] = (summary.get("Names") or [""])[0]
+            subscription_id = self.subscription_of(attributes)
+            if subscription_id is None:
+                continue
+            cache[subscription_id] = {
+                "container_id": summary["Id"],
+                "container_ip": dockerapi.container_ip(summary),
+                "state": summary["State"],
+                "health": None,
+                "stopping": False,
+                "reported": False,
+            }
+        with self._lock:
+            self._cache = cache
+
+    # Events
+
+    def stop(self):
+        self._stop_event.set()
+        stream = self._stream
+        if stream is not None:
+            stream.close()
+
+    def run(self):
+        delay = 1.0
+        while not self._stop_event.is_set():
+            # Listed before subscribing, so replaying from `since` covers
+            # anything that happened in between
+            since = time.time()
+            try:
+                self._prime()
+                self._stream = self.docker.events(
+                    filters={"type": ["container"], "event": EVENTS}, since=since
+                )
+                self.synced = True
+                delay = 1.0
+                for event in self._stream:
+                    self.handle_event(event)
+            except DockerAPIError as e:
+                if not self._stop_event.is_set():
+                    logger.warning(f"Docker event stream lost: {e}")
+            except Exception as e:
+                logger.error(f"Docker event watcher failed: {e}")
+            finally:
+                self.synced = False
+                if self._stream is not None:
+                    self._stream.close()
+                    self._stream = None
+            self._stop_event.wait(delay)
+            delay = min(delay * 2, self.reconnect_max)
+
+    def handle_event(self, event: Dict):
+        actor = event.get("Actor") or {}
+        attributes = actor.get("Attributes") or {}
+        subscription_id = self.subscription_of(attributes)
+        if subscription_id is None:
+            return
+        action = event.get("Action") or event.get("status") or ""
+        container_id = actor.get("ID") or event.get("id")
+        now = event.get("timeNano", time.time_ns()) / 1e9
+
+        with self._lock:
+            entry = self._cache.setdefault(
+                subscription_id,
+                {
+                    "container_id": container_id,
+                    "container_ip": "",
+                    "state": "created",
+                    "health": None,
+                    "stopping": False,
+                    "reported": False,
+                },
+            )
+            entry["container_id"] = container_id
+            previous_state = entry["state"]
+
+        push = None
+        metrics: Dict = {"time": now}
+        if action in ("kill", "stop"):
+            with self._lock:
+                entry["stopping"] = True
+        elif action == "start":
+            container_ip = self._container_ip(container_id)
+            with self._lock:
+                # Only a reported crash gets a matching recovery
+                reported = entry["reported"]
+                entry.update(
+                    state="running",
+                    container_ip=container_ip,
+                    stopping=False,
+                    health=None,
+                    reported=False,
+                )
+            if reported:
+                push = "recovered"
+        elif action == "oom":
+            with self._lock:
+                entry["state"] = "oom"
+                entry["reported"] = True
+            push = "oom"
+        elif action == "die":
+            metrics["exit_code"] = int(attributes.get("exitCode", -1))
+            with self._lock:
+                stopping = entry["stopping"]
+                killed = previous_state == "oom"
+                if stopping:
+                    entry["state"] = "exited"
+                elif not killed:
+                    entry["state"] = "crashed"
+                entry["container_ip"] = ""
+            if not stopping:
+                push, count = self._crash(subscription_id, now)
+                metrics["crashes"] = count
+                if killed:
+                    # Already reported by its oom event
+                    push = None
+                elif push is not None:
+                    with self._lock:
+                        entry["reported"] = True
+        elif action == "restart":
+            push = "restart"
+        elif action.startswith("health_status"):
+            health = action.partition(":")[2].strip()
+            with self._lock:
+                changed = entry["health"] != health
+                entry["health"] = health
+            if changed:
+                push = f"health_{health}"
+        elif action == "destroy":
+            with self._lock:
+                self._cache.pop(subscription_id, None)
+            self._index(subscription_id, "stopped", None, None)
+            return
+
+        current = self.get(subscription_id) or {}
+        if action in ("start", "die", "oom"):
+            self._index(
+                subscription_id,
+                current.get("state"),
+                container_id,
+                current.get("container_ip") or None,
+            )
+        if push is not None:
+            logger.info(f"Container event for {subscription_id}: {push}")
+            self.manager.report(
+                ServerResult(
+                    action="event",
+                    subscription_id=subscription_id,
+                    status=push,
+                    container_id=container_id,
+                    container_ip=current.get("container_ip") or None,
+                    metrics=metrics,
+                )
+            )
+
+    def _crash(self, subscription_id: str, now: float) -> Tuple[Optional[str], int]:
+        """Event to push for a crash, None while a crash loop is debounced"""
+        with self._lock:
+            crashes = self._crashes.setdefault(subscription_id, collections.deque())
+            crashes.append(now)
+            while crashes and crashes[0] < now - self.crash_window:
+                crashes.popleft()
+            count = len(crashes)
+            if count == 1:
+                return "crashed", count
+            if count < self.crash_threshold:
+                return None, count
+            last = self._loop_reported.get(subscription_id)
+            if last is not None and now - last < self.crash_window:
+                return None, count
+            self._loop_reported[subscription_id] = now
+            return "crash_loop", count
+
+    def _container_ip(self, container_id: str) -> str:
+        try:
+            return dockerapi.container_ip(self.docker.inspect_container(container_id))
+        except DockerAPIError as e:
+            logger.warning(f"Failed to inspect {container_id}: {e}")
+            return ""
+
+    def _index(
+        self,
+        subscription_id: str,
+        status: Optional[str],
+        container_id: Optional[str],
+        container_ip: Optional[str],
+    ):
+        hibernator = self.manager.hibernator
+        if (
+            status == "exited"
+            and hibernator is not None
+            and hibernator.is_hibernated(subscription_id)
+        ):
+            status = "hibernated"
+        try:
+            self.manager.state.update(
+                subscription_id,
+                status=status,
+                container_id=container_id,
+                container_ip=container_ip,
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to index event of {subscription_id}: {e}")
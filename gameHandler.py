@@ -1,11 +1,35 @@
+import os
+import tempfile
+import threading
 from abc import ABC, abstractmethod
+from a2s import is_info_request
 from customdataclasses import GameConfig
-from typing import List, Dict
+from typing import Iterable, List, Dict, Optional, Tuple
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    Template,
+    select_autoescape,
+)
+
+# Compiled templates are shared by every process through this directory,
+# created next to the templates
+BYTECODE_CACHE_DIR = ".jinja-cache"
+
+# How a running server takes a config change, least disruptive first
+CHANGE_LEVELS = ("noop", "restart", "recreate")
 
 
 class GameHandler(ABC):
     """Abstract base class for game-specific handlers"""
 
+    def __init__(self) -> None:
+        # template dir -> environment, (template path, mtime) -> template
+        self._template_envs: Dict[str, Environment] = {}
+        self._templates: Dict[Tuple[str, int], Template] = {}
+        self._template_lock = threading.Lock()
+
     @property
     @abstractmethod
     def game_type(self) -> str:
@@ -18,6 +42,56 @@ class GameHandler(ABC):
         """Return default ports for this game"""
         pass
 
+    @property
+    def port_count(self) -> int:
+        """Number of host ports a server of this game needs"""
+        return 1
+
+    @property
+    def contiguous_ports(self) -> bool:
+        """Whether the host ports must be adjacent"""
+        return False
+
+    @property
+    def backup_paths(self) -> List[str]:
+        """Paths under the server directory that backups cover"""
+        return ["."]
+
+    def server_log_path(self, server_dir: str) -> Optional[str]:
+        """Host path of the server's log, None if it is not on the host"""
+        return None
+
+    @property
+    def query_port_index(self) -> Optional[int]:
+        """Index of the host port answering Steam A2S queries, None if none"""
+        return None
+
+    def is_wake_packet(self, port_index: int, data: bytes) -> bool:
+        """
+        True if a datagram on a hibernated server's port is a client worth
+        starting it for; by default an A2S_INFO query on the query port
+        """
+        return port_index == self.query_port_index and is_info_request(data)
+
+    @property
+    def config_change_levels(self) -> Dict[str, str]:
+        """
+        Config key -> level in CHANGE_LEVELS; unlisted keys need a restart
+
+        noop: applied without touching the server
+        restart: the server must restart with the new environment
+        recreate: the container itself (ports, mounts) must be rebuilt
+        """
+        return {}
+
+    def classify_config_changes(self, changed: Iterable[str]) -> Dict[str, List[str]]:
+        """Sort changed config keys by the level each needs"""
+        levels = self.config_change_levels
+        classes: Dict[str, List[str]] = {level: [] for level in CHANGE_LEVELS}
+        for key in sorted(changed):
+            classes[levels.get(key, "restart")].append(key)
+        return classes
+
     @abstractmethod
     def get_env_file_format(self, subscription_id) -> str:
         """Returns env file name of game"""
@@ -41,8 +115,13 @@ class GameHandler(ABC):
     @abstractmethod
     def update_config_file(
         self, env_vars: Dict, subscription_path: str, subscription_id: str
-    ):
-        """Fills compose file with defaults and any custom variables"""
+    ) -> Dict[str, Tuple[Optional[str], Optional[str]]]:
+        """
+        Bring the config file in line with env_vars, writing only on change
+
+        Returns:
+            Dict: changed key -> (old value, new value), None where absent
+        """
         pass
 
     @abstractmethod
@@ -58,3 +137,94 @@ class GameHandler(ABC):
     def validate_config(self, config: GameConfig) -> bool:
         """Validate game configuration (override if needed)"""
         return bool(config.name and config.port)
+
+    def _template_env(self, template_dir: str) -> Environment:
+        env = self._template_envs.get(template_dir)
+        if env is None:
+            bytecode_cache = None
+            cache_dir = os.path.join(template_dir, BYTECODE_CACHE_DIR)
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                bytecode_cache = FileSystemBytecodeCache(cache_dir)
+            except OSError:
+                # Read-only template dir, compile in memory only
+                pass
+            env = self._template_envs[template_dir] = Environment(
+                loader=FileSystemLoader(template_dir),
+                autoescape=select_autoescape(),
+                bytecode_cache=bytecode_cache,
+                # freshness is checked through the mtime key below
+                auto_reload=False,
+            )
+        return env
+
+    def get_template(self, template_path: str) -> Template:
+        """Compiled template, recompiled only when the file changes"""
+        path = os.path.abspath(template_path)
+        key = (path, os.stat(path).st_mtime_ns)
+        with self._template_lock:
+            template = self._templates.get(key)
+            if template is None:
+                env = self._template_env(os.path.dirname(path))
+                # Drop the stale compile of an edited template
+                if env.cache is not None:
+                    env.cache.clear()
+                for stale in [k for k in self._templates if k[0] == path]:
+                    del self._templates[stale]
+                template = self._templates[key] = env.get_template(
+                    os.path.basename(path)
+                )
+        return template
+
+    @staticmethod
+    def write_atomic(target_path: str, content: str):
+        """Write a file through a temp file in the same directory"""
+        directory = os.path.dirname(os.path.abspath(target_path))
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            mode="w", delete=False, dir=directory, suffix=".tmp"
+        ) as f:
+            f.write(content)
+        try:
+            os.replace(f.name, target_path)
+        except OSError:
+            os.unlink(f.name)
+            raise
+
+    @staticmethod
+    def read_env_file(path: str) -> Dict[str, str]:
+        """KEY=VALUE lines of an env file, empty if it does not exist"""
+        env: Dict[str, str] = {}
+        try:
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith("#") or "=" not in line:
+                        continue
+                    key, _, value = line.partition("=")
+                    env[key.strip()] = value
+        except FileNotFoundError:
+            pass
+        return env
+
+    def write_env_file(
+        self, path: str, env_vars: Dict
+    ) -> Dict[str, Tuple[Optional[str], Optional[str]]]:
+        """Replace an env file with env_vars if its content differs"""
+        desired = {key: str(value) for key, value in env_vars.items()}
+        current = self.read_env_file(path)
+        changes = {
+            key: (current.get(key), desired.get(key))
+            for key in current.keys() | desired.keys()
+            if current.get(key) != desired.get(key)
+        }
+        if changes:
+            self.write_atomic(
+                path, "".join(f"{key}={value}\n" for key, value in desired.items())
+            )
+        return changes
+
+    def render_template(self, template_path: str, context: Dict, target_path: str):
+        """Render a template into target_path atomically"""
+        content = self.get_template(template_path).render(context)
+        self.write_atomic(target_path, content)
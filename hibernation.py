@@ -0,0 +1,418 @@
+"""
+Idle hibernation of game servers with wake on connect.
+
+The hibernator, run by the manager daemon, checks every running server
+once per `tick`. A server is idle while its A2S player count is zero, or,
+for servers that do not answer A2S, while its log's join/leave and
+"Connections" lines count no players. Once idle for `idle_after` seconds
+it waits for a "World saved" line newer than the moment it went idle, up
+to `save_wait` seconds, then stops the container with a long grace period
+so the server's own shutdown save completes too.
+
+A stopped server's host ports are taken over by a WakeListener: one
+asyncio loop holding a UDP socket per port. The first datagram the game's
+handler accepts as a client's (a Steam connect on the game port, an
+A2S_INFO query on the query port) closes the subscription's sockets and
+starts the container again; scanners and other stray traffic are ignored.
+That first packet is dropped; game clients and Steam server browsers
+retry, and connect once the server has loaded its world. Starting,
+stopping or restarting a hibernated server through the manager releases
+its ports first.
+
+Hibernated servers are persisted, so a restarted daemon listens on their
+ports again.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from customdataclasses import ServerResult
+from dockerapi import DockerAPIError
+from snapshot import last_world_save, log_time, read_log_tail
+
+logger = logging.getLogger("game-server-setup")
+
+WakeFilter = Callable[[int, bytes], bool]
+
+# "06/19/2025 10:00:00: Got connection SteamID 76561198000000000"
+# "06/19/2025 10:05:00: Closing socket 76561198000000000"
+# "06/19/2025 10:05:10: Connections 0 ZDOS:130588  sent:0 recv:422"
+ACTIVITY_LINE = re.compile(
+    rb"^(\d\d/\d\d/\d{4} \d\d:\d\d:\d\d): "
+    rb"(?:(Got connection SteamID)|(Closing socket)|Connections (\d+) )",
+    re.M,
+)
+
+
+def log_players(log_path: str) -> Tuple[Optional[int], Optional[float]]:
+    """
+    Players counted from the log's tail and the epoch of the last join or
+    leave; (None, None) when the tail has no such lines
+    """
+    tail = read_log_tail(log_path)
+    players: Optional[int] = None
+    last_activity: Optional[float] = None
+    for stamp, joined, left, connections in ACTIVITY_LINE.findall(tail or b""):
+        if connections:
+            players = int(connections)
+            continue
+        players = max(0, (players or 0) + (1 if joined else -1))
+        last_activity = log_time(stamp)
+    return players, last_activity
+
+
+class _WakeProtocol(asyncio.DatagramProtocol):
+    def __init__(self, listener: "WakeListener", subscription_id: str, index: int):
+        self.listener = listener
+        self.subscription_id = subscription_id
+        self.index = index
+
+    def datagram_received(self, data: bytes, addr):
+        self.listener._packet(self.subscription_id, self.index, data, addr)
+
+
+class WakeListener(threading.Thread):
+    """UDP sockets on hibernated servers' ports, calling wake on a packet"""
+
+    def __init__(self, wake: Callable[[str], None]):
+        super().__init__(name="wake-listener", daemon=True)
+        self.wake = wake
+        self.loop = asyncio.new_event_loop()
+        self._transports: Dict[str, List[asyncio.DatagramTransport]] = {}
+        # subscription -> (port index, datagram) -> whether it wakes
+        self._accepts: Dict[str, WakeFilter] = {}
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def stop(self):
+        if self.loop.is_running():
+            for subscription_id in self.listening():
+                self.release(subscription_id)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def listening(self) -> List[str]:
+        async def keys():
+            return list(self._transports)
+
+        return self._call(keys()) if self.loop.is_running() else []
+
+    def listen(self, subscription_id: str, ports: List[int], accepts: WakeFilter):
+        """
+        Bind every port, waking on the first datagram `accepts`; raises
+        OSError if any port is taken
+        """
+        self._call(self._listen(subscription_id, ports, accepts))
+
+    async def _listen(self, subscription_id: str, ports: List[int], accepts):
+        transports = []
+        try:
+            for index, port in enumerate(ports):
+                transport, _ = await self.loop.create_datagram_endpoint(
+                    lambda index=index: _WakeProtocol(self, subscription_id, index),
+                    local_addr=("0.0.0.0", port),
+                )
+                transports.append(transport)
+        except OSError:
+            for transport in transports:
+                transport.close()
+            raise
+        self._transports[subscription_id] = transports
+        self._accepts[subscription_id] = accepts
+
+    def release(self, subscription_id: str) -> bool:
+        """Close a subscription's sockets, True if it had any"""
+        if not self.loop.is_running():
+            return False
+        return self._call(self._release(subscription_id))
+
+    async def _release(self, subscription_id: str) -> bool:
+        transports = self._transports.pop(subscription_id, None)
+        self._accepts.pop(subscription_id, None)
+        for transport in transports or ():
+            transport.close()
+        # Sockets are closed by callbacks scheduled by close()
+        await asyncio.sleep(0)
+        return transports is not None
+
+    def _packet(self, subscription_id: str, index: int, data: bytes, addr):
+        accepts = self._accepts.get(subscription_id)
+        if accepts is None:
+            return
+        try:
+            wakes = accepts(index, data)
+        except Exception as e:
+            logger.warning(f"Wake filter of {subscription_id} failed: {e}")
+            wakes = False
+        if not wakes:
+            logger.debug(
+                f"Ignoring {len(data)} byte packet for {subscription_id} "
+                f"from {addr[0]} on port {index}"
+            )
+            return
+        del self._accepts[subscription_id]
+        transports = self._transports.pop(subscription_id)
+        logger.info(f"Wake packet for {subscription_id} from {addr[0]}")
+        for transport in transports:
+            transport.close()
+        # Queued behind the close callbacks so the ports are free first
+        self.loop.call_soon(self.loop.run_in_executor, None, self.wake, subscription_id)
+
+
+class Hibernator(threading.Thread):
+    """Stops idle servers and starts them again on their first packet"""
+
+    def __init__(
+        self,
+        manager,
+        state_path: str,
+        idle_after: float = 1800,
+        save_wait: float = 1800,
+        stop_timeout: int = 120,
+        tick: float = 60,
+    ):
+        super().__init__(name="hibernator", daemon=True)
+        self.manager = manager
+        self.state_path = state_path
+        self.idle_after = idle_after
+        self.save_wait = save_wait
+        self.stop_timeout = stop_timeout
+        self.tick = tick
+        self.listener = WakeListener(self._wake)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        # subscription -> since, container_id, game_type, ports
+        self._state: Dict[str, Dict] = self._load_state()
+        # subscription -> epoch since which it has had no players
+        self._idle: Dict[str, float] = {}
+
+    # State
+
+    def _load_state(self) -> Dict[str, Dict]:
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable hibernation state: {e}")
+            return {}
+
+    def _save_state(self):
+        directory = os.path.dirname(os.path.abspath(self.state_path))
+        with self._lock:
+            content = json.dumps(self._state, indent=1)
+        with tempfile.NamedTemporaryFile(
+            mode="w", delete=False, dir=directory, suffix=".tmp"
+        ) as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_file.name, self.state_path)
+
+    def is_hibernated(self, subscription_id: str) -> bool:
+        with self._lock:
+            return subscription_id in self._state
+
+    def hibernated(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {sub: dict(entry) for sub, entry in self._state.items()}
+
+    def release(self, subscription_id: str) -> bool:
+        """Forget a hibernated server and free its ports, True if it was one"""
+        with self._lock:
+            entry = self._state.pop(subscription_id, None)
+        if entry is None:
+            return False
+        self.listener.release(subscription_id)
+        self._save_state()
+        logger.info(f"Released hibernated server {subscription_id}")
+        return True
+
+    # Loop
+
+    def stop(self):
+        self._stop_event.set()
+        self.listener.stop()
+
+    def run(self):
+        self.listener.start()
+        self._resume()
+        while not self._stop_event.wait(self.tick):
+            try:
+                self.check_once()
+            except Exception as e:
+                logger.error(f"Hibernation check failed: {e}")
+
+    def _resume(self):
+        """Listen again for servers hibernated before a daemon restart"""
+        containers = self.manager.project_containers()
+        for subscription_id, entry in self.hibernated().items():
+            _, state = containers.get(subscription_id, (None, None))
+            try:
+                if state == "running":
+                    raise OSError("container is running")
+                self.listener.listen(
+                    subscription_id, entry["ports"], self._accepts(entry)
+                )
+            except OSError as e:
+                logger.warning(f"Dropping hibernation of {subscription_id}: {e}")
+                self.release(subscription_id)
+
+    def check_once(self, now: Optional[float] = None):
+        """Hibernate every server idle for long enough"""
+        now = now if now is not None else time.time()
+        servers = [
+            entry
+            for entry in self.manager.state.list()
+            if entry["status"] == "running"
+            and not self.is_hibernated(entry["subscription_id"])
+        ]
+        counts = self.manager.player_counts(
+            [entry["subscription_id"] for entry in servers]
+        )
+        running = set()
+        for entry in servers:
+            subscription_id = entry["subscription_id"]
+            running.add(subscription_id)
+            handler = self.manager.registry.get_handler(entry["game_type"])
+            log_path = handler.server_log_path(f"/srv/allservers/{subscription_id}")
+            players, last_activity = (
+                log_players(log_path) if log_path else (None, None)
+            )
+            players = counts.get(subscription_id, players)
+            if players != 0:
+                # Busy, or no way to tell
+                self._idle.pop(subscription_id, None)
+                continue
+            since = max(self._idle.setdefault(subscription_id, now), last_activity or 0)
+            if now - since < self.idle_after:
+                continue
+            saved = last_world_save(log_path) if log_path else None
+            unsaved = log_path is not None and (saved is None or saved < since)
+            if unsaved and now - since < self.idle_after + self.save_wait:
+                continue
+            self.hibernate(entry, now - since)
+        for subscription_id in set(self._idle) - running:
+            del self._idle[subscription_id]
+
+    # Transitions
+
+    def hibernate(self, entry: Dict, idle: float) -> ServerResult:
+        """Stop a server and listen on its ports"""
+        subscription_id = entry["subscription_id"]
+        container_id = entry["container_id"]
+        ports = entry["ports"]
+        result = ServerResult(
+            action="hibernate",
+            subscription_id=subscription_id,
+            status="failed",
+            container_id=container_id,
+            ports=ports,
+            metrics={"idle_seconds": round(idle)},
+        )
+        if not container_id or not ports:
+            result.error = "Container or ports unknown"
+            return result
+
+        # Marked first, so the container's die event is indexed as such
+        with self._lock:
+            self._state[subscription_id] = {
+                "since": time.time(),
+                "container_id": container_id,
+                "game_type": entry["game_type"],
+                "ports": ports,
+            }
+        try:
+            self._stop_container(container_id)
+            self.listener.listen(subscription_id, ports, self._accepts(entry))
+        except (DockerAPIError, OSError) as e:
+            logger.error(f"Failed to hibernate {subscription_id}: {e}")
+            with self._lock:
+                self._state.pop(subscription_id, None)
+            result.error = str(e)
+            # Never leave a server down without a listener to wake it
+            try:
+                self._start_container(
+                    subscription_id, container_id, entry["game_type"]
+                )
+            except Exception as e:
+                logger.error(f"Failed to restart {subscription_id}: {e}")
+            self.manager.report(result)
+            return result
+
+        self._save_state()
+        self._idle.pop(subscription_id, None)
+        self.manager.state.update(subscription_id, status="hibernated")
+        logger.info(f"Hibernated {subscription_id} after {round(idle)}s idle")
+        result.status = "hibernated"
+        self.manager.report(result)
+        return result
+
+    def _accepts(self, entry: Dict) -> WakeFilter:
+        return self.manager.registry.get_handler(entry["game_type"]).is_wake_packet
+
+    def _wake(self, subscription_id: str):
+        with self._lock:
+            entry = self._state.pop(subscription_id, None)
+        if entry is None:
+            return
+        self._save_state()
+        result = ServerResult(
+            action="wake",
+            subscription_id=subscription_id,
+            status="running",
+            container_id=entry["container_id"],
+            ports=entry["ports"],
+            metrics={"hibernated_seconds": round(time.time() - entry["since"])},
+        )
+        try:
+            self._start_container(
+                subscription_id, entry["container_id"], entry["game_type"]
+            )
+        except Exception as e:
+            logger.error(f"Failed to wake {subscription_id}: {e}")
+            result.status = "failed"
+            result.error = str(e)
+        else:
+            # Players get a full idle period to connect
+            self._idle[subscription_id] = time.time()
+            self.manager.state.update(subscription_id, status="running")
+            logger.info(f"Woke {subscription_id}")
+        self.manager.report(result)
+
+    def _stop_container(self, container_id: str):
+        if self.manager.docker is not None:
+            self.manager.docker.stop_container(container_id, self.stop_timeout)
+            return
+        return_code, _, stderr = self.manager.run_command(
+            f"docker stop -t {self.stop_timeout} {container_id}"
+        )
+        if return_code != 0:
+            raise OSError(f"docker stop failed: {stderr}")
+
+    def _start_container(self, subscription_id: str, container_id: str, game_type):
+        """Start the stopped container, recreating it if it was removed"""
+        try:
+            if self.manager.docker is None:
+                raise DockerAPIError("Docker API unavailable")
+            self.manager.docker.start_container(container_id)
+            return
+        except DockerAPIError as e:
+            logger.warning(f"Direct start of {subscription_id} failed: {e}")
+        result = self.manager.start_server(
+            self.manager.compose_path(subscription_id, game_type),
+            subscription_id,
+            self.manager.ensure_ports(subscription_id, game_type),
+        )
+        if result.status != "running":
+            raise RuntimeError(result.error)
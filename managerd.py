@@ -0,0 +1,379 @@
+"""
+Long-running manager daemon and its thin client.
+
+The daemon keeps one GameServerManager alive and serves the same actions as
+setup_server.main() over a Unix socket, so callers stop paying interpreter
+start-up, imports and registry construction on every request.
+
+Wire format is one JSON object per line in both directions. A request is
+either {"argv": ["status", "-u", "<id>", "-g", "valheim"]} or the keyword form
+{"action": "status", "subscription_id": "<id>", "game_type": "valheim"}.
+A response is {"ok": true, "result": {...}} or {"ok": false, "error": "..."}.
+A connection may carry any number of requests.
+
+Besides the setup_server actions the daemon answers DAEMON_ACTIONS, which
+need its in-memory state:
+    history -u <id> [--start <epoch>] [--end <epoch>] [--resolution raw|1m|1h|1d]
+
+This module only imports the standard library at load time so the client side
+stays cheap; setup_server is imported lazily by the daemon itself.
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+from typing import Dict, List, Optional
+
+SOCKET_PATH = os.environ.get(
+    "SERVERMGMNT_SOCKET",
+    os.path.join(os.path.expanduser("~/servermgmnt"), "manager.sock"),
+)
+
+# Seconds between two backups of a subscription, 0 leaves backups to cron
+BACKUP_INTERVAL = int(os.environ.get("SERVERMGMNT_BACKUP_INTERVAL", "3600"))
+
+# MB/s all scheduled backups may read together, 0 for no cap
+BACKUP_READ_MBPS = float(os.environ.get("SERVERMGMNT_BACKUP_READ_MBPS", "50"))
+
+# Seconds without players before a server hibernates, 0 disables hibernation
+HIBERNATE_AFTER = int(os.environ.get("SERVERMGMNT_HIBERNATE_AFTER", "0"))
+
+# Seconds to reach the daemon; a CLI that cannot runs the action in-process
+CONNECT_TIMEOUT = 5.0
+
+# Seconds to wait for the daemon's answer. Past that the call fails instead
+# of running in-process, as the daemon may still be carrying out the action
+ACTION_TIMEOUTS = {
+    "start": 900.0,
+    "restart": 900.0,
+    "restore": 3600.0,
+    "backup": 3600.0,
+    "bulk-start": 3600.0,
+    "sftp-migrate": 600.0,
+}
+DEFAULT_TIMEOUT = 120.0
+
+logger = logging.getLogger("game-server-setup")
+
+DAEMON_ACTIONS = ["history"]
+
+
+def build_daemon_parser() -> argparse.ArgumentParser:
+    """Parser for the actions only the daemon can answer"""
+    parser = argparse.ArgumentParser("Game server manager daemon")
+    parser.add_argument("action", choices=DAEMON_ACTIONS, help="Action to perform")
+    parser.add_argument(
+        "-u", "--subscription-id", required=True, help="Unique subscription identifier"
+    )
+    parser.add_argument("--start", type=int, help="Range start (unix seconds)")
+    parser.add_argument("--end", type=int, help="Range end (unix seconds)")
+    parser.add_argument("--resolution", help="Force a tier (raw, 1m, 1h, 1d)")
+    return parser
+
+
+def request_to_argv(request: Dict) -> List[str]:
+    """Convert a JSON request into the argv understood by setup_server"""
+    if "argv" in request:
+        return [str(arg) for arg in request["argv"]]
+
+    if "action" not in request:
+        raise ValueError("Request needs either 'argv' or 'action'")
+
+    argv = [str(request["action"])]
+    for key, value in request.items():
+        if key == "action" or value is None or value is False:
+            continue
+        flag = "--" + key.replace("_", "-")
+        if value is True:
+            argv.append(flag)
+        elif isinstance(value, (list, tuple)):
+            argv.append(flag)
+            argv.extend(str(v) for v in value)
+        else:
+            argv.extend([flag, str(value)])
+    return argv
+
+
+class ManagerRequestHandler(socketserver.StreamRequestHandler):
+    """Serves newline delimited JSON requests on one connection"""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.dispatch(line)
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class ManagerDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server wrapping a single long-lived GameServerManager"""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        socket_path: str = SOCKET_PATH,
+        sample_interval: int = 10,
+        sftp_batch_window: float = 30,
+        backup_interval: int = BACKUP_INTERVAL,
+        hibernate_after: int = HIBERNATE_AFTER,
+    ):
+        # Deferred so the client never pays for requests/yaml/jinja2 imports
+        import backupscheduler
+        import eventwatcher
+        import hibernation
+        import metricshistory
+        import outbox
+        import setup_server
+
+        self.setup_server = setup_server
+        self.manager = setup_server.GameServerManager()
+        self.manager.enable_sftp_batching(sftp_batch_window)
+        self.socket_path = socket_path
+
+        # Raw tier keeps an hour at the sampling interval
+        raw_tier = ("raw", sample_interval, 3600 // sample_interval)
+        tiers = (raw_tier,) + metricshistory.DEFAULT_TIERS[1:]
+        self.history = metricshistory.MetricsHistory(tiers)
+        self.sampler = metricshistory.MetricsSampler(
+            self.manager, self.history, sample_interval
+        )
+        self.outbox_sender = outbox.OutboxSender(self.manager.outbox)
+        self.event_watcher = None
+        if self.manager.docker is not None:
+            self.event_watcher = eventwatcher.DockerEventWatcher(self.manager)
+            self.manager.events = self.event_watcher
+        self.backup_scheduler = None
+        if backup_interval > 0:
+            self.backup_scheduler = backupscheduler.BackupScheduler(
+                self.manager,
+                os.path.join(setup_server.base_path, "backup-schedule.json"),
+                interval=backup_interval,
+                read_rate=BACKUP_READ_MBPS * 1024 * 1024,
+            )
+
+        self.hibernator = None
+        if hibernate_after > 0:
+            self.hibernator = hibernation.Hibernator(
+                self.manager,
+                os.path.join(setup_server.base_path, "hibernation.json"),
+                idle_after=hibernate_after,
+            )
+            self.manager.hibernator = self.hibernator
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        super().__init__(socket_path, ManagerRequestHandler)
+        os.chmod(socket_path, 0o660)
+
+    def dispatch(self, line: bytes) -> Dict:
+        """Run one request line and build its response"""
+        try:
+            request = json.loads(line)
+            argv = request_to_argv(request)
+        except (ValueError, TypeError) as e:
+            return {"ok": False, "error": f"Invalid request: {e}"}
+
+        if argv[:1] and argv[0] in DAEMON_ACTIONS:
+            return self.dispatch_daemon_action(argv)
+
+        try:
+            result = self.setup_server.handle(self.manager, argv)
+        except SystemExit:
+            # argparse and argument validation bail out through sys.exit
+            return {"ok": False, "error": f"Invalid arguments: {argv}"}
+        except Exception as e:
+            logger.error(f"Manager daemon failed on {argv}: {e}")
+            return {"ok": False, "error": str(e)}
+
+        return {
+            "ok": True,
+            "result": self.setup_server.result_payload(result) if result else None,
+        }
+
+    def dispatch_daemon_action(self, argv: List[str]) -> Dict:
+        """Answer an action that reads daemon state"""
+        try:
+            args = build_daemon_parser().parse_args(argv)
+        except SystemExit:
+            return {"ok": False, "error": f"Invalid arguments: {argv}"}
+
+        if args.action == "history":
+            try:
+                history = self.history.query(
+                    args.subscription_id, args.start, args.end, args.resolution
+                )
+            except ValueError as e:
+                return {"ok": False, "error": str(e)}
+            if history is None:
+                return {"ok": False, "error": "No history for subscription"}
+            return {"ok": True, "result": history}
+
+        return {"ok": False, "error": f"Unknown action: {args.action}"}
+
+    def server_close(self):
+        self.sampler.stop()
+        self.manager.disable_sftp_batching()
+        self.outbox_sender.stop()
+        if self.event_watcher is not None:
+            self.event_watcher.stop()
+        if self.backup_scheduler is not None:
+            self.backup_scheduler.stop()
+        if self.hibernator is not None:
+            self.hibernator.stop()
+        if self.manager.offloads is not None:
+            self.manager.offloads.stop()
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+class ManagerClient:
+    """Client keeping one connection to the daemon open across requests"""
+
+    def __init__(
+        self,
+        socket_path: str = SOCKET_PATH,
+        timeout: Optional[float] = DEFAULT_TIMEOUT,
+        connect_timeout: float = CONNECT_TIMEOUT,
+    ):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self._sock: Optional[socket.socket] = None
+        self._rfile = None
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.connect_timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        sock.settimeout(self.timeout)
+        self._sock = sock
+        self._rfile = sock.makefile("rb")
+
+    def request(self, request: Dict, timeout: Optional[float] = None) -> Dict:
+        """
+        Send one request and wait for its response, at most `timeout` seconds
+        (the client's timeout by default); raises TimeoutError past that
+        """
+        if self._sock is None:
+            self.connect()
+        self._sock.settimeout(timeout if timeout is not None else self.timeout)
+        try:
+            self._sock.sendall(json.dumps(request).encode() + b"\n")
+            line = self._rfile.readline()
+        except TimeoutError:
+            # The late response would be read as the next request's
+            self.close()
+            raise
+        if not line:
+            self.close()
+            raise ConnectionError("Manager daemon closed the connection")
+        return json.loads(line)
+
+    def close(self):
+        if self._rfile is not None:
+            self._rfile.close()
+        if self._sock is not None:
+            self._sock.close()
+        self._sock = None
+        self._rfile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def action_timeout(argv: List[str]) -> float:
+    """Seconds to wait for the daemon to answer argv"""
+    return ACTION_TIMEOUTS.get(argv[0] if argv else "", DEFAULT_TIMEOUT)
+
+
+def forward(argv: List[str], socket_path: str = SOCKET_PATH) -> Optional[Dict]:
+    """
+    Send argv to a running daemon, returns None when no daemon accepts the
+    connection and a failed response when it does not answer in time
+    """
+    if not os.path.exists(socket_path):
+        return None
+    timeout = action_timeout(argv)
+    with ManagerClient(socket_path, timeout) as client:
+        try:
+            client.connect()
+        except (ConnectionRefusedError, FileNotFoundError):
+            return None
+        except OSError as e:
+            logger.warning(f"Manager daemon unreachable, running in-process: {e}")
+            return None
+        try:
+            return client.request({"argv": argv})
+        except TimeoutError:
+            logger.error(f"Manager daemon did not answer {argv} in {timeout:.0f}s")
+            return {
+                "ok": False,
+                "error": f"Manager daemon did not answer in {timeout:.0f}s",
+            }
+
+
+def serve(socket_path: str = SOCKET_PATH):
+    """Run the daemon until interrupted"""
+    daemon = ManagerDaemon(socket_path)
+    daemon.manager.reconcile_ports()
+    daemon.manager.remount_sftp_homes()
+    daemon.manager.reconcile_state()
+    daemon.sampler.start()
+    daemon.outbox_sender.start()
+    if daemon.event_watcher is not None:
+        daemon.event_watcher.start()
+    if daemon.backup_scheduler is not None:
+        daemon.backup_scheduler.start()
+    if daemon.hibernator is not None:
+        daemon.hibernator.start()
+    logger.info(f"Manager daemon listening on {socket_path}")
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Manager daemon shutting down")
+    finally:
+        daemon.server_close()
+
+
+def client_main(argv: List[str]) -> int:
+    """Thin CLI: forward to the daemon, run in-process only if it is down"""
+    if argv[:1] == ["serve"]:
+        serve(argv[1] if len(argv) > 1 else SOCKET_PATH)
+        return 0
+
+    response = forward(argv)
+    if response is None and argv[:1] and argv[0] in DAEMON_ACTIONS:
+        response = {"ok": False, "error": "Manager daemon is not running"}
+    elif response is None:
+        import setup_server
+
+        manager = setup_server.GameServerManager()
+        result = setup_server.handle(manager, argv)
+        manager.outbox.flush(setup_server.CLI_FLUSH_TIMEOUT)
+        manager.wait_offloads()
+        response = {
+            "ok": True,
+            "result": setup_server.result_payload(result) if result else None,
+        }
+
+    print(json.dumps(response))
+    return 0 if response.get("ok") else 1
+
+
+if __name__ == "__main__":
+    sys.exit(client_main(sys.argv[1:]))
@@ -0,0 +1,257 @@
+"""
+Per-subscription metrics history in fixed-size ring buffers.
+
+Every subscription owns one ring per tier. Each ring is a set of preallocated
+`array` columns (uint32 timestamps, float32 values), so memory per
+subscription is fixed at creation and never grows. Samples land in the raw
+tier and are averaged into 1-minute, 1-hour and 1-day tiers as their buckets
+close. Missing values (no player count yet) are stored as NaN and skipped
+when averaging.
+
+With the default tiers a subscription costs about 58 KB of array storage
+(65 KB with object overhead):
+    raw  10s x 360   (1 hour)
+    1m   60s x 1440  (1 day)
+    1h 3600s x 720   (30 days)
+    1d 86400s x 365  (1 year)
+so 1,000 servers hold a week of hourly history, and far more, in about 65 MB.
+"""
+
+import logging
+import math
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger("game-server-setup")
+
+SERIES = ("cpu_percent", "memory_bytes", "io_bytes_per_sec", "players")
+
+# (name, resolution in seconds, capacity); the raw resolution is the interval
+DEFAULT_TIERS: Tuple[Tuple[str, int, int], ...] = (
+    ("raw", 10, 360),
+    ("1m", 60, 1440),
+    ("1h", 3600, 720),
+    ("1d", 86400, 365),
+)
+
+
+class RingBuffer:
+    """Fixed capacity ring of timestamped rows, oldest overwritten first"""
+
+    __slots__ = ("capacity", "timestamps", "columns", "head", "size")
+
+    def __init__(self, capacity: int, width: int):
+        self.capacity = capacity
+        self.timestamps = array("I", bytes(4 * capacity))
+        self.columns = [array("f", bytes(4 * capacity)) for _ in range(width)]
+        self.head = 0
+        self.size = 0
+
+    def append(self, timestamp: int, row: Sequence[float]):
+        self.timestamps[self.head] = timestamp
+        for column, value in zip(self.columns, row):
+            column[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def range(self, start: int, end: int) -> Tuple[List[int], List[List[float]]]:
+        """Rows with start <= timestamp <= end, oldest first"""
+        timestamps: List[int] = []
+        columns: List[List[float]] = [[] for _ in self.columns]
+        first = (self.head - self.size) % self.capacity
+        for i in range(self.size):
+            idx = (first + i) % self.capacity
+            ts = self.timestamps[idx]
+            if ts < start or ts > end:
+                continue
+            timestamps.append(ts)
+            for out, column in zip(columns, self.columns):
+                out.append(column[idx])
+        return timestamps, columns
+
+
+class _Tier:
+    """One resolution level with its pending aggregation bucket"""
+
+    __slots__ = ("name", "resolution", "ring", "bucket", "sums", "counts")
+
+    def __init__(self, name: str, resolution: int, capacity: int, width: int):
+        self.name = name
+        self.resolution = resolution
+        self.ring = RingBuffer(capacity, width)
+        self.bucket = -1
+        self.sums = [0.0] * width
+        self.counts = [0] * width
+
+    def add(self, timestamp: int, row: Sequence[float]):
+        bucket = timestamp - timestamp % self.resolution
+        if bucket != self.bucket:
+            self.flush()
+            self.bucket = bucket
+        for i, value in enumerate(row):
+            if not math.isnan(value):
+                self.sums[i] += value
+                self.counts[i] += 1
+
+    def flush(self):
+        if self.bucket < 0:
+            return
+        self.ring.append(
+            self.bucket,
+            [s / c if c else math.nan for s, c in zip(self.sums, self.counts)],
+        )
+        self.sums = [0.0] * len(self.sums)
+        self.counts = [0] * len(self.counts)
+        self.bucket = -1
+
+
+class SubscriptionHistory:
+    """All tiers of one subscription"""
+
+    __slots__ = ("tiers",)
+
+    def __init__(self, tiers: Sequence[Tuple[str, int, int]] = DEFAULT_TIERS):
+        self.tiers = [_Tier(name, res, cap, len(SERIES)) for name, res, cap in tiers]
+
+    def record(self, timestamp: int, row: Sequence[float]):
+        raw = self.tiers[0]
+        raw.ring.append(timestamp, row)
+        for tier in self.tiers[1:]:
+            tier.add(timestamp, row)
+
+    def query(self, start: int, end: int, resolution: Optional[str] = None) -> Dict:
+        """Finest tier whose retention reaches back to start, or the named one"""
+        if resolution is not None:
+            tiers = [t for t in self.tiers if t.name == resolution]
+            if not tiers:
+                raise ValueError(f"Unknown resolution: {resolution}")
+            tier = tiers[0]
+        else:
+            now = int(time.time())
+            tier = self.tiers[-1]
+            for candidate in self.tiers:
+                retention = candidate.resolution * candidate.ring.capacity
+                if now - retention <= start:
+                    tier = candidate
+                    break
+
+        timestamps, columns = tier.ring.range(start, end)
+        result = {"resolution": tier.name, "timestamps": timestamps}
+        for name, column in zip(SERIES, columns):
+            result[name] = [None if math.isnan(v) else round(v, 3) for v in column]
+        return result
+
+
+class MetricsHistory:
+    """Thread-safe map of subscription -> history"""
+
+    def __init__(self, tiers: Sequence[Tuple[str, int, int]] = DEFAULT_TIERS):
+        self.tiers = tiers
+        self._histories: Dict[str, SubscriptionHistory] = {}
+        self._lock = threading.Lock()
+
+    def record(
+        self, subscription_id: str, timestamp: int, values: Dict[str, float]
+    ):
+        row = [float(values.get(name, math.nan)) for name in SERIES]
+        with self._lock:
+            history = self._histories.get(subscription_id)
+            if history is None:
+                history = self._histories[subscription_id] = SubscriptionHistory(
+                    self.tiers
+                )
+            history.record(timestamp, row)
+
+    def query(
+        self,
+        subscription_id: str,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        resolution: Optional[str] = None,
+    ) -> Optional[Dict]:
+        end = end if end is not None else int(time.time())
+        start = start if start is not None else end - 3600
+        with self._lock:
+            history = self._histories.get(subscription_id)
+            if history is None:
+                return None
+            return history.query(start, end, resolution)
+
+    def forget(self, subscription_id: str):
+        with self._lock:
+            self._histories.pop(subscription_id, None)
+
+    def subscriptions(self) -> List[str]:
+        with self._lock:
+            return list(self._histories)
+
+    def bytes_per_subscription(self) -> int:
+        # uint32 timestamp plus one float32 per series for every slot
+        return sum(4 * (1 + len(SERIES)) * cap for _, _, cap in self.tiers)
+
+
+class MetricsSampler(threading.Thread):
+    """Samples every running subscription into a MetricsHistory"""
+
+    def __init__(self, manager, history: MetricsHistory, interval: int = 10):
+        super().__init__(name="metrics-sampler", daemon=True)
+        self.manager = manager
+        self.history = history
+        self.interval = interval
+        self._io_totals: Dict[str, Tuple[int, int]] = {}
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            started = time.monotonic()
+            try:
+                self.sample_once()
+            except Exception as e:
+                logger.error(f"Metrics sampling failed: {e}")
+            elapsed = time.monotonic() - started
+            self._stop_event.wait(max(0.0, self.interval - elapsed))
+
+    def sample_once(self):
+        now = int(time.time())
+        containers = self.manager.project_containers()
+        running = {
+            container_id: project
+            for project, (container_id, state) in containers.items()
+            if state == "running"
+        }
+        # Stopped and recreated servers keep their history; it goes only
+        # with the subscription's compose file
+        existing = self.manager.subscription_ids()
+        for project in set(self.history.subscriptions()) - existing:
+            self.history.forget(project)
+            self._io_totals.pop(project, None)
+        metrics = self.manager.container_metrics(list(running))
+        players = self.manager.player_counts(list(running.values()))
+        for container_id, project in running.items():
+            sample = metrics.get(container_id)
+            if not sample:
+                continue
+            self.history.record(
+                project,
+                now,
+                {
+                    # No rate yet on a container's first cgroup read
+                    "cpu_percent": sample.get("cpu_percent", math.nan),
+                    "memory_bytes": sample["memory_bytes"],
+                    "io_bytes_per_sec": self._io_rate(project, now, sample),
+                    "players": players.get(project, sample.get("players", math.nan)),
+                },
+            )
+
+    def _io_rate(self, project: str, now: int, sample: Dict) -> float:
+        total = sample["io_read_bytes"] + sample["io_write_bytes"]
+        previous = self._io_totals.get(project)
+        self._io_totals[project] = (now, total)
+        if previous is None or now <= previous[0] or total < previous[1]:
+            return math.nan
+        return (total - previous[1]) / (now - previous[0])
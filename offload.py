@@ -0,0 +1,543 @@
+"""
+Offload of local backups to S3-compatible object storage (AWS, MinIO).
+
+Dedup backups are mirrored with the store's own layout, chunks first and the
+manifest last, so a manifest in the bucket always has all of its chunks:
+
+    <prefix>chunks/ab/ab12...
+    <prefix>manifests/<subscription_id>/<backup_id>.json
+    <prefix>archives/<subscription_id>/backup-....tar.gz
+
+Files above `part_size` go up as multipart uploads whose parts are sent by
+a worker pool; at most `buffer_parts` parts are held in memory. Every
+finished part is recorded in a JSON state file, so after a crash the upload
+continues from the parts the endpoint confirms instead of starting over. A
+token bucket caps the average upload rate so offload leaves bandwidth to the
+game servers. An object counts as offloaded once a HEAD of it returns the
+local size; only offloaded backups are ever pruned locally.
+
+Backups do not wait for their upload: they hand the subscription to an
+OffloadQueue, whose thread uploads one subscription at a time. What a
+process leaves queued at exit is picked up by the subscription's next
+offload, as every upload covers all backups not yet confirmed.
+
+Configured from the environment, offload is off unless a bucket is set:
+
+    SERVERMGMNT_S3_BUCKET      bucket name
+    SERVERMGMNT_S3_ENDPOINT    endpoint URL, e.g. http://127.0.0.1:9000 (MinIO)
+    SERVERMGMNT_S3_PREFIX      key prefix, e.g. the host name
+    SERVERMGMNT_S3_BANDWIDTH   upload cap in MB/s, 0 for none
+    SERVERMGMNT_S3_WORKERS     parallel uploads
+
+Credentials come from boto3's usual sources (AWS_ACCESS_KEY_ID, ...).
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from backupstore import BackupStore
+from filelock import FileLock
+
+try:
+    import boto3
+    import botocore.config
+    import botocore.exceptions
+except ImportError:
+    boto3 = None
+
+logger = logging.getLogger("game-server-setup")
+
+PART_SIZE = 16 * 1024 * 1024
+# S3 rejects parts below 5 MiB except the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+_CLIENT_ERRORS = (
+    (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError)
+    if boto3 is not None
+    else ()
+)
+
+
+class OffloadError(Exception):
+    """Raised when a backup cannot be offloaded"""
+
+    pass
+
+
+class TokenBucket:
+    """Thread-safe average rate limit in bytes per second"""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int):
+        """Block until `amount` bytes may be sent"""
+        while amount > 0:
+            step = min(amount, self.burst)
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                # Take the tokens now and sleep off any debt, so waiting
+                # threads queue up in order instead of polling
+                self._tokens -= step
+                wait = -self._tokens / self.rate if self._tokens < 0 else 0
+            if wait:
+                time.sleep(wait)
+            amount -= step
+
+
+class OffloadQueue(threading.Thread):
+    """
+    Runs offloads on one thread, in order, each (subscription, kind) queued
+    at most once; started by the first put
+    """
+
+    def __init__(self, offload: Callable[[str, str], None]):
+        super().__init__(name="offload-queue", daemon=True)
+        self.offload = offload
+        # (subscription, kind) -> None, in queue order
+        self._pending: Dict[Tuple[str, str], None] = {}
+        self._busy = False
+        self._stopping = False
+        self._cond = threading.Condition()
+
+    def put(self, subscription_id: str, kind: str):
+        with self._cond:
+            if self._stopping:
+                return
+            self._pending[(subscription_id, kind)] = None
+            if self.ident is None:
+                self.start()
+            self._cond.notify_all()
+
+    def pending(self) -> List[Tuple[str, str]]:
+        with self._cond:
+            return list(self._pending)
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                item = next(iter(self._pending))
+                del self._pending[item]
+                self._busy = True
+            try:
+                self.offload(*item)
+            except Exception as e:
+                logger.error(f"Offload of {item[0]} failed: {e}")
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """Wait until everything queued is done, False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._pending and not self._busy, timeout
+            )
+
+    def stop(self):
+        """Finish the running offload and drop the rest"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self.ident is not None:
+            self.join()
+
+
+class Offloader:
+    """Uploads dedup and archive backups and tracks what is confirmed"""
+
+    def __init__(
+        self,
+        client,
+        bucket: str,
+        state_path: str,
+        prefix: str = "",
+        bandwidth: Optional[float] = None,
+        workers: int = 4,
+        part_size: int = PART_SIZE,
+        buffer_parts: Optional[int] = None,
+    ):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.state_path = state_path
+        self.workers = workers
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.buffer_parts = buffer_parts or workers + 1
+        self.throttle = TokenBucket(bandwidth, self.part_size) if bandwidth else None
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="offload"
+        )
+        self.lock_path = state_path + ".lock"
+        self._lock = threading.Lock()
+        self._state = self._load_state()
+        self._chunks_path = state_path + ".chunks"
+        self._chunks = self._load_chunks()
+
+    @classmethod
+    def from_env(cls, state_path: str) -> Optional["Offloader"]:
+        """Offloader configured by SERVERMGMNT_S3_*, None when disabled"""
+        bucket = os.environ.get("SERVERMGMNT_S3_BUCKET")
+        if not bucket:
+            return None
+        if boto3 is None:
+            logger.warning("Backup offload needs the boto3 package; disabled")
+            return None
+        workers = int(os.environ.get("SERVERMGMNT_S3_WORKERS", "4"))
+        bandwidth = float(os.environ.get("SERVERMGMNT_S3_BANDWIDTH", "0")) * 1e6
+        client = boto3.client(
+            "s3",
+            endpoint_url=os.environ.get("SERVERMGMNT_S3_ENDPOINT") or None,
+            config=botocore.config.Config(
+                retries={"max_attempts": 5, "mode": "standard"},
+                max_pool_connections=2 * workers,
+            ),
+        )
+        return cls(
+            client,
+            bucket,
+            state_path,
+            prefix=os.environ.get("SERVERMGMNT_S3_PREFIX", ""),
+            bandwidth=bandwidth or None,
+            workers=workers,
+        )
+
+    # State
+
+    def _load_state(self) -> Dict[str, Dict]:
+        state = {"uploads": {}, "offloaded": {}}
+        try:
+            with open(self.state_path) as f:
+                state.update(json.load(f))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable offload state: {e}")
+        return state
+
+    def _save_state(self):
+        """Persist the state; caller holds self._lock"""
+        directory = os.path.dirname(os.path.abspath(self.state_path))
+        with tempfile.NamedTemporaryFile(
+            mode="w", delete=False, dir=directory, suffix=".tmp"
+        ) as tmp_file:
+            json.dump(self._state, tmp_file, indent=1)
+        os.replace(tmp_file.name, self.state_path)
+
+    def _load_chunks(self) -> Set[str]:
+        try:
+            with open(self._chunks_path) as f:
+                return {line.strip() for line in f if line.strip()}
+        except FileNotFoundError:
+            return set()
+
+    def _record_chunks(self, digests: List[str]):
+        # Append-only: chunks never change once uploaded
+        with self._lock, open(self._chunks_path, "a") as f:
+            f.write("".join(f"{d}\n" for d in digests))
+            self._chunks.update(digests)
+
+    def _reload(self):
+        """Pick up uploads made by other processes; caller holds the file lock"""
+        with self._lock:
+            self._state = self._load_state()
+            self._chunks = self._load_chunks()
+
+    def is_offloaded(self, key: str) -> bool:
+        with self._lock:
+            return key in self._state["offloaded"]
+
+    # Uploads
+
+    def _put(self, path: str, key: str) -> int:
+        with open(path, "rb") as f:
+            data = f.read()
+        if self.throttle is not None:
+            self.throttle.consume(len(data))
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+        return len(data)
+
+    def _remote_parts(self, key: str, upload_id: str) -> Optional[Dict[int, str]]:
+        """Parts the endpoint holds for an upload, None if it is gone"""
+        parts: Dict[int, str] = {}
+        kwargs = {"Bucket": self.bucket, "Key": key, "UploadId": upload_id}
+        try:
+            while True:
+                response = self.client.list_parts(**kwargs)
+                for part in response.get("Parts", []):
+                    parts[part["PartNumber"]] = part["ETag"]
+                if not response.get("IsTruncated"):
+                    return parts
+                kwargs["PartNumberMarker"] = response["NextPartNumberMarker"]
+        except _CLIENT_ERRORS as e:
+            logger.info(f"Restarting upload of {key}: {e}")
+            return None
+
+    def _abort(self, key: str, upload_id: str):
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id
+            )
+        except _CLIENT_ERRORS as e:
+            logger.warning(f"Failed to abort upload of {key}: {e}")
+
+    def _multipart(self, path: str, key: str, st: os.stat_result) -> Dict[str, int]:
+        """Upload a large file part by part, resuming a recorded upload"""
+        with self._lock:
+            pending = self._state["uploads"].get(key)
+        parts: Dict[int, str] = {}
+        if pending is not None:
+            unchanged = (
+                pending["size"] == st.st_size
+                and pending["mtime_ns"] == st.st_mtime_ns
+                and pending["part_size"] == self.part_size
+            )
+            remote = (
+                self._remote_parts(key, pending["upload_id"]) if unchanged else None
+            )
+            if remote is None:
+                self._abort(key, pending["upload_id"])
+                pending = None
+            else:
+                recorded = {int(n): etag for n, etag in pending["parts"].items()}
+                parts = {n: e for n, e in remote.items() if recorded.get(n) == e}
+        if pending is None:
+            upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=key
+            )["UploadId"]
+            pending = {
+                "upload_id": upload_id,
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "part_size": self.part_size,
+                "parts": {},
+            }
+        pending["parts"] = {str(n): etag for n, etag in parts.items()}
+        with self._lock:
+            self._state["uploads"][key] = pending
+            self._save_state()
+        resumed = len(parts)
+
+        buffered = threading.Semaphore(self.buffer_parts)
+        futures: List[Future] = []
+
+        def send(number: int, data: bytes):
+            try:
+                if self.throttle is not None:
+                    self.throttle.consume(len(data))
+                etag = self.client.upload_part(
+                    Bucket=self.bucket,
+                    Key=key,
+                    UploadId=pending["upload_id"],
+                    PartNumber=number,
+                    Body=data,
+                )["ETag"]
+                with self._lock:
+                    parts[number] = etag
+                    pending["parts"][str(number)] = etag
+                    self._save_state()
+            finally:
+                buffered.release()
+
+        part_count = max(1, -(-st.st_size // self.part_size))
+        sent = 0
+        try:
+            with open(path, "rb") as f:
+                for number in range(1, part_count + 1):
+                    if number in parts:
+                        continue
+                    # Bound memory: wait for a free buffer before reading
+                    buffered.acquire()
+                    f.seek((number - 1) * self.part_size)
+                    data = f.read(self.part_size)
+                    sent += len(data)
+                    futures.append(self.executor.submit(send, number, data))
+            for future in futures:
+                future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=key,
+            UploadId=pending["upload_id"],
+            MultipartUpload={
+                "Parts": [
+                    {"PartNumber": n, "ETag": parts[n]} for n in sorted(parts)
+                ]
+            },
+        )
+        with self._lock:
+            self._state["uploads"].pop(key, None)
+            self._save_state()
+        return {"bytes": sent, "parts": part_count, "parts_resumed": resumed}
+
+    def upload_file(self, path: str, key: str) -> Dict[str, int]:
+        """Upload one file and confirm it; no-op if already offloaded"""
+        key = self.prefix + key
+        if self.is_offloaded(key):
+            return {"bytes": 0, "parts": 0, "parts_resumed": 0}
+        try:
+            st = os.stat(path)
+            if st.st_size > self.part_size:
+                stats = self._multipart(path, key, st)
+            else:
+                stats = {"bytes": self._put(path, key), "parts": 1}
+                stats["parts_resumed"] = 0
+            head = self.client.head_object(Bucket=self.bucket, Key=key)
+        except (OSError,) + _CLIENT_ERRORS as e:
+            raise OffloadError(f"Failed to offload {path}: {e}")
+        if head["ContentLength"] != st.st_size:
+            raise OffloadError(
+                f"Offloaded {key} has {head['ContentLength']} bytes, "
+                f"expected {st.st_size}"
+            )
+        with self._lock:
+            self._state["offloaded"][key] = {
+                "size": st.st_size,
+                "etag": head.get("ETag"),
+                "at": time.time(),
+            }
+            self._save_state()
+        return stats
+
+    def abort_stale(self, prefix: str, keep: Set[str]):
+        """Abort recorded multipart uploads under prefix whose key is not kept"""
+        with self._lock:
+            stale = {
+                key: pending["upload_id"]
+                for key, pending in self._state["uploads"].items()
+                if key.startswith(prefix) and key not in keep
+            }
+        for key, upload_id in stale.items():
+            self._abort(key, upload_id)
+        if stale:
+            with self._lock:
+                for key in stale:
+                    self._state["uploads"].pop(key, None)
+                self._save_state()
+
+    # Backups
+
+    def manifest_key(self, subscription_id: str, backup_id: str) -> str:
+        return f"{self.prefix}manifests/{subscription_id}/{backup_id}.json"
+
+    def archive_key(self, subscription_id: str, archive_path: str) -> str:
+        return (
+            f"{self.prefix}archives/{subscription_id}/"
+            f"{os.path.basename(archive_path)}"
+        )
+
+    def pending_backups(self, store: BackupStore, subscription_id: str) -> Set[str]:
+        """Ids of local dedup backups not confirmed offloaded"""
+        return {
+            backup["id"]
+            for backup in store.list_backups(subscription_id)
+            if not self.is_offloaded(self.manifest_key(subscription_id, backup["id"]))
+        }
+
+    def offload_dedup(self, store: BackupStore, subscription_id: str) -> Dict:
+        """Upload every local backup of a subscription not offloaded yet"""
+        started = time.monotonic()
+        uploaded = chunks = 0
+        backups = []
+        # Shared store lock: garbage collection cannot remove chunks mid-upload
+        with FileLock(self.lock_path), FileLock(store.lock_path, shared=True):
+            self._reload()
+            for backup in store.list_backups(subscription_id):
+                if self.is_offloaded(self.manifest_key(subscription_id, backup["id"])):
+                    continue
+                manifest = store.load_manifest(subscription_id, backup["id"])
+                with self._lock:
+                    missing = sorted(
+                        {d for e in manifest["files"] for d in e["chunks"]}
+                        - self._chunks
+                    )
+                for start in range(0, len(missing), 256):
+                    batch = missing[start : start + 256]
+                    try:
+                        sizes = list(
+                            self.executor.map(
+                                lambda d: self._put(
+                                    store.chunk_path(d),
+                                    f"{self.prefix}chunks/{d[:2]}/{d}",
+                                ),
+                                batch,
+                            )
+                        )
+                    except (OSError,) + _CLIENT_ERRORS as e:
+                        raise OffloadError(f"Failed to offload chunks: {e}")
+                    self._record_chunks(batch)
+                    uploaded += sum(sizes)
+                    chunks += len(batch)
+                # Manifest last: a remote manifest implies all its chunks
+                stats = self.upload_file(
+                    store.manifest_path(subscription_id, backup["id"]),
+                    f"manifests/{subscription_id}/{backup['id']}.json",
+                )
+                uploaded += stats["bytes"]
+                backups.append(backup["id"])
+        return self._summary(started, uploaded, backups, chunks=chunks)
+
+    def offload_archives(self, subscription_id: str, archives: List[str]) -> Dict:
+        """Upload archive backups not offloaded yet"""
+        started = time.monotonic()
+        uploaded = resumed = 0
+        done = []
+        with FileLock(self.lock_path):
+            self._reload()
+            # Archives pruned or replaced since a crash leave uploads behind
+            self.abort_stale(
+                f"{self.prefix}archives/{subscription_id}/",
+                {self.archive_key(subscription_id, a) for a in archives},
+            )
+            for archive in archives:
+                if self.is_offloaded(self.archive_key(subscription_id, archive)):
+                    continue
+                stats = self.upload_file(
+                    archive,
+                    f"archives/{subscription_id}/{os.path.basename(archive)}",
+                )
+                uploaded += stats["bytes"]
+                resumed += stats["parts_resumed"]
+                done.append(os.path.basename(archive))
+        return self._summary(started, uploaded, done, parts_resumed=resumed)
+
+    def _summary(
+        self, started: float, uploaded: int, backups: List[str], **extra
+    ) -> Dict:
+        duration = time.monotonic() - started
+        if backups:
+            logger.info(
+                f"Offloaded {len(backups)} backups, {uploaded} bytes "
+                f"in {duration:.1f}s"
+            )
+        return {
+            "backups": backups,
+            "bytes_uploaded": uploaded,
+            **extra,
+            "duration": round(duration, 3),
+            "throughput_mb_s": round(uploaded / duration / 1e6, 2)
+            if duration
+            else None,
+        }
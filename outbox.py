@@ -0,0 +1,274 @@
+"""
+Durable outbox for results reported to the host API.
+
+Results are committed to a local SQLite queue the moment an action finishes
+and delivered later, so an action never waits on the backend and a result
+survives the backend being down or the process restarting.
+
+Delivery takes up to `batch_size` due rows, leases them so a concurrent
+sender (daemon and CLI) skips them, and POSTs them as one JSON list over a
+keep-alive session with connect/read timeouts. Every result carries an
+`idempotency_key` and the request an `Idempotency-Key` header, so a batch
+resent after a lost response can be deduplicated by the backend. Delivered
+rows are deleted; failed ones are retried with jittered exponential backoff
+until `max_attempts`, after which they are kept as dead for inspection.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("game-server-setup")
+
+# (connect, read) seconds
+TIMEOUT = (3.05, 10)
+# Seconds a sender owns the rows it is delivering
+LEASE = 60
+# HTTP statuses worth retrying; any other 4xx means the payload is rejected
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    dead INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (dead, next_attempt, id);
+"""
+
+
+class Outbox:
+    """SQLite-backed queue of result payloads with batched delivery"""
+
+    def __init__(
+        self,
+        db_path: str,
+        url: str,
+        batch_size: int = 100,
+        timeout: Tuple[float, float] = TIMEOUT,
+        base_backoff: float = 1.0,
+        max_backoff: float = 300.0,
+        max_attempts: int = 50,
+    ):
+        self.db_path = db_path
+        self.url = url
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.wakeup = threading.Event()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db = sqlite3.connect(
+            db_path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=2))
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=2))
+
+    def put(self, payload: Union[Dict, List[Dict]]) -> List[str]:
+        """Queue one payload or a list of them, returns their keys"""
+        payloads = payload if isinstance(payload, list) else [payload]
+        now = time.time()
+        rows = []
+        for item in payloads:
+            key = uuid.uuid4().hex
+            rows.append((key, json.dumps({**item, "idempotency_key": key}), now, now))
+        with self._lock:
+            self._db.executemany(
+                "INSERT INTO outbox (key, payload, created, next_attempt) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+        self.wakeup.set()
+        return [row[0] for row in rows]
+
+    def _claim(self) -> List[Tuple[int, str, str, int]]:
+        """Lease the next due batch"""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(
+                    "SELECT id, key, payload, attempts FROM outbox "
+                    "WHERE dead = 0 AND next_attempt <= ? ORDER BY id LIMIT ?",
+                    (now, self.batch_size),
+                ).fetchall()
+                self._db.executemany(
+                    "UPDATE outbox SET next_attempt = ? WHERE id = ?",
+                    [(now + LEASE, row[0]) for row in rows],
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return rows
+
+    def _post(self, rows) -> Tuple[bool, bool, str]:
+        """Send a batch; returns (delivered, retryable, error)"""
+        batch_key = hashlib.sha256(
+            "".join(row[1] for row in rows).encode()
+        ).hexdigest()
+        body = "[" + ",".join(row[2] for row in rows) + "]"
+        try:
+            response = self.session.post(
+                self.url,
+                data=body,
+                headers={
+                    "Content-Type": "application/json",
+                    "Idempotency-Key": batch_key,
+                },
+                timeout=self.timeout,
+            )
+        except requests.RequestException as e:
+            return False, True, str(e)
+        if response.ok:
+            return True, False, ""
+        error = f"HTTP {response.status_code}: {response.text[:200]}"
+        return False, response.status_code in RETRY_STATUSES, error
+
+    def send_due(self) -> Optional[int]:
+        """
+        Deliver one batch; rows handled, or None if the backend failed
+
+        A batch rejected as a whole is bisected until the rows at fault
+        are found, so only those are marked dead.
+        """
+        rows = self._claim()
+        if not rows:
+            return 0
+        delivered: List = []
+        rejected: List = []
+        retry: List = []
+        error = ""
+        batches = [rows]
+        while batches:
+            batch = batches.pop()
+            if retry:
+                # The backend is failing; leave the rest for the retry
+                retry.extend((row, error) for row in batch)
+                continue
+            ok, retryable, error = self._post(batch)
+            if ok:
+                delivered.extend(batch)
+            elif retryable:
+                retry.extend((row, error) for row in batch)
+            elif len(batch) == 1:
+                rejected.append((batch[0], error))
+            else:
+                middle = len(batch) // 2
+                batches += [batch[middle:], batch[:middle]]
+
+        if delivered:
+            ids = [row[0] for row in delivered]
+            with self._lock:
+                self._db.execute(
+                    f"DELETE FROM outbox WHERE id IN ({','.join('?' * len(ids))})",
+                    ids,
+                )
+
+        now = time.time()
+        updates = []
+        for failed, retryable in ((rejected, False), (retry, True)):
+            for (row_id, _, _, attempts), row_error in failed:
+                attempts += 1
+                delay = min(self.max_backoff, self.base_backoff * 2 ** attempts)
+                dead = int(not retryable or attempts >= self.max_attempts)
+                updates.append(
+                    (
+                        attempts,
+                        now + delay * random.uniform(0.5, 1),
+                        dead,
+                        row_error,
+                        row_id,
+                    )
+                )
+        if updates:
+            with self._lock:
+                self._db.executemany(
+                    "UPDATE outbox SET attempts = ?, next_attempt = ?, dead = ?, "
+                    "last_error = ? WHERE id = ?",
+                    updates,
+                )
+        for _, row_error in rejected:
+            logger.error(f"Result rejected by {self.url}: {row_error}")
+        if retry:
+            logger.warning(
+                f"Failed to report {len(retry)} results to {self.url}: {error}"
+            )
+            return None
+        return len(delivered) + len(rejected)
+
+    def flush(self, timeout: float) -> int:
+        """Deliver due rows until none are left, a send fails or time is up"""
+        deadline = time.monotonic() + timeout
+        sent = 0
+        while time.monotonic() < deadline:
+            count = self.send_due()
+            if not count:
+                break
+            sent += count
+        return sent
+
+    def next_due(self) -> Optional[float]:
+        """Epoch of the earliest pending retry, None when the queue is empty"""
+        with self._lock:
+            (due,) = self._db.execute(
+                "SELECT MIN(next_attempt) FROM outbox WHERE dead = 0"
+            ).fetchone()
+        return due
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            pending, dead = self._db.execute(
+                "SELECT COALESCE(SUM(dead = 0), 0), COALESCE(SUM(dead), 0) "
+                "FROM outbox"
+            ).fetchone()
+        return {"pending": pending, "dead": dead}
+
+
+class OutboxSender(threading.Thread):
+    """Background delivery of an Outbox, woken by every put()"""
+
+    def __init__(self, outbox: Outbox, idle: float = 30.0):
+        super().__init__(name="outbox-sender", daemon=True)
+        self.outbox = outbox
+        self.idle = idle
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+        self.outbox.wakeup.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.outbox.wakeup.clear()
+            try:
+                while self.outbox.send_due():
+                    if self._stop_event.is_set():
+                        return
+                due = self.outbox.next_due()
+            except sqlite3.Error as e:
+                logger.error(f"Outbox delivery failed: {e}")
+                due = None
+            wait = self.idle if due is None else min(self.idle, due - time.time())
+            self.outbox.wakeup.wait(max(wait, 0.05))
@@ -0,0 +1,191 @@
+"""
+Persistent, race-free host port allocation.
+
+Reservations live in a JSON file guarded by an fcntl lock, so concurrent
+`start` actions in separate processes can never hand out the same ports.
+Each allocation builds a bytearray bitmap of the port range from the stored
+reservations and the sockets currently bound on the host (/proc/net), then
+takes the first free run of the requested size.
+"""
+
+import json
+import logging
+import os
+import tempfile
+from typing import Dict, List, Optional
+
+from filelock import FileLock
+from portchecker import listening_ports
+
+logger = logging.getLogger("game-server-setup")
+
+
+class PortAllocationError(Exception):
+    """Raised when the range has no room for a reservation"""
+
+    pass
+
+
+class PortAllocator:
+    """Reserves host ports per subscription in a persistent store"""
+
+    def __init__(self, store_path: str, start: int = 2300, end: int = 8000):
+        self.store_path = store_path
+        self.start = start
+        self.end = end
+        self.lock = FileLock(store_path + ".lock")
+
+    def _load(self) -> Dict[str, List[int]]:
+        try:
+            with open(self.store_path) as f:
+                return json.load(f).get("reservations", {})
+        except FileNotFoundError:
+            return {}
+
+    def _save(self, reservations: Dict[str, List[int]]):
+        directory = os.path.dirname(os.path.abspath(self.store_path))
+        with tempfile.NamedTemporaryFile(
+            mode="w", delete=False, dir=directory, suffix=".tmp"
+        ) as tmp_file:
+            json.dump({"reservations": reservations}, tmp_file, indent=1)
+            tmp_path = tmp_file.name
+        os.replace(tmp_path, self.store_path)
+
+    def _bitmap(self, reservations: Dict[str, List[int]]) -> bytearray:
+        """1 for every port in range that is reserved or bound"""
+        bitmap = bytearray(self.end - self.start)
+        for ports in reservations.values():
+            for port in ports:
+                if self.start <= port < self.end:
+                    bitmap[port - self.start] = 1
+        for port in listening_ports():
+            if self.start <= port < self.end:
+                bitmap[port - self.start] = 1
+        return bitmap
+
+    def _find_free(
+        self, bitmap: bytearray, count: int, contiguous: bool
+    ) -> List[int]:
+        if contiguous:
+            idx = bitmap.find(bytes(count))
+            if idx < 0:
+                raise PortAllocationError(
+                    f"No block of {count} adjacent free ports in "
+                    f"{self.start}-{self.end}"
+                )
+            return [self.start + idx + i for i in range(count)]
+
+        ports = []
+        idx = bitmap.find(0)
+        while idx >= 0 and len(ports) < count:
+            ports.append(self.start + idx)
+            idx = bitmap.find(0, idx + 1)
+        if len(ports) < count:
+            raise PortAllocationError(
+                f"Only {len(ports)} free ports in {self.start}-{self.end}"
+            )
+        return ports
+
+    def reserve(
+        self, subscription_id: str, count: int, contiguous: bool = False
+    ) -> List[int]:
+        """Reserve count ports for a subscription, reusing its existing ones"""
+        with self.lock:
+            reservations = self._load()
+            existing = reservations.get(subscription_id)
+            if existing is not None and len(existing) == count:
+                return existing
+
+            reservations.pop(subscription_id, None)
+            ports = self._find_free(self._bitmap(reservations), count, contiguous)
+            reservations[subscription_id] = ports
+            self._save(reservations)
+        logger.info(f"Reserved ports {ports} for {subscription_id}")
+        return ports
+
+    def reserve_many(
+        self, requests: Dict[str, int], contiguous: bool = False
+    ) -> Dict[str, List[int]]:
+        """Reserve ports for several subscriptions under one lock"""
+        allocated = {}
+        with self.lock:
+            reservations = self._load()
+            bitmap = self._bitmap(reservations)
+            for subscription_id, count in requests.items():
+                existing = reservations.get(subscription_id)
+                if existing is not None and len(existing) == count:
+                    allocated[subscription_id] = existing
+                    continue
+                ports = self._find_free(bitmap, count, contiguous)
+                for port in ports:
+                    bitmap[port - self.start] = 1
+                reservations[subscription_id] = allocated[subscription_id] = ports
+            self._save(reservations)
+        return allocated
+
+    def adopt(self, subscription_id: str, ports: List[int]) -> List[int]:
+        """Reserve exactly these ports, unless another subscription holds one"""
+        with self.lock:
+            reservations = self._load()
+            existing = reservations.get(subscription_id)
+            if existing is not None:
+                return existing
+            for other, held in reservations.items():
+                clash = sorted(set(held) & set(ports))
+                if clash:
+                    raise PortAllocationError(
+                        f"Ports {clash} of {subscription_id} are reserved by {other}"
+                    )
+            reservations[subscription_id] = list(ports)
+            self._save(reservations)
+        logger.info(f"Adopted ports {ports} for {subscription_id}")
+        return list(ports)
+
+    def release(self, subscription_id: str) -> List[int]:
+        """Drop a subscription's reservation, returns the freed ports"""
+        with self.lock:
+            reservations = self._load()
+            ports = reservations.pop(subscription_id, [])
+            if ports:
+                self._save(reservations)
+        if ports:
+            logger.info(f"Released ports {ports} for {subscription_id}")
+        return ports
+
+    def reserved(self, subscription_id: str) -> Optional[List[int]]:
+        with self.lock:
+            return self._load().get(subscription_id)
+
+    def reservations(self) -> Dict[str, List[int]]:
+        with self.lock:
+            return self._load()
+
+    def reconcile(self, known: Dict[str, List[int]]) -> Dict[str, List]:
+        """Bring the store in line with the subscriptions that exist
+
+        known maps every existing subscription to the host ports found in its
+        compose file. Missing reservations are adopted, reservations of
+        subscriptions that no longer exist are released. Also returns the
+        subscriptions with none of their ports bound, i.e. servers that are down.
+        """
+        with self.lock:
+            reservations = self._load()
+            stale = [sub for sub in reservations if sub not in known]
+            for subscription_id in stale:
+                reservations.pop(subscription_id)
+            adopted = [sub for sub in known if sub not in reservations and known[sub]]
+            for subscription_id in adopted:
+                reservations[subscription_id] = known[subscription_id]
+            if stale or adopted:
+                self._save(reservations)
+            bound = listening_ports()
+            unbound = sorted(
+                sub
+                for sub, ports in reservations.items()
+                if not any(port in bound for port in ports)
+            )
+        if stale:
+            logger.info(f"Released stale port reservations for {stale}")
+        if adopted:
+            logger.info(f"Adopted port reservations for {adopted}")
+        return {"released": stale, "adopted": adopted, "unbound": unbound}
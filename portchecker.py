@@ -1,37 +1,41 @@
-import subprocess
-import re
-from typing import List
-
-
-def _run_cmd(cmd: str):
-    """Run a shell command and return (returncode, stdout, stderr)."""
-    process = subprocess.Popen(
-        args=cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, text=True
-    )
-    stdout, stderr = process.communicate()
-    return process.returncode, stdout, stderr
-
-
-def _get_used_ports(stdout: str) -> List[str]:
-    """Extract used port numbers from netstat output."""
-    used_ports = []
-    for line in stdout.splitlines():
-        match = re.search(r":(\d+)\s", line)
-        if match:
-            used_ports.append(match.group(1))
+from typing import List, Set
+
+PROC_NET_FILES = ("/proc/net/tcp", "/proc/net/tcp6", "/proc/net/udp", "/proc/net/udp6")
+
+# /proc/net/tcp state column for a listening socket
+TCP_LISTEN = "0A"
+
+
+def listening_ports() -> Set[int]:
+    """Ports bound by TCP listeners or UDP sockets, read from /proc/net."""
+    used_ports = set()
+    for path in PROC_NET_FILES:
+        is_tcp = "/tcp" in path
+        try:
+            with open(path) as f:
+                next(f, None)  # header
+                for line in f:
+                    fields = line.split()
+                    if len(fields) < 4:
+                        continue
+                    if is_tcp and fields[3] != TCP_LISTEN:
+                        continue
+                    # local_address is "<hex ip>:<hex port>"
+                    used_ports.add(int(fields[1].rsplit(":", 1)[1], 16))
+        except FileNotFoundError:
+            # e.g. IPv6 disabled
+            continue
     return used_ports
 
 
 def get_available_ports(start: int = 2300, end: int = 8000, n=5) -> List[int]:
     """Return a list of available ports in the given range."""
+    used_ports = listening_ports()
     available_ports = []
-    returncode, stdout, stderr = _run_cmd("ss -tuln")
-    if returncode != 0:
-        return available_ports
-
-    used_ports = _get_used_ports(stdout)
     for port in range(start, end):
-        if str(port) not in used_ports:
+        if port not in used_ports:
             available_ports.append(port)
+            if len(available_ports) == n:
+                break
 
-    return available_ports[:n]
+    return available_ports
@@ -0,0 +1,301 @@
+"""
+Redis queue worker for provisioning jobs.
+
+Consumes the badger:* queues that the web dashboard inspects and runs each job
+through setup_server.handle() on one shared GameServerManager, so a burst of
+jobs drains in parallel instead of one CLI process at a time.
+
+Keys per queue <name>:
+    badger:pending:<name>   list of job payloads, consumed from the right
+    badger:processing:<name>:<worker>
+                            list of the payloads a worker has taken
+    badger:running:<name>   hash of job payload -> run metadata
+    badger:done:<name>      list of "<job_id>:<job payload>"
+    badger:failed:<name>    list of "<job_id>:<job payload>"
+    badger:joblog           hash of job_id -> captured log output
+
+A job payload is the same JSON request the manager daemon accepts.
+
+Jobs are popped with BRPOPLPUSH into the worker's processing list and
+removed from it only in the transaction that files them under done or
+failed, so a job is never lost to a crash or a Redis outage. A worker
+started under the same name (the host name by default) puts the jobs its
+predecessor left behind back on the pending queue; they run at least once.
+Redis errors during a job's bookkeeping are retried.
+
+Jobs acting on a server's container (CONTAINER_ACTIONS) are forwarded to the
+manager daemon while it runs: it holds the wake sockets of hibernated
+servers, which must be released before their containers start.
+"""
+
+import argparse
+import json
+import logging
+import socket
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+
+import redis
+
+import managerd
+import outbox
+import setup_server
+
+logger = logging.getLogger("game-server-setup")
+
+JOBLOG_KEY = "badger:joblog"
+
+# Run by the manager daemon when it is up, see the module docstring
+CONTAINER_ACTIONS = ["start", "stop", "restart", "restore", "bulk-start"]
+
+
+class _ThreadLogCapture(logging.Handler):
+    """Collects log records emitted by a single thread"""
+
+    def __init__(self, thread_id: int):
+        super().__init__()
+        self.thread_id = thread_id
+        self.lines: List[str] = []
+        self.setFormatter(
+            logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        )
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.thread == self.thread_id
+
+    def emit(self, record: logging.LogRecord):
+        self.lines.append(self.format(record))
+
+
+class QueueWorker:
+    """Runs jobs from several badger queues with a concurrency limit per queue"""
+
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        queues: Dict[str, int],
+        keep_done: int = 1000,
+        poll_timeout: int = 5,
+        sftp_batch_window: float = 30,
+        worker_name: Optional[str] = None,
+    ):
+        self.redis = redis_client
+        self.queues = queues
+        self.keep_done = keep_done
+        self.poll_timeout = poll_timeout
+        # Stable across restarts so a worker recovers its own processing lists
+        self.worker_name = worker_name or socket.gethostname()
+        self.manager = setup_server.GameServerManager()
+        if sftp_batch_window:
+            self.manager.enable_sftp_batching(sftp_batch_window)
+        # Delivers the results report() queues in the manager's outbox
+        self.outbox_sender = outbox.OutboxSender(self.manager.outbox)
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self):
+        """Start `concurrency` consumer threads for every queue"""
+        self.outbox_sender.start()
+        for queue_name in self.queues:
+            self.recover(queue_name)
+        for queue_name, concurrency in self.queues.items():
+            for i in range(concurrency):
+                t = threading.Thread(
+                    target=self._consume,
+                    args=(queue_name,),
+                    name=f"worker-{queue_name}-{i}",
+                    daemon=True,
+                )
+                t.start()
+                self._threads.append(t)
+            logger.info(f"Consuming {queue_name} with concurrency {concurrency}")
+
+    def stop(self):
+        """Stop taking new jobs and wait for running ones to finish"""
+        self._stop.set()
+        for t in self._threads:
+            t.join()
+        self.manager.disable_sftp_batching()
+        if self.manager.offloads is not None:
+            self.manager.offloads.stop()
+        self.outbox_sender.stop()
+        self.outbox_sender.join()
+        self.manager.outbox.flush(setup_server.CLI_FLUSH_TIMEOUT)
+
+    def processing_key(self, queue_name: str) -> str:
+        return f"badger:processing:{queue_name}:{self.worker_name}"
+
+    def recover(self, queue_name: str) -> int:
+        """Requeue jobs a previous run of this worker took but never filed"""
+        pending = f"badger:pending:{queue_name}"
+        processing = self.processing_key(queue_name)
+        running = f"badger:running:{queue_name}"
+        recovered = 0
+        while True:
+            job = self._retry(
+                "requeue", lambda: self.redis.rpoplpush(processing, pending)
+            )
+            if job is None:
+                break
+            self._retry("requeue", lambda: self.redis.hdel(running, job))
+            recovered += 1
+        if recovered:
+            logger.warning(f"Requeued {recovered} unfinished jobs of {queue_name}")
+        return recovered
+
+    def _retry(self, what: str, operation: Callable, attempts: int = 10):
+        """Run a Redis operation, retrying connection blips with backoff"""
+        delay = 0.5
+        for attempt in range(attempts):
+            try:
+                return operation()
+            except redis.RedisError as e:
+                if attempt == attempts - 1:
+                    raise
+                logger.warning(f"Redis {what} failed, retrying: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, self.poll_timeout)
+
+    def _consume(self, queue_name: str):
+        pending = f"badger:pending:{queue_name}"
+        processing = self.processing_key(queue_name)
+        while not self._stop.is_set():
+            try:
+                job = self.redis.brpoplpush(
+                    pending, processing, timeout=self.poll_timeout
+                )
+            except redis.RedisError as e:
+                logger.error(f"Failed to pop from {pending}: {e}")
+                self._stop.wait(self.poll_timeout)
+                continue
+            if job is None:
+                continue
+            try:
+                self.run_job(
+                    queue_name, job.decode() if isinstance(job, bytes) else job
+                )
+            except redis.RedisError as e:
+                # Still in the processing list, requeued on the next start
+                logger.error(f"Failed to file job from {pending}: {e}")
+
+    def run_job(self, queue_name: str, job: str) -> bool:
+        """Run one job payload and file it under done or failed"""
+        job_id = uuid.uuid4().hex
+        running = f"badger:running:{queue_name}"
+        metadata = json.dumps(
+            {
+                "id": job_id,
+                "worker": self.worker_name,
+                "started_at": datetime.now(timezone.utc).isoformat(),
+            }
+        )
+        try:
+            self._retry("bookkeeping", lambda: self.redis.hset(running, job, metadata))
+        except redis.RedisError as e:
+            # Only the dashboard's running view misses it
+            logger.error(f"Failed to mark job {job_id} running: {e}")
+
+        capture = _ThreadLogCapture(threading.get_ident())
+        logger.addHandler(capture)
+        ok = False
+        try:
+            argv = managerd.request_to_argv(json.loads(job))
+            response = None
+            if argv[:1] and argv[0] in CONTAINER_ACTIONS:
+                response = managerd.forward(argv)
+            if response is not None:
+                logger.info(f"Job {job_id} ran by the manager daemon")
+                if not response.get("ok"):
+                    logger.error(f"Job {job_id} failed: {response.get('error')}")
+                payload = response.get("result")
+                payloads = payload if isinstance(payload, list) else [payload]
+                ok = bool(response.get("ok")) and all(
+                    p is not None and p.get("status") != "failed" for p in payloads
+                )
+            else:
+                result = setup_server.handle(self.manager, argv)
+                results = result if isinstance(result, list) else [result]
+                ok = result is not None and all(r.status != "failed" for r in results)
+        except SystemExit:
+            logger.error(f"Invalid job arguments: {job}")
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+        finally:
+            logger.removeHandler(capture)
+
+        target = f"badger:{'done' if ok else 'failed'}:{queue_name}"
+
+        def file_job():
+            pipe = self.redis.pipeline()
+            pipe.hdel(running, job)
+            pipe.lpush(target, f"{job_id}:{job}")
+            if ok and self.keep_done:
+                pipe.ltrim(target, 0, self.keep_done - 1)
+            pipe.hset(JOBLOG_KEY, job_id, "\n".join(capture.lines))
+            pipe.lrem(self.processing_key(queue_name), 1, job)
+            pipe.execute()
+
+        self._retry("bookkeeping", file_job)
+        return ok
+
+
+def parse_queue(spec: str):
+    """Parse a "name=concurrency" queue spec"""
+    name, _, concurrency = spec.partition("=")
+    if not name:
+        raise argparse.ArgumentTypeError(f"Invalid queue spec: {spec}")
+    try:
+        return name, int(concurrency or 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid concurrency in: {spec}")
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser("Game server queue worker")
+    parser.add_argument(
+        "--redis-url", default="redis://127.0.0.1:6379/0", help="Redis URL"
+    )
+    parser.add_argument(
+        "-q",
+        "--queue",
+        type=parse_queue,
+        action="append",
+        required=True,
+        help="Queue to consume as name=concurrency (repeatable)",
+    )
+    parser.add_argument(
+        "--keep-done", type=int, default=1000, help="Done jobs to keep per queue"
+    )
+    parser.add_argument(
+        "--worker-name",
+        help="Name owning this worker's processing lists (default: host name)",
+    )
+    parser.add_argument(
+        "--sftp-batch-window",
+        type=float,
+        default=30,
+        help="Seconds between batched SFTP restarts (0 applies each change)",
+    )
+    args = parser.parse_args(argv)
+
+    worker = QueueWorker(
+        redis.Redis.from_url(args.redis_url),
+        dict(args.queue),
+        keep_done=args.keep_done,
+        sftp_batch_window=args.sftp_batch_window,
+        worker_name=args.worker_name,
+    )
+    worker.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        logger.info("Waiting for running jobs to finish")
+        worker.stop()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,18 +1,46 @@
 import os
-import logging
-import pathlib
-import shutil
 import sys
+
+if __name__ == "__main__":
+    # Hand the action to a running manager daemon before paying for the
+    # imports and set-up below; main() runs it in-process otherwise
+    import json
+    import managerd
+
+    _response = managerd.forward(sys.argv[1:])
+    if _response is not None:
+        print(json.dumps(_response))
+        sys.exit(0 if _response.get("ok") else 1)
+
+import logging
 import argparse
+import base64
+import hashlib
+import json
 import subprocess
-import tempfile
-from typing import List, Tuple, Optional, Dict
-import requests
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple, Optional, Dict, Set, Union
+import sqlite3
+import yaml
 import datetime
+import glob
 
+import a2s
+import archiver
+import dockerapi
 import gregistry
+import managerd
+from backupstore import BACKUP_ROOT, BackupError, BackupStore
+from cgroupmetrics import CgroupMetricsCollector
 from customdataclasses import ServerResult, GameConfig
+from dockerapi import DockerAPIError
+from offload import OffloadError, Offloader, OffloadQueue
+from outbox import Outbox
+from portallocator import PortAllocationError, PortAllocator
 from sftpmanager import SFTPManager
+from snapshot import SKIP_PATTERNS, SnapshotError, Snapshotter
+from stateindex import StateIndex
 
 HOST_API = "http://127.0.0.1:8000/api/server_report"
 base_path = os.path.expanduser("~/servermgmnt")
@@ -20,6 +48,15 @@ log_path = os.path.join(base_path, "logs")
 docker_game_template_path = os.path.join(base_path, "docker-game-templates")
 subscription_path = os.path.join(base_path, "subscription-docker-compose")
 game_configs_path = os.path.join(base_path, "game-configs")
+# Same filesystem as the server dirs so snapshots can reflink or hardlink
+SNAPSHOT_ROOT = "/srv/allservers/.snapshots"
+# Per-subscription state, see stateindex.py
+STATE_DB_PATH = os.path.join(base_path, "state.sqlite")
+# Results waiting for delivery to HOST_API
+OUTBOX_PATH = os.path.join(base_path, "outbox.sqlite")
+# Seconds a CLI run spends delivering its results before exiting; the rest
+# goes out with the daemon or the next run
+CLI_FLUSH_TIMEOUT = 5.0
 
 
 # Create directories
@@ -42,12 +79,238 @@ logging.basicConfig(
 
 logger = logging.getLogger("game-server-setup")
 
+# Seconds between progress reports of long-running actions
+PROGRESS_INTERVAL = 2.0
+
+# Seconds a start waits for the server to answer A2S queries, 0 skips it
+READY_TIMEOUT = float(os.environ.get("SERVERMGMNT_READY_TIMEOUT", "300"))
+
+# Simultaneous `docker compose up` runs of a bulk start
+BULK_MAX_STARTS = 8
+
+# Actions that operate on the whole fleet rather than one subscription
+FLEET_ACTIONS = ["status-all", "list", "sftp-flush", "sftp-migrate", "bulk-start"]
+
 
 class GameServerManager:
     """Main game server management class"""
 
     def __init__(self):
         self.registry = gregistry.GameRegistry()
+        # One client so every action reuses its pool of kept-alive connections
+        self.docker = dockerapi.DockerClient.from_socket()
+        self.cgroup_metrics = (
+            CgroupMetricsCollector() if CgroupMetricsCollector.available() else None
+        )
+        self._sftp_manager = SFTPManager(docker=self.docker)
+        self.sftp_batch_window: Optional[float] = None
+        self.snapshotter = Snapshotter()
+        self.backup_store = BackupStore(
+            os.environ.get("SERVERMGMNT_BACKUP_ROOT", BACKUP_ROOT)
+        )
+        self.port_allocator = PortAllocator(
+            os.path.join(base_path, "port-reservations.json")
+        )
+        self.outbox = Outbox(OUTBOX_PATH, HOST_API)
+        self.state = StateIndex(STATE_DB_PATH)
+        # Set by the daemon to a DockerEventWatcher keeping a live cache
+        self.events = None
+        # Set by the daemon to a Hibernator holding idle servers' ports
+        self.hibernator = None
+        # None unless SERVERMGMNT_S3_BUCKET is set
+        self.offloader = Offloader.from_env(
+            os.path.join(base_path, "offload-state.json")
+        )
+        self.offloads = (
+            OffloadQueue(self._offload) if self.offloader is not None else None
+        )
+
+    def report(self, result: Union[ServerResult, List[ServerResult]]):
+        """Queue a result for delivery to HOST_API"""
+        payload = result_payload(result)
+        logger.info(payload)
+        try:
+            self.outbox.put(payload)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to queue result for the API: {e}")
+
+    @staticmethod
+    def compose_path(subscription_id: str, game_type: Optional[str]) -> str:
+        return os.path.join(
+            subscription_path,
+            f"docker-compose-{game_type}-{subscription_id}.yml",
+        )
+
+    def env_path(self, subscription_id: str, game_type: str) -> str:
+        handler = self.registry.get_handler(game_type)
+        return os.path.join(
+            subscription_path, handler.get_env_file_format(subscription_id)
+        )
+
+    @staticmethod
+    def file_hash(path: str) -> Optional[str]:
+        try:
+            with open(path, "rb") as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            return None
+
+    def resolve_game_type(self, subscription_id: str) -> Optional[str]:
+        """Game type of an existing subscription, from the index or its file"""
+        entry = self.state.get(subscription_id)
+        if entry is not None and entry["game_type"]:
+            return entry["game_type"]
+        for game_type, sub, _ in self._scan_compose_files():
+            if sub == subscription_id:
+                return game_type
+        return None
+
+    def record(
+        self,
+        result: ServerResult,
+        game_type: Optional[str] = None,
+        **limits,
+    ):
+        """Update the state index from the result of an action"""
+        fields: Dict = {}
+        compose_file = None
+        if game_type:
+            compose_file = self.compose_path(result.subscription_id, game_type)
+            fields.update(game_type=game_type, compose_file=compose_file)
+
+        action, status = result.action, result.status
+        if action in ("start", "restore") and status in (
+            "running",
+            "starting",
+            "completed",
+        ):
+            fields.update(
+                status="starting" if status == "starting" else "running",
+                container_id=result.container_id,
+                container_ip=result.container_ip,
+                **{k: v for k, v in limits.items() if v is not None},
+            )
+            if result.ports:
+                fields["ports"] = result.ports
+            if compose_file:
+                fields["compose_hash"] = self.file_hash(compose_file)
+                fields["env_hash"] = self.file_hash(
+                    self.env_path(result.subscription_id, game_type)
+                )
+        elif action == "stop" and status == "stopped":
+            fields.update(
+                status="stopped", container_id=None, container_ip=None, ports=None
+            )
+        elif action in ("start", "restore") and status == "failed":
+            fields["status"] = "failed"
+        elif action == "status" and status != "not_found":
+            fields.update(status=status, container_id=result.container_id)
+        elif action == "backup" and status == "completed":
+            metrics = result.metrics or {}
+            fields.update(
+                last_backup=time.time(),
+                last_backup_id=metrics.get("id") or metrics.get("backup_file"),
+            )
+        else:
+            return
+        try:
+            self.state.update(result.subscription_id, **fields)
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to index {action} of {result.subscription_id}: {e}")
+
+    def query_targets(
+        self, servers: Dict[str, Tuple[Optional[str], Optional[List[int]]]]
+    ) -> Dict[str, Tuple[str, int]]:
+        """A2S query address of every (game type, ports) that has one"""
+        targets = {}
+        for subscription_id, (game_type, ports) in servers.items():
+            if not game_type or not ports:
+                continue
+            index = self.registry.get_handler(game_type).query_port_index
+            if index is not None and index < len(ports):
+                targets[subscription_id] = ("127.0.0.1", ports[index])
+        return targets
+
+    def await_ready(
+        self,
+        started: Dict[str, Tuple[ServerResult, str]],
+        timeout: float = READY_TIMEOUT,
+    ):
+        """
+        Wait until freshly started servers answer A2S queries
+
+        All servers are probed concurrently from one event loop. Readiness,
+        time to ready (from the end of `compose up`) and player counts are
+        added to each result's metrics; a running server that never answers
+        is reported as "starting".
+        """
+        if timeout <= 0:
+            return
+        targets = self.query_targets(
+            {sub: (game_type, r.ports) for sub, (r, game_type) in started.items()}
+        )
+        for subscription_id, probe in a2s.probe_many(targets, timeout).items():
+            result = started[subscription_id][0]
+            result.metrics = {**(result.metrics or {}), **probe}
+            if not probe["ready"] and result.status == "running":
+                logger.warning(f"{subscription_id} not answering after {timeout}s")
+                result.status = "starting"
+                result.error = f"Server not answering queries after {timeout:.0f}s"
+
+    def player_counts(self, subscription_ids: List[str]) -> Dict[str, int]:
+        """Current player count of every listed server answering A2S"""
+        servers = {}
+        for subscription_id in subscription_ids:
+            entry = self.state.get(subscription_id)
+            if entry is not None:
+                servers[subscription_id] = (entry["game_type"], entry["ports"])
+        return a2s.player_counts(self.query_targets(servers))
+
+    def reconcile_state(self) -> Dict[str, List[str]]:
+        """Rebuild the state index from the compose files and Docker"""
+        containers = self.project_containers()
+        observed = {}
+        for game_type, subscription_id, compose_file in self._scan_compose_files():
+            container_id, status = containers.get(subscription_id, (None, "stopped"))
+            fields = {
+                "game_type": game_type,
+                "compose_file": compose_file,
+                "compose_hash": self.file_hash(compose_file),
+                "env_hash": self.file_hash(self.env_path(subscription_id, game_type)),
+                "container_id": container_id,
+                "status": status,
+                "ports": self.port_allocator.reserved(subscription_id),
+            }
+            if status != "running":
+                fields["container_ip"] = None
+            observed[subscription_id] = fields
+        return self.state.reconcile(observed)
+
+    def list_servers(self, game_type: Optional[str] = None) -> List[ServerResult]:
+        """Every subscription as last recorded, without asking Docker"""
+        if self.state.reconciled_at() is None:
+            self.reconcile_state()
+        details = (
+            "game_type",
+            "memory",
+            "cpu",
+            "compose_file",
+            "last_backup",
+            "last_backup_id",
+            "updated",
+        )
+        return [
+            ServerResult(
+                action="list",
+                subscription_id=entry["subscription_id"],
+                status=entry["status"] or "unknown",
+                container_id=entry["container_id"],
+                container_ip=entry["container_ip"],
+                ports=entry["ports"],
+                metrics={key: entry[key] for key in details},
+            )
+            for entry in self.state.list(game_type)
+        ]
 
     @staticmethod
     def run_command(cmd: str) -> Tuple[int, str, str]:
@@ -120,6 +383,7 @@ class GameServerManager:
     ) -> ServerResult:
         """Start game server using docker compose"""
         logger.info(f"Starting server for {subscription_id}")
+        self._release_hibernation(subscription_id)
 
         # Start containers
         start_cmd = f"docker compose -f {compose_file} -p {subscription_id} up -d"
@@ -132,31 +396,37 @@ class GameServerManager:
                 error=f"Failed to start server: {stderr}",
             )
 
-        # Get container ID
-        container_cmd = f"docker compose -f {compose_file} -p {subscription_id} ps -q"
-        return_code, stdout, stderr = self.run_command(container_cmd)
-        if return_code != 0:
-            return ServerResult(
-                action="start",
-                subscription_id=subscription_id,
-                status="failed",
-                error=f"Failed to get container id: {stderr}",
+        # Get container ID and IP in one API round trip when possible
+        container = self._find_project_container(subscription_id)
+        if container is not None:
+            container_id = container["Id"]
+            container_ip = dockerapi.container_ip(container)
+        else:
+            container_cmd = (
+                f"docker compose -f {compose_file} -p {subscription_id} ps -q"
             )
+            return_code, stdout, stderr = self.run_command(container_cmd)
+            if return_code != 0:
+                return ServerResult(
+                    action="start",
+                    subscription_id=subscription_id,
+                    status="failed",
+                    error=f"Failed to get container id: {stderr}",
+                )
 
-        container_id = stdout.strip()
+            container_id = stdout.strip()
 
-        # Get container IP
-        ip_cmd = f"docker inspect -f '{{{{range.NetworkSettings.Networks}}}}{{{{.IPAddress}}}}{{{{end}}}}' {container_id}"
-        return_code, stdout, stderr = self.run_command(ip_cmd)
-        if return_code != 0:
-            return ServerResult(
-                action="start",
-                subscription_id=subscription_id,
-                status="failed",
-                error=f"Failed to get container ip: {stderr}",
-            )
+            ip_cmd = f"docker inspect -f '{{{{range.NetworkSettings.Networks}}}}{{{{.IPAddress}}}}{{{{end}}}}' {container_id}"
+            return_code, stdout, stderr = self.run_command(ip_cmd)
+            if return_code != 0:
+                return ServerResult(
+                    action="start",
+                    subscription_id=subscription_id,
+                    status="failed",
+                    error=f"Failed to get container ip: {stderr}",
+                )
 
-        container_ip = stdout.strip()
+            container_ip = stdout.strip()
 
         return ServerResult(
             action="start",
@@ -167,12 +437,173 @@ class GameServerManager:
             ports=ports,
         )
 
-    def stop_server(self, subscription_id: str, game_type: str) -> ServerResult:
+    def bulk_start(
+        self, entries: List[Dict], max_starts: int = BULK_MAX_STARTS
+    ) -> List[ServerResult]:
+        """
+        Provision and start many servers at once
+
+        Ports for every server are reserved under one lock and SFTP users are
+        added as one batch with a single flush. Compose and config files are
+        rendered on a thread pool, and at most max_starts `compose up` run at
+        the same time.
+
+        Args:
+            entries: Manifest entries with subscription_id and game_type, and
+                optionally memory, cpu and config (a mapping, or base64 JSON
+                as taken by updateConfig)
+            max_starts: Cap on simultaneous `docker compose up`
+
+        Returns:
+            List[ServerResult]: One start result per entry, in manifest order
+        """
+        results: List[Optional[ServerResult]] = [None] * len(entries)
+        supported = self.registry.get_supported_games()
+
+        def failed(subscription_id: str, error: str) -> ServerResult:
+            logger.error(f"Bulk start of {subscription_id} failed: {error}")
+            return ServerResult(
+                action="start",
+                subscription_id=subscription_id,
+                status="failed",
+                error=error,
+            )
+
+        pending: Dict[str, Dict] = {}
+        index: Dict[str, int] = {}
+        for i, entry in enumerate(entries):
+            subscription_id = entry.get("subscription_id") or ""
+            if not subscription_id or entry.get("game_type") not in supported:
+                results[i] = failed(subscription_id, f"Invalid manifest entry: {entry}")
+            elif subscription_id in pending:
+                results[i] = failed(subscription_id, "Duplicate subscription")
+            else:
+                pending[subscription_id] = entry
+                index[subscription_id] = i
+
+        # Ports: one reservation transaction per contiguity requirement.
+        # Only reservations made here are released again on failure
+        existing = self.port_allocator.reservations()
+        fresh = {sub for sub in pending if sub not in existing}
+        by_mode: Dict[bool, Dict[str, int]] = {True: {}, False: {}}
+        for subscription_id, entry in pending.items():
+            handler = self.registry.get_handler(entry["game_type"])
+            by_mode[handler.contiguous_ports][subscription_id] = handler.port_count
+        ports: Dict[str, List[int]] = {}
+        for contiguous, counts in by_mode.items():
+            if not counts:
+                continue
+            try:
+                ports.update(self.port_allocator.reserve_many(counts, contiguous))
+            except PortAllocationError as e:
+                for subscription_id in counts:
+                    results[index[subscription_id]] = failed(subscription_id, str(e))
+        pending = {sub: entry for sub, entry in pending.items() if sub in ports}
+
+        def prepare(subscription_id: str) -> str:
+            entry = pending[subscription_id]
+            compose_file = self.create_compose_file(
+                subscription_id,
+                ports[subscription_id],
+                entry.get("memory", "2g"),
+                entry.get("cpu", 2.0),
+                entry["game_type"],
+            )
+            config = entry.get("config")
+            if config:
+                if not isinstance(config, str):
+                    config = base64.b64encode(json.dumps(config).encode()).decode()
+                configured = self.update_config(
+                    subscription_id, entry["game_type"], config
+                )
+                if configured.status == "failed":
+                    raise RuntimeError(configured.error)
+            return compose_file
+
+        compose_files: Dict[str, str] = {}
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(32, len(pending))), thread_name_prefix="bulk"
+        ) as pool:
+            futures = {sub: pool.submit(prepare, sub) for sub in pending}
+            for subscription_id, future in futures.items():
+                try:
+                    compose_files[subscription_id] = future.result()
+                except Exception as e:
+                    if subscription_id in fresh:
+                        self.port_allocator.release(subscription_id)
+                    results[index[subscription_id]] = failed(subscription_id, str(e))
+
+        # SFTP users: queue all, apply once while the servers start
+        credentials: Dict[str, Dict] = {}
+        for subscription_id in compose_files:
+            queued = self._sftp_manager.queue_user_volume(
+                pending[subscription_id]["game_type"], subscription_id
+            )
+            if queued.metrics:
+                credentials[subscription_id] = queued.metrics
+            elif queued.status == "failed":
+                logger.error(
+                    f"Failed to queue SFTP user for {subscription_id}: {queued.error}"
+                )
+
+        with ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="bulk-sftp"
+        ) as sftp_pool, ThreadPoolExecutor(
+            max_workers=max(1, min(max_starts, len(compose_files))),
+            thread_name_prefix="bulk-start",
+        ) as pool:
+            flush = sftp_pool.submit(self._sftp_manager.flush_pending)
+            starts = {
+                sub: pool.submit(self.start_server, compose_file, sub, ports[sub])
+                for sub, compose_file in compose_files.items()
+            }
+            for subscription_id, future in starts.items():
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = failed(subscription_id, str(e))
+                if result.status == "failed":
+                    if subscription_id in fresh:
+                        self.port_allocator.release(subscription_id)
+                elif subscription_id in credentials:
+                    result.metrics = credentials[subscription_id]
+                results[index[subscription_id]] = result
+            try:
+                flushed = flush.result()
+                if flushed.status == "failed":
+                    logger.error(f"SFTP flush of bulk start failed: {flushed.error}")
+            except Exception as e:
+                logger.error(f"SFTP flush of bulk start failed: {e}")
+
+        started = {
+            sub: (results[index[sub]], pending[sub]["game_type"])
+            for sub in compose_files
+            if results[index[sub]].status == "running"
+        }
+        self.await_ready(started)
+        for subscription_id in compose_files:
+            entry = pending[subscription_id]
+            self.record(
+                results[index[subscription_id]],
+                entry["game_type"],
+                memory=entry.get("memory", "2g"),
+                cpu=entry.get("cpu", 2.0),
+            )
+
+        return [result for result in results if result is not None]
+
+    def _release_hibernation(self, subscription_id: str):
+        """Free a hibernated server's ports before acting on its container"""
+        if self.hibernator is not None:
+            self.hibernator.release(subscription_id)
+
+    def stop_server(
+        self, subscription_id: str, game_type: Optional[str] = None
+    ) -> ServerResult:
         """Stop game server"""
-        compose_file = os.path.join(
-            subscription_path,
-            f"docker-compose-{game_type}-{subscription_id}.yml",
-        )
+        game_type = game_type or self.resolve_game_type(subscription_id)
+        compose_file = self.compose_path(subscription_id, game_type)
+        self._release_hibernation(subscription_id)
 
         if not os.path.exists(compose_file):
             return ServerResult(
@@ -198,18 +629,27 @@ class GameServerManager:
             status="stopped",
         )
 
-    def restart_server(self, subscription_id: str, game_type: str) -> ServerResult:
-        """Restart game server"""
-        # Stop the server first
-        stop_result = self.stop_server(subscription_id, game_type)
-        if stop_result.status != "stopped":
-            return stop_result
-
-        # Check if compose file exists
-        compose_file = os.path.join(
-            subscription_path,
-            f"docker-compose-{game_type}-{subscription_id}.yml",
-        )
+    def restart_server(
+        self,
+        subscription_id: str,
+        game_type: Optional[str] = None,
+        force: bool = False,
+    ) -> ServerResult:
+        """
+        Restart game server, doing only as much as its changes need
+
+        The compose and env files are hashed and compared with the hashes
+        recorded when the server last started:
+            compose changed     down + up, the container is rebuilt
+            env changed         `compose up -d`, which recreates the container
+                                with the new environment and keeps the network
+            nothing changed     no-op while the container runs; with force,
+                                or when it is stopped, an in-place restart of
+                                the existing container
+        The mode taken is returned as metrics["restart"].
+        """
+        game_type = game_type or self.resolve_game_type(subscription_id)
+        compose_file = self.compose_path(subscription_id, game_type)
         if not os.path.exists(compose_file):
             return ServerResult(
                 action="restart",
@@ -218,16 +658,88 @@ class GameServerManager:
                 error="Server configuration not found",
             )
 
-        # Start the server again
-        return self.start_server(compose_file, subscription_id, None)
+        self._release_hibernation(subscription_id)
+        try:
+            ports = self.ensure_ports(subscription_id, game_type)
+        except PortAllocationError as e:
+            return ServerResult(
+                action="restart",
+                subscription_id=subscription_id,
+                status="failed",
+                error=str(e),
+            )
+        entry = self.state.get(subscription_id) or {}
+        compose_hash = self.file_hash(compose_file)
+        env_hash = self.file_hash(self.env_path(subscription_id, game_type))
+        container_id, state = self.project_containers().get(
+            subscription_id, (None, None)
+        )
 
-    def server_status(self, subscription_id: str, game_type: str) -> ServerResult:
-        """Get server status and metrics"""
-        compose_file = os.path.join(
-            subscription_path,
-            f"docker-compose-{game_type}-{subscription_id}.yml",
+        if container_id is None or compose_hash != entry.get("compose_hash"):
+            mode = "recreate"
+            stop_result = self.stop_server(subscription_id, game_type)
+            if stop_result.status != "stopped":
+                return stop_result
+            result = self.start_server(compose_file, subscription_id, ports)
+        elif env_hash != entry.get("env_hash"):
+            mode = "update"
+            result = self.start_server(compose_file, subscription_id, ports)
+        elif state == "running" and not force:
+            mode = "skipped"
+            result = ServerResult(
+                action="start",
+                subscription_id=subscription_id,
+                status="running",
+                container_id=container_id,
+                container_ip=entry.get("container_ip"),
+                ports=ports,
+            )
+        else:
+            mode = "in_place"
+            result = self._restart_container(subscription_id, container_id, ports)
+
+        logger.info(f"Restart of {subscription_id}: {mode}")
+        result.metrics = {**(result.metrics or {}), "restart": mode}
+        return result
+
+    def _restart_container(
+        self, subscription_id: str, container_id: str, ports: Optional[List[int]]
+    ) -> ServerResult:
+        """Restart the existing container without recreating it"""
+        container_ip = None
+        try:
+            if self.docker is None:
+                raise DockerAPIError("Docker API unavailable")
+            self.docker.restart_container(container_id)
+            inspect = self.docker.inspect_container(container_id)
+            container_ip = dockerapi.container_ip(inspect)
+        except DockerAPIError as e:
+            logger.warning(f"Docker API restart failed, using CLI: {e}")
+            return_code, _, stderr = self.run_command(f"docker restart {container_id}")
+            if return_code != 0:
+                return ServerResult(
+                    action="start",
+                    subscription_id=subscription_id,
+                    status="failed",
+                    error=f"Failed to restart server: {stderr}",
+                )
+        return ServerResult(
+            action="start",
+            subscription_id=subscription_id,
+            status="running",
+            container_id=container_id,
+            container_ip=container_ip,
+            ports=ports,
         )
 
+    def server_status(
+        self, subscription_id: str, game_type: Optional[str] = None
+    ) -> ServerResult:
+        """Get server status and metrics"""
+        entry = self.state.get(subscription_id)
+        game_type = game_type or (entry or {}).get("game_type")
+        compose_file = self.compose_path(subscription_id, game_type)
+
         if not os.path.exists(compose_file):
             return ServerResult(
                 action="status",
@@ -236,10 +748,20 @@ class GameServerManager:
                 error="Server not found",
             )
 
-        # Get container ID
-        id_cmd = f"docker compose -f {compose_file} -p {subscription_id} ps -q"
-        _, container_id, _ = self.run_command(id_cmd)
-        container_id = container_id.strip()
+        if self.docker is not None:
+            try:
+                status, container_id, metrics = self._api_status(
+                    subscription_id, (entry or {}).get("container_id")
+                )
+            except DockerAPIError as e:
+                logger.warning(f"Docker API status failed, using CLI: {e}")
+                status, container_id, metrics = self._cli_status(
+                    compose_file, subscription_id
+                )
+        else:
+            status, container_id, metrics = self._cli_status(
+                compose_file, subscription_id
+            )
 
         if not container_id:
             return ServerResult(
@@ -249,6 +771,70 @@ class GameServerManager:
                 metrics={},
             )
 
+        return ServerResult(
+            action="status",
+            subscription_id=subscription_id,
+            status=status,
+            container_id=container_id if container_id else None,
+            metrics=metrics,
+        )
+
+    def _find_project_container(self, subscription_id: str) -> Optional[Dict]:
+        """Container summary for a compose project via the Engine API"""
+        if self.docker is None:
+            return None
+        try:
+            containers = self.docker.project_containers(subscription_id)
+        except DockerAPIError as e:
+            logger.warning(f"Docker API lookup failed, using CLI: {e}")
+            return None
+        return containers[0] if containers else None
+
+    def _api_status(
+        self, subscription_id: str, container_id: Optional[str] = None
+    ) -> Tuple[str, str, Dict]:
+        """
+        Container state and metrics through the Engine API
+
+        With the container id from the state index this is a single inspect;
+        otherwise, or when that container is gone, the project is listed.
+        """
+        inspect = None
+        if container_id:
+            try:
+                inspect = self.docker.inspect_container(container_id)
+            except DockerAPIError as e:
+                if e.status != 404:
+                    raise
+        if inspect is None:
+            containers = self.docker.project_containers(subscription_id)
+            if not containers:
+                return "stopped", "", {}
+            container_id = containers[0]["Id"]
+            status = containers[0]["State"]
+        else:
+            status = inspect["State"]["Status"]
+
+        metrics = {}
+        if status == "running":
+            if inspect is None:
+                inspect = self.docker.inspect_container(container_id)
+            metrics = self.container_metrics([container_id]).get(container_id, {})
+            metrics["started_at"] = inspect["State"]["StartedAt"]
+        return status, container_id, metrics
+
+    def _cli_status(
+        self, compose_file: str, subscription_id: str
+    ) -> Tuple[str, str, Dict]:
+        """Container state and metrics through the docker CLI"""
+        # Get container ID
+        id_cmd = f"docker compose -f {compose_file} -p {subscription_id} ps -q"
+        _, container_id, _ = self.run_command(id_cmd)
+        container_id = container_id.strip()
+
+        if not container_id:
+            return "stopped", "", {}
+
         # Get container status
         status_cmd = f"docker inspect -f '{{{{.State.Status}}}}' {container_id}"
         _, status, _ = self.run_command(status_cmd)
@@ -256,42 +842,268 @@ class GameServerManager:
 
         metrics = {}
         if status == "running":
-            # Get CPU usage
-            cpu_cmd = (
-                f"docker stats {container_id} --no-stream --format '{{{{.CPUPerc}}}}'"
-            )
-            _, cpu, _ = self.run_command(cpu_cmd)
-
-            # Get memory usage
-            mem_cmd = (
-                f"docker stats {container_id} --no-stream --format '{{{{.MemUsage}}}}'"
-            )
-            _, mem, _ = self.run_command(mem_cmd)
+            metrics = self.container_metrics([container_id]).get(container_id)
+            if metrics is None:
+                # Get CPU and memory usage
+                stats_cmd = (
+                    f"docker stats {container_id} --no-stream "
+                    f"--format '{{{{.CPUPerc}}}}|{{{{.MemUsage}}}}'"
+                )
+                _, stats, _ = self.run_command(stats_cmd)
+                cpu, _, mem = stats.strip().partition("|")
+                metrics = {"cpu_usage": cpu, "memory_usage": mem}
 
             # Get uptime
             uptime_cmd = (
                 f"docker inspect --format='{{{{.State.StartedAt}}}}' {container_id}"
             )
             _, uptime, _ = self.run_command(uptime_cmd)
+            metrics["started_at"] = uptime.strip()
+        return status, container_id, metrics
 
-            metrics = {
-                "cpu_usage": cpu.strip(),
-                "memory_usage": mem.strip(),
-                "started_at": uptime.strip(),
-            }
+    def container_metrics(self, container_ids: List[str]) -> Dict[str, Dict]:
+        """Numeric metrics per running container, from cgroup files when possible"""
+        metrics = {}
+        if self.cgroup_metrics is not None:
+            metrics = self.cgroup_metrics.collect(container_ids)
+
+        missing = [cid for cid in container_ids if cid not in metrics]
+        if not missing or self.docker is None:
+            return metrics
+
+        def api_metrics(container_id: str):
+            try:
+                stats = self.docker.container_stats(container_id)
+            except DockerAPIError as e:
+                logger.warning(f"Failed to get stats for {container_id}: {e}")
+                return
+            metrics[container_id] = dockerapi.stats_metrics(stats)
+
+        # Stats calls block for a sampling period each, so overlap them
+        with ThreadPoolExecutor(max_workers=min(32, len(missing))) as pool:
+            list(pool.map(api_metrics, missing))
+        return metrics
+
+    def list_subscriptions(
+        self, game_type: Optional[str] = None
+    ) -> List[Tuple[str, str, str]]:
+        """(game_type, subscription_id, compose_file) from the state index"""
+        if self.state.reconciled_at() is None:
+            self.reconcile_state()
+        return [
+            (entry["game_type"], entry["subscription_id"], entry["compose_file"])
+            for entry in self.state.list(game_type)
+            if entry["compose_file"]
+        ]
 
-        return ServerResult(
-            action="status",
-            subscription_id=subscription_id,
-            status=status,
-            container_id=container_id if container_id else None,
-            metrics=metrics,
+    @staticmethod
+    def _scan_compose_files(
+        game_type: Optional[str] = None,
+    ) -> List[Tuple[str, str, str]]:
+        """(game_type, subscription_id, compose_file) for every compose file"""
+        subscriptions = []
+        prefix = "docker-compose-"
+        for name in sorted(os.listdir(subscription_path)):
+            if not (name.startswith(prefix) and name.endswith(".yml")):
+                continue
+            file_game_type, _, subscription_id = name[len(prefix) : -4].partition("-")
+            if not subscription_id:
+                continue
+            if game_type and file_game_type != game_type:
+                continue
+            subscriptions.append(
+                (file_game_type, subscription_id, os.path.join(subscription_path, name))
+            )
+        return subscriptions
+
+    def subscription_ids(self) -> Set[str]:
+        """Subscriptions whose compose file still exists"""
+        return {sub for _, sub, _ in self._scan_compose_files()}
+
+    @staticmethod
+    def compose_ports(compose_file: str) -> List[int]:
+        """Host ports published by a compose file"""
+        with open(compose_file) as f:
+            compose = yaml.safe_load(f) or {}
+        ports = []
+        for service in (compose.get("services") or {}).values():
+            for mapping in service.get("ports") or []:
+                # "<host>:<container>[/proto]"
+                host = str(mapping).split(":")[0]
+                if host.isdigit():
+                    ports.append(int(host))
+        return ports
+
+    def ensure_ports(self, subscription_id: str, game_type: str) -> Optional[List[int]]:
+        """
+        Reservation of an existing server, adopted from its compose file if
+        it has none, so no other subscription is given the ports it starts on
+
+        Raises PortAllocationError if another subscription holds them.
+        """
+        ports = self.port_allocator.reserved(subscription_id)
+        if ports is not None:
+            return ports
+        try:
+            ports = self.compose_ports(self.compose_path(subscription_id, game_type))
+        except (OSError, yaml.YAMLError) as e:
+            logger.warning(f"Unable to read ports of {subscription_id}: {e}")
+            return None
+        return self.port_allocator.adopt(subscription_id, ports) if ports else None
+
+    def reconcile_ports(self) -> Dict[str, List]:
+        """Sync port reservations with the ports in existing compose files"""
+        known = {}
+        for _, subscription_id, compose_file in self._scan_compose_files():
+            try:
+                known[subscription_id] = self.compose_ports(compose_file)
+            except (OSError, yaml.YAMLError) as e:
+                logger.warning(f"Unable to read ports from {compose_file}: {e}")
+        return self.port_allocator.reconcile(known)
+
+    def status_all(self, game_type: Optional[str] = None) -> List[ServerResult]:
+        """Status and metrics for every subscription with one batched query"""
+        subscriptions = self.list_subscriptions(game_type)
+        if not subscriptions:
+            return []
+
+        containers = self.project_containers()
+        running = {
+            container_id: project
+            for project, (container_id, state) in containers.items()
+            if state == "running"
+        }
+        fleet_metrics = self._fleet_metrics(running)
+
+        results = []
+        for _, subscription_id, _ in subscriptions:
+            if subscription_id not in containers:
+                results.append(
+                    ServerResult(
+                        action="status",
+                        subscription_id=subscription_id,
+                        status="stopped",
+                        metrics={},
+                    )
+                )
+                continue
+            container_id, status = containers[subscription_id]
+            results.append(
+                ServerResult(
+                    action="status",
+                    subscription_id=subscription_id,
+                    status=status,
+                    container_id=container_id,
+                    metrics=fleet_metrics.get(subscription_id, {}),
+                )
+            )
+
+        try:
+            self.state.update_many(
+                {
+                    r.subscription_id: {
+                        "status": r.status,
+                        "container_id": r.container_id,
+                    }
+                    for r in results
+                }
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to index fleet status: {e}")
+        return results
+
+    def project_containers(self) -> Dict[str, Tuple[str, str]]:
+        """Map compose project -> (container id, state) with one listing"""
+        if self.events is not None and self.events.synced:
+            return self.events.project_containers()
+        label = "com.docker.compose.project"
+        if self.docker is not None:
+            try:
+                return {
+                    container["Labels"][label]: (container["Id"], container["State"])
+                    for container in self.docker.list_containers(
+                        filters={"label": [label]}
+                    )
+                }
+            except DockerAPIError as e:
+                logger.warning(f"Docker API listing failed, using CLI: {e}")
+
+        ps_cmd = (
+            f"docker ps -a --no-trunc --filter label={label} "
+            f"--format '{{{{.ID}}}} {{{{.State}}}} {{{{.Label \"{label}\"}}}}'"
+        )
+        return_code, stdout, _ = self.run_command(ps_cmd)
+        if return_code != 0:
+            return {}
+
+        containers = {}
+        for line in stdout.splitlines():
+            parts = line.split()
+            if len(parts) == 3:
+                container_id, state, project = parts
+                containers[project] = (container_id, state)
+        return containers
+
+    def _fleet_metrics(self, running: Dict[str, str]) -> Dict[str, Dict]:
+        """Map project -> metrics for running containers (container id -> project)"""
+        if not running:
+            return {}
+
+        fleet = {project: {} for project in running.values()}
+        metrics = self.container_metrics(list(running))
+        for container_id, container_metrics in metrics.items():
+            fleet[running[container_id]].update(container_metrics)
+
+        if self.docker is not None:
+            try:
+                for container_id, project in running.items():
+                    inspect = self.docker.inspect_container(container_id)
+                    fleet[project]["started_at"] = inspect["State"]["StartedAt"]
+                return fleet
+            except DockerAPIError as e:
+                logger.warning(f"Docker API inspect failed, using CLI: {e}")
+
+        unsampled = " ".join(cid for cid in running if cid not in metrics)
+        if unsampled:
+            # One sampling pass for every container cgroups could not cover
+            stats_cmd = (
+                f"docker stats --no-stream --no-trunc "
+                f"--format '{{{{.ID}}}}|{{{{.CPUPerc}}}}|{{{{.MemUsage}}}}' {unsampled}"
+            )
+            _, stdout, _ = self.run_command(stats_cmd)
+            for line in stdout.splitlines():
+                parts = line.split("|")
+                if len(parts) == 3 and parts[0] in running:
+                    fleet[running[parts[0]]].update(
+                        {
+                            "cpu_usage": parts[1].strip(),
+                            "memory_usage": parts[2].strip(),
+                        }
+                    )
+
+        ids = " ".join(running)
+        started_cmd = (
+            f"docker inspect --format '{{{{.Id}}}} {{{{.State.StartedAt}}}}' {ids}"
         )
+        _, stdout, _ = self.run_command(started_cmd)
+        for line in stdout.splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[0] in running:
+                fleet[running[parts[0]]]["started_at"] = parts[1]
+        return fleet
 
     def update_config(
         self, subscription_id: str, game_type: str, cfg_json: str
     ) -> ServerResult:
-        """Update server configuration"""
+        """
+        Update server configuration, writing only keys that changed
+
+        The result's metrics list the changed keys by the level each needs
+        ("noop", "restart", "recreate") and the most disruptive as "apply",
+        "none" when nothing changed. The state index is adjusted so the next
+        restart_server does exactly that: a recreate-level change forgets
+        the compose hash, a noop-only change records the new env hash.
+        """
         try:
             handler = self.registry.get_handler(game_type)
             config: GameConfig = handler.parse_config(cfg_json)
@@ -308,17 +1120,38 @@ class GameServerManager:
             env_vars: Dict[str, str] = handler.generate_env_vars(
                 config, subscription_id
             )
+            env_file = self.env_path(subscription_id, game_type)
+            previous_hash = self.file_hash(env_file)
             # update the env file or appropriate file
-            handler.update_config_file(
+            changes = handler.update_config_file(
                 env_vars=env_vars,
                 subscription_path=subscription_path,
                 subscription_id=subscription_id,
             )
+            classes = handler.classify_config_changes(changes)
+            apply = next(
+                (level for level in ("recreate", "restart", "noop") if classes[level]),
+                "none",
+            )
+            entry = self.state.get(subscription_id)
+            if entry is not None and apply == "recreate":
+                self.state.update(subscription_id, compose_hash=None)
+            elif entry is not None and apply == "noop":
+                if entry.get("env_hash") == previous_hash:
+                    self.state.update(
+                        subscription_id, env_hash=self.file_hash(env_file)
+                    )
+            if changes:
+                logger.info(
+                    f"Config of {subscription_id} changed ({apply}): "
+                    f"{sorted(changes)}"
+                )
 
             return ServerResult(
                 action="updateConfig",
                 subscription_id=subscription_id,
-                status="configured",
+                status="configured" if changes else "unchanged",
+                metrics={"changed": sorted(changes), "apply": apply, **classes},
             )
 
         except Exception as e:
@@ -329,45 +1162,382 @@ class GameServerManager:
                 error=str(e),
             )
 
-    def backup(self, subscription_id: str) -> ServerResult:
+    def backup(
+        self,
+        subscription_id: str,
+        game_type: Optional[str] = None,
+        mode: str = "dedup",
+        codec: str = "gzip",
+        level: Optional[int] = None,
+        workers: Optional[int] = None,
+        throttle: Optional[Callable[[int], None]] = None,
+    ) -> ServerResult:
+        """
+        Back up a subscription's server directory from a snapshot of it
+
+        Args:
+            subscription_id: Unique subscription identifier
+            game_type: Selects the paths to back up, everything when None
+            mode: "dedup" for the incremental chunk store, "archive" for a
+                tarball next to the server files
+            codec, level, workers: Compression of an archive backup
+            throttle: Read rate limit of a dedup backup, called with the
+                bytes read
+        """
+        source_dir = f"/srv/allservers/{subscription_id}"
+        paths = ["."]
+        log_path = None
+        if game_type is not None:
+            handler = self.registry.get_handler(game_type)
+            log_path = handler.server_log_path(source_dir)
+            if mode != "archive":
+                paths = handler.backup_paths
+        # Full archives keep logs and scratch files; world backups skip them
+        exclude = ["backup-*"]
+        if mode != "archive":
+            exclude += SKIP_PATTERNS
+
+        snapshot_dir = os.path.join(
+            SNAPSHOT_ROOT, f"{subscription_id}-{time.time_ns()}"
+        )
+        try:
+            snapshot = self.snapshotter.snapshot(
+                source_dir, snapshot_dir, paths, log_path, exclude=exclude
+            )
+        except SnapshotError as e:
+            logger.warning(f"Backing up {subscription_id} without a snapshot: {e}")
+            snapshot, snapshot_dir = None, None
+
+        try:
+            if mode == "archive":
+                result = self._archive_backup(
+                    subscription_id, snapshot_dir, codec, level, workers
+                )
+            else:
+                result = self._dedup_backup(
+                    subscription_id, snapshot_dir, paths, exclude, throttle
+                )
+        finally:
+            if snapshot_dir is not None:
+                self.snapshotter.remove(snapshot_dir)
+        if result.metrics is not None:
+            result.metrics["snapshot"] = snapshot
+        return result
+
+    def _dedup_backup(
+        self,
+        subscription_id: str,
+        read_dir: Optional[str],
+        paths: List[str],
+        exclude: List[str],
+        throttle: Optional[Callable[[int], None]] = None,
+    ) -> ServerResult:
+        source_dir = f"/srv/allservers/{subscription_id}"
+        try:
+            summary = self.backup_store.backup(
+                subscription_id,
+                read_dir or source_dir,
+                paths=paths,
+                exclude=exclude,
+                throttle=throttle,
+            )
+            if self.offloads is not None:
+                self.offloads.put(subscription_id, "dedup")
+                summary["offload"] = "queued"
+            summary.update(self._prune_dedup(subscription_id))
+        except (BackupError, OSError) as e:
+            logger.error(f"Backup of {subscription_id} failed: {e}")
+            return ServerResult(
+                action="backup",
+                subscription_id=subscription_id,
+                status="failed",
+                error=str(e),
+            )
+        return ServerResult(
+            action="backup",
+            subscription_id=subscription_id,
+            status="completed",
+            metrics=summary,
+        )
+
+    def _archive_backup(
+        self,
+        subscription_id: str,
+        read_dir: Optional[str] = None,
+        codec: str = "gzip",
+        level: Optional[int] = None,
+        workers: Optional[int] = None,
+    ) -> ServerResult:
         now = datetime.datetime.now(datetime.timezone.utc)
         backup_source = f"/srv/allservers/{subscription_id}"
-        backup_target = f"/srv/allservers/{subscription_id}/backup-{now.strftime('%Y-%m-%d-%H:%M')}.tar.gz"
-        tmp = pathlib.Path(__file__).resolve().parent / "temp"
-        tmp.mkdir(exist_ok=True)
-        with tempfile.NamedTemporaryFile(
-            delete=False, dir=tmp, mode="w", suffix=".tar.gz"
-        ) as tmp_file:
-            pass
-
-        cmd = f"tar -czf {tmp_file.name} {backup_source}"
-        return_code, stdout, stderr = self.run_command(cmd)
-        shutil.move(tmp_file.name, backup_target)
+        backup_target = (
+            f"{backup_source}/backup-{now.strftime('%Y-%m-%d-%H:%M')}"
+            f"{archiver.EXTENSIONS.get(codec, '')}"
+        )
         try:
-            if return_code == 0:
-                return ServerResult(
-                    action="backup",
+            metrics = archiver.write_archive(
+                read_dir or backup_source,
+                backup_target,
+                # Earlier archives would nest inside every new one
+                exclude=["backup-*"],
+                codec=codec,
+                level=level,
+                workers=workers,
+                arcname=backup_source,
+            )
+            if self.offloads is not None:
+                self.offloads.put(subscription_id, "archive")
+                metrics["offload"] = "queued"
+        except archiver.ArchiveError as e:
+            logger.error(f"Backup of {subscription_id} failed: {e}")
+            return ServerResult(
+                action="backup",
+                subscription_id=subscription_id,
+                status="failed",
+                error=str(e),
+            )
+        return ServerResult(
+            action="backup",
+            subscription_id=subscription_id,
+            status="completed",
+            metrics=metrics,
+        )
+
+    def restore(
+        self,
+        subscription_id: str,
+        game_type: str,
+        backup_ref: Optional[str] = None,
+        workers: Optional[int] = None,
+        progress: Optional[Callable[[ServerResult], None]] = None,
+    ) -> ServerResult:
+        """
+        Stop a server, restore its files from a backup and start it again
+
+        Args:
+            subscription_id: Unique subscription identifier
+            game_type: Type of game server
+            backup_ref: Dedup backup id, a time (unix seconds or ISO 8601)
+                selecting the newest backup taken at or before it, or the
+                file name of an archive backup. The newest backup when None.
+            workers: Restore threads, all cores when None
+            progress: Called with "in_progress" results while restoring
+        """
+        target_dir = f"/srv/allservers/{subscription_id}"
+        compose_file = os.path.join(
+            subscription_path,
+            f"docker-compose-{game_type}-{subscription_id}.yml",
+        )
+
+        def failed(error: str) -> ServerResult:
+            logger.error(f"Restore of {subscription_id} failed: {error}")
+            return ServerResult(
+                action="restore",
+                subscription_id=subscription_id,
+                status="failed",
+                error=error,
+            )
+
+        if not os.path.exists(compose_file):
+            return ServerResult(
+                action="restore",
+                subscription_id=subscription_id,
+                status="not_found",
+                error="Server configuration not found",
+            )
+
+        # Resolve the backup before touching the running server
+        archive_path = None
+        if backup_ref is not None and backup_ref.startswith("backup-"):
+            archive_path = os.path.join(target_dir, os.path.basename(backup_ref))
+            if not os.path.isfile(archive_path):
+                return failed(f"Unknown backup: {backup_ref}")
+            backup_id = os.path.basename(backup_ref)
+        else:
+            try:
+                backup_id = self.backup_store.find_backup(subscription_id, backup_ref)
+            except BackupError as e:
+                return failed(str(e))
+
+        last_report = [0.0]
+
+        def report(phase: str, done: int = 0, total: int = 0, force: bool = False):
+            if progress is None:
+                return
+            now = time.monotonic()
+            if not force and now - last_report[0] < PROGRESS_INTERVAL:
+                return
+            last_report[0] = now
+            progress(
+                ServerResult(
+                    action="restore",
                     subscription_id=subscription_id,
-                    status="completed",
+                    status="in_progress",
                     metrics={
-                        "backup_file": backup_target,
-                        "size": os.path.getsize(backup_target),
+                        "backup_id": backup_id,
+                        "phase": phase,
+                        "bytes_done": done,
+                        "bytes_total": total,
+                        "percent": round(100 * done / total, 1) if total else None,
                     },
                 )
+            )
+
+        report("stopping", force=True)
+        stop_result = self.stop_server(subscription_id, game_type)
+        if stop_result.status != "stopped":
+            return failed(f"Failed to stop server: {stop_result.error}")
+
+        report("restoring", force=True)
+        error = None
+        metrics: Dict = {"backup_id": backup_id}
+        try:
+            if archive_path is not None:
+                metrics.update(
+                    archiver.extract_archive(
+                        archive_path,
+                        target_dir,
+                        strip=target_dir,
+                        progress=lambda done, total: report("restoring", done, total),
+                    )
+                )
             else:
-                return ServerResult(
-                    action="backup",
-                    subscription_id=subscription_id,
-                    status="failed",
-                    error=stderr,
+                metrics.update(
+                    self.backup_store.restore(
+                        subscription_id,
+                        backup_id,
+                        target_dir,
+                        workers=workers,
+                        progress=lambda done, total: report("restoring", done, total),
+                    )
                 )
-        except Exception as e:
-            return ServerResult(
-                action="backup",
+        except (BackupError, archiver.ArchiveError, OSError) as e:
+            error = str(e)
+            logger.error(f"Restore of {subscription_id} from {backup_id} failed: {e}")
+
+        # Bring the server back even after a failed restore; every file was
+        # replaced atomically, so it sees either its old or its restored copy
+        report("starting", force=True)
+        try:
+            start_result = self.start_server(
+                compose_file,
+                subscription_id,
+                self.ensure_ports(subscription_id, game_type),
+            )
+        except PortAllocationError as e:
+            start_result = ServerResult(
+                action="start",
                 subscription_id=subscription_id,
                 status="failed",
                 error=str(e),
             )
+        if start_result.status != "running":
+            error = "; ".join(filter(None, [error, start_result.error]))
+        else:
+            self.await_ready({subscription_id: (start_result, game_type)})
+            metrics.update(
+                {
+                    key: value
+                    for key, value in (start_result.metrics or {}).items()
+                    if key in ("ready", "time_to_ready", "players", "max_players")
+                }
+            )
+
+        return ServerResult(
+            action="restore",
+            subscription_id=subscription_id,
+            status="failed" if error else "completed",
+            error=error,
+            container_id=start_result.container_id,
+            container_ip=start_result.container_ip,
+            metrics=metrics,
+            ports=start_result.ports,
+        )
+
+    def _prune_dedup(self, subscription_id: str) -> Dict:
+        """Apply dedup retention, keeping backups the bucket lacks"""
+        protected: Set[str] = set()
+        if self.offloader is not None:
+            protected = self.offloader.pending_backups(
+                self.backup_store, subscription_id
+            )
+        summary: Dict = {"pruned": self.backup_store.prune(subscription_id, protected)}
+        if summary["pruned"]:
+            summary.update(self.backup_store.gc())
+        return summary
+
+    def _offload(self, subscription_id: str, kind: str):
+        """Upload a subscription's backups of one kind, run by self.offloads"""
+        if kind == "archive":
+            summary = self._offload_archives(subscription_id)
+        else:
+            try:
+                offload = self.offloader.offload_dedup(
+                    self.backup_store, subscription_id
+                )
+            except OffloadError as e:
+                logger.error(f"Offload of {subscription_id} failed: {e}")
+                offload = {"error": str(e)}
+            summary = {"offload": offload, **self._prune_dedup(subscription_id)}
+        logger.info(f"Offload of {subscription_id} ({kind}): {summary}")
+
+    def wait_offloads(self):
+        """Block until queued offloads are done, before a CLI run exits"""
+        if self.offloads is not None:
+            self.offloads.wait_idle()
+
+    def _offload_archives(self, subscription_id: str) -> Dict:
+        """Upload a subscription's archives, then prune offloaded ones"""
+        archives = sorted(
+            glob.glob(f"/srv/allservers/{subscription_id}/backup-*.tar.*"),
+            key=os.path.getmtime,
+        )
+        try:
+            offload = self.offloader.offload_archives(subscription_id, archives)
+        except OffloadError as e:
+            logger.error(f"Offload of {subscription_id} failed: {e}")
+            offload = {"error": str(e)}
+
+        kept = self.backup_store.policy.keep([os.path.getmtime(a) for a in archives])
+        pruned = []
+        for archive in archives:
+            key = self.offloader.archive_key(subscription_id, archive)
+            if not self.offloader.is_offloaded(key):
+                continue
+            if os.path.getmtime(archive) in kept:
+                continue
+            try:
+                os.unlink(archive)
+                pruned.append(os.path.basename(archive))
+            except FileNotFoundError:
+                continue
+        if pruned:
+            logger.info(f"Pruned {len(pruned)} local archives of {subscription_id}")
+        return {"offload": offload, "pruned": pruned}
+
+    def enable_sftp_batching(self, window: float):
+        """Queue SFTP user changes and apply them at most once per window"""
+        self.sftp_batch_window = window
+        self._sftp_manager.start_batch_flusher(window)
+
+    def disable_sftp_batching(self):
+        """Stop the batch flusher and apply the changes still queued"""
+        self.sftp_batch_window = None
+        flushed = self._sftp_manager.stop_batch_flusher()
+        if flushed is not None and flushed.status == "failed":
+            logger.error(f"Final SFTP flush failed: {flushed.error}")
+
+    def flush_sftp_batch(self) -> ServerResult:
+        """Apply queued SFTP user changes now"""
+        return self._sftp_manager.flush_pending()
+
+    def migrate_sftp_server(self) -> ServerResult:
+        """Switch the SFTP server to live user provisioning (one restart)"""
+        return self._sftp_manager.migrate_to_live_provisioning()
+
+    def remount_sftp_homes(self) -> ServerResult:
+        """Bind SFTP users' server dirs again, as after a host reboot"""
+        return self._sftp_manager.mount_homes()
 
     def update_sftp_server(self, game_type: str, subscription_id: str) -> ServerResult:
         """
@@ -381,15 +1551,16 @@ class GameServerManager:
             ServerResult: Result of the SFTP update operation
         """
         try:
-            # Initialize SFTP manager if not already done
-            if not hasattr(self, "_sftp_manager"):
-                self._sftp_manager = SFTPManager()
-
-            # Add user and volume mapping
-            result = self._sftp_manager.add_user_volume(game_type, subscription_id)
+            # Add user and volume mapping, or queue it for the next batch
+            if self.sftp_batch_window:
+                result = self._sftp_manager.queue_user_volume(
+                    game_type, subscription_id
+                )
+            else:
+                result = self._sftp_manager.add_user_volume(game_type, subscription_id)
 
             # Log the result
-            if result.status == "completed":
+            if result.status in ("completed", "queued"):
                 logger.info(f"SFTP server updated successfully for {subscription_id}")
                 if result.metrics:
                     logger.info(
@@ -413,17 +1584,25 @@ class GameServerManager:
             )
 
 
-def main(argv: List[str]):
-    manager = GameServerManager()
-    """Main entry point"""
+def build_parser() -> argparse.ArgumentParser:
+    """Build the argument parser shared by the CLI and the manager daemon"""
     parser = argparse.ArgumentParser("Game server management")
     parser.add_argument(
         "action",
-        choices=["start", "stop", "restart", "status", "updateConfig", "backup"],
+        choices=[
+            "start",
+            "stop",
+            "restart",
+            "status",
+            "updateConfig",
+            "backup",
+            "restore",
+        ]
+        + FLEET_ACTIONS,
         help="Action to perform",
     )
     parser.add_argument(
-        "-u", "--subscription-id", required=True, help="Unique subscription identifier"
+        "-u", "--subscription-id", help="Unique subscription identifier"
     )
     parser.add_argument(
         "-p", "--port", type=int, nargs="+", help="List of game server ports"
@@ -436,11 +1615,81 @@ def main(argv: List[str]):
     parser.add_argument(
         "--cfg-json", type=str, help="base64 encoded json Configuration of server"
     )
+    parser.add_argument(
+        "--backup-mode",
+        choices=["dedup", "archive"],
+        default="dedup",
+        help="Incremental deduplicated backup or a full tar archive",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=["gzip", "zstd"],
+        default="gzip",
+        help="Compression of archive backups",
+    )
+    parser.add_argument(
+        "--compress-level", type=int, help="Compression level of archive backups"
+    )
+    parser.add_argument(
+        "--backup-workers",
+        type=int,
+        help="Compression threads for archive backups (default: all cores)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Restart the container even when nothing changed",
+    )
+    parser.add_argument(
+        "--manifest",
+        help="YAML or JSON list of servers for bulk-start: subscription_id, "
+        "game_type and optionally memory, cpu and config",
+    )
+    parser.add_argument(
+        "--max-starts",
+        type=int,
+        default=BULK_MAX_STARTS,
+        help="Simultaneous `docker compose up` runs during bulk-start",
+    )
+    parser.add_argument(
+        "--backup-id",
+        help="Backup to restore: a backup id, a time (unix seconds or ISO 8601) "
+        "or an archive file name (default: the newest backup)",
+    )
+    parser.add_argument(
+        "--restore-workers",
+        type=int,
+        help="Threads restoring files (default: all cores)",
+    )
+    return parser
+
 
+def result_payload(
+    result: Union[ServerResult, List[ServerResult]]
+) -> Union[Dict, List[Dict]]:
+    """JSON payload for one result or a batch of results"""
+    if isinstance(result, list):
+        return [r.to_dict() for r in result]
+    return result.to_dict()
+
+
+def handle(
+    manager: GameServerManager, argv: List[str]
+) -> Union[ServerResult, List[ServerResult], None]:
+    """Parse argv, run the requested action on manager and report the result"""
+    parser = build_parser()
     args = parser.parse_args(argv)
 
+    if args.action not in FLEET_ACTIONS and not args.subscription_id:
+        parser.error(f"--subscription-id is required for {args.action}")
+
+    # Existing subscriptions are found through the state index
+    if args.game_type is None and args.action not in FLEET_ACTIONS:
+        args.game_type = manager.resolve_game_type(args.subscription_id)
+
     # Validate game type
-    if args.game_type not in manager.registry.get_supported_games():
+    fleet_wide = args.action in FLEET_ACTIONS and args.game_type is None
+    if not fleet_wide and args.game_type not in manager.registry.get_supported_games():
         logger.error(f"Unsupported game type: {args.game_type}")
         logger.info(
             f"Supported games: {', '.join(manager.registry.get_supported_games())}"
@@ -452,32 +1701,92 @@ def main(argv: List[str]):
     args.port = []
     if args.action == "start":
         handler = manager.registry.get_handler(args.game_type)
-        args.port = handler.default_ports
-        logger.info(f"Using  ports for {args.game_type}: {args.port}")
+        fresh = manager.port_allocator.reserved(args.subscription_id) is None
+        rstp = None
+        try:
+            args.port = manager.port_allocator.reserve(
+                args.subscription_id, handler.port_count, handler.contiguous_ports
+            )
+            logger.info(f"Using  ports for {args.game_type}: {args.port}")
 
-        compose_file = manager.create_compose_file(
-            args.subscription_id, args.port, args.memory, args.cpu, args.game_type
-        )
-        rstp = manager.update_sftp_server(
-            args.game_type,
-            args.subscription_id,
-        )
-        result = manager.start_server(compose_file, args.subscription_id, args.
-            port)
-        if rstp.metrics:
-            result.metrics=rstp.metrics
+            compose_file = manager.create_compose_file(
+                args.subscription_id, args.port, args.memory, args.cpu, args.game_type
+            )
+            rstp = manager.update_sftp_server(
+                args.game_type,
+                args.subscription_id,
+            )
+            result = manager.start_server(compose_file, args.subscription_id, args.port)
+        except Exception as e:
+            logger.error(f"Failed to start {args.subscription_id}: {e}")
+            result = ServerResult(
+                action="start",
+                subscription_id=args.subscription_id,
+                status="failed",
+                error=str(e),
+            )
+        if result.status == "failed":
+            # A stopped server's reservation outlives a failed start
+            if fresh:
+                manager.port_allocator.release(args.subscription_id)
+        else:
+            manager.await_ready({args.subscription_id: (result, args.game_type)})
+        if rstp is not None and rstp.metrics:
+            result.metrics = {**(result.metrics or {}), **rstp.metrics}
 
     elif args.action == "stop":
+        # Ports stay reserved while the compose file exists; reconcile_ports
+        # releases them once the subscription is gone
         result = manager.stop_server(args.subscription_id, args.game_type)
 
     elif args.action == "restart":
-        result = manager.restart_server(args.subscription_id, args.game_type)
+        result = manager.restart_server(
+            args.subscription_id, args.game_type, force=args.force
+        )
+        if result.status == "running" and result.metrics["restart"] != "skipped":
+            manager.await_ready({args.subscription_id: (result, args.game_type)})
 
     elif args.action == "status":
         result = manager.server_status(args.subscription_id, args.game_type)
 
+    elif args.action == "status-all":
+        result = manager.status_all(args.game_type)
+
+    elif args.action == "list":
+        result = manager.list_servers(args.game_type)
+
+    elif args.action == "sftp-flush":
+        result = [manager.flush_sftp_batch()]
+
+    elif args.action == "sftp-migrate":
+        result = [manager.migrate_sftp_server()]
+
+    elif args.action == "bulk-start":
+        if not args.manifest:
+            logger.error("--manifest is required for bulk-start")
+            sys.exit(1)
+        with open(args.manifest) as f:
+            entries = yaml.safe_load(f) or []
+        result = manager.bulk_start(entries, args.max_starts)
+
     elif args.action == "backup":
-        result = manager.backup(args.subscription_id)
+        result = manager.backup(
+            args.subscription_id,
+            args.game_type,
+            args.backup_mode,
+            codec=args.compression,
+            level=args.compress_level,
+            workers=args.backup_workers,
+        )
+
+    elif args.action == "restore":
+        result = manager.restore(
+            args.subscription_id,
+            args.game_type,
+            args.backup_id,
+            workers=args.restore_workers,
+            progress=manager.report,
+        )
 
     elif args.action == "updateConfig":
         if not args.cfg_json:
@@ -487,20 +1796,46 @@ def main(argv: List[str]):
             args.subscription_id, args.game_type, args.cfg_json
         )
 
-    if result:
+    if isinstance(result, ServerResult):
+        manager.record(
+            result,
+            args.game_type,
+            memory=args.memory if args.action == "start" else None,
+            cpu=args.cpu if args.action == "start" else None,
+        )
+
+    if args.action in FLEET_ACTIONS:
+        logger.info(f"Finished {args.action} on {len(result)} subscriptions")
+    elif result:
         compose_file = os.path.join(
             subscription_path,
             f"docker-compose-{args.game_type}-{args.subscription_id}.yml",
         )
         logger.info(f"Finished {args.action} on {compose_file}")
 
-        # Send result to API
-        try:
-            logger.info(result.to_dict())
-            requests.post(url=HOST_API, json=result.to_dict())
-        except Exception as e:
-            logger.error(f"Failed to send result to API: {e}")
+    if result:
+        manager.report(result)
+
+    return result
+
+
+def main(argv: List[str], forward: bool = True):
+    """Main entry point"""
+    # Hand the action to a running manager daemon so we skip registry setup
+    response = managerd.forward(argv) if forward else None
+    if response is not None:
+        if not response.get("ok"):
+            logger.error(f"Manager daemon rejected {argv}: {response.get('error')}")
+            sys.exit(1)
+        logger.info(response.get("result"))
+        return
+
+    manager = GameServerManager()
+    handle(manager, argv)
+    manager.outbox.flush(CLI_FLUSH_TIMEOUT)
+    manager.wait_offloads()
 
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    # The daemon was asked at the top of the module
+    main(sys.argv[1:], forward=False)
@@ -1,15 +1,21 @@
+import json
 import logging
 import pathlib
 import yaml
 import tempfile
 import shutil
 import secrets
+import shlex
 import subprocess
 import string
-from typing import Tuple, Optional
+import time
+from typing import Dict, List, Tuple, Optional
 import threading
 from datetime import datetime
 from customdataclasses import ServerResult
+from dockerapi import DockerAPIError, DockerClient
+from filelock import FileLock
+from sftpregistry import SFTPUser, SFTPUserRegistry
 
 
 class SFTPConfigurationError(Exception):
@@ -18,14 +24,84 @@ class SFTPConfigurationError(Exception):
     pass
 
 
+SFTP_CONTAINER = "sftpserver"
+
+# Parent of every subscription's server dir on the host
+SERVERS_ROOT = "/srv/allservers"
+
+# Host dir mounted as the container's /home. The manager bind-mounts each
+# user's server dir under it on the host and the mount propagates into the
+# running container, which needs neither SYS_ADMIN nor the servers root.
+SFTP_HOMES = "/srv/sftp-homes"
+HOMES_VOLUME = {
+    "type": "bind",
+    "source": SFTP_HOMES,
+    "target": "/home",
+    "bind": {"propagation": "rslave"},
+}
+
+# Make the homes dir a shared mount point of its own so later mounts under
+# it propagate; prints "mounted" when it was not one yet. Args: homes dir
+HOST_SHARE_SCRIPT = """
+set -e
+mkdir -p "$1"
+if ! mountpoint -q "$1"; then mount --bind "$1" "$1"; echo mounted; fi
+mount --make-rshared "$1"
+"""
+
+# Bind a server dir into its user's home on the host.
+# Args: homes dir, servers root, username, subscription_id
+HOST_BIND_SCRIPT = """
+set -e
+mkdir -p "$2/$4" "$1/$3/server"
+mountpoint -q "$1/$3/server" || mount --bind "$2/$4" "$1/$3/server"
+"""
+
+# Unbind a user's server dir and delete its home; the server data stays.
+# Args: homes dir, username
+HOST_UNBIND_SCRIPT = """
+if mountpoint -q "$1/$2/server"; then umount "$1/$2/server" || exit 1; fi
+rm -rf "${1:?}/${2:?}"
+"""
+
+# Create the user in the container and hand it its server dir.
+# Args: users.conf entry, username
+LIVE_ADD_SCRIPT = """
+set -e
+create-sftp-user "$1"
+chown "$2:users" "/home/$2/server"
+"""
+
+# Drop the user's sessions and account. Args: username
+LIVE_REMOVE_SCRIPT = """
+pkill -KILL -u "$1" || true
+userdel "$1" 2>/dev/null || true
+"""
+
+
+def mount_path(username: str) -> str:
+    """Where a user's server dir is mounted in the SFTP container"""
+    return f"/home/{username}/server"
+
+
 class SFTPManager:
     """Dedicated class for managing SFTP server configuration"""
 
-    def __init__(self, sftp_base_path: Optional[pathlib.Path] = None):
+    def __init__(
+        self,
+        sftp_base_path: Optional[pathlib.Path] = None,
+        docker: Optional[DockerClient] = None,
+    ):
         self.sftp_path = sftp_base_path or pathlib.Path(__file__).parent / "sftp"
+        self.docker = docker
         self.docker_compose_sftp = self.sftp_path / "docker-sftp.yml"
         self.users_conf = self.sftp_path / "users.conf"
+        self.pending_path = self.sftp_path / "pending"
+        self.provision_lock = self.sftp_path / ".provision.lock"
+        self.restart_marker = self.sftp_path / ".last_restart"
         self.lock = threading.Lock()
+        self._flusher: Optional[threading.Thread] = None
+        self._flusher_stop = threading.Event()
         self.logger = logging.getLogger("game-server-setup")
 
         # Ensure directories exist
@@ -34,6 +110,10 @@ class SFTPManager:
         # Create default files if they don't exist
         self._ensure_config_files_exist()
 
+        self.registry = SFTPUserRegistry(
+            self.users_conf, self.sftp_path / ".users.lock"
+        )
+
     def _ensure_config_files_exist(self):
         """Create default configuration files if they don't exist"""
         if not self.docker_compose_sftp.exists():
@@ -44,7 +124,11 @@ class SFTPManager:
                         "image": "atmoz/sftp:latest",
                         "container_name": "sftpserver",
                         "ports": ["2222:22"],
-                        "volumes": [f"{self.users_conf}:/etc/sftp/users.conf:ro"],
+                        "volumes": [
+                            f"{self.users_conf}:/etc/sftp/users.conf:ro",
+                            f"{self.sftp_path / 'init.sh'}:/etc/sftp.d/init.sh:ro",
+                            HOMES_VOLUME,
+                        ],
                         "restart": "unless-stopped",
                         "networks": ["gameserver-net"],
                     }
@@ -64,43 +148,11 @@ class SFTPManager:
 
     def _get_next_user_ids(self) -> Tuple[int, int]:
         """Get next available UID and GID for new user"""
-        try:
-            with open(self.users_conf, "r") as f:
-                lines = [line.strip() for line in f.readlines() if line.strip()]
-
-            if not lines:
-                return 1001, 101  # Start from 1001/101
-
-            # Find highest UID and GID
-            max_uid = 1000
-            max_gid = 100
-
-            for line in lines:
-                if ":" in line:
-                    parts = line.split(":")
-                    if len(parts) >= 4:
-                        try:
-                            uid = int(parts[2])
-                            gid = int(parts[3])
-                            max_uid = max(max_uid, uid)
-                            max_gid = max(max_gid, gid)
-                        except ValueError:
-                            continue
-
-            return max_uid + 1, max_gid + 1
-
-        except Exception as e:
-            self.logger.warning(f"Error reading users.conf, using default IDs: {e}")
-            return 1001, 101
+        return self.registry.next_ids()
 
     def _user_exists(self, subscription_id: str) -> bool:
         """Check if user already exists in users.conf"""
-        try:
-            with open(self.users_conf, "r") as f:
-                content = f.read()
-                return f"{subscription_id}:" in content
-        except FileNotFoundError:
-            return False
+        return subscription_id in self.registry
 
     def _backup_config_files(self) -> Tuple[pathlib.Path, pathlib.Path]:
         """Create backup copies of configuration files"""
@@ -120,7 +172,7 @@ class SFTPManager:
         """Restore configuration files from backup"""
         try:
             shutil.copy2(compose_backup, self.docker_compose_sftp)
-            shutil.copy2(users_backup, self.users_conf)
+            self.registry.restore(users_backup)
             self.logger.info("Configuration files restored from backup")
         except Exception as e:
             self.logger.error(f"Failed to restore from backup: {e}")
@@ -153,22 +205,25 @@ class SFTPManager:
                     self.logger.info(
                         f"SFTP user {subscription_id} already exists, skipping"
                     )
-                    self._restart_sftp_server()
                     return ServerResult(
                         action="sftp_update",
                         subscription_id=subscription_id,
                         status="already_exists",
                     )
 
+                if self._live_mode():
+                    return self._add_user_live(game_type, subscription_id)
+
                 # Create backups before making changes
                 compose_backup, users_backup = self._backup_config_files()
 
                 try:
-                    # Update docker-compose.yml
-                    self._update_docker_compose(game_type, subscription_id)
-
                     # Add user to users.conf
                     password = self._add_user_to_conf(subscription_id)
+                    username = self.registry.username_for(subscription_id)
+
+                    # Update docker-compose.yml
+                    self._update_docker_compose(subscription_id, username)
 
                     # Restart SFTP server
                     restart_result = self._restart_sftp_server()
@@ -186,10 +241,10 @@ class SFTPManager:
                         subscription_id=subscription_id,
                         status="completed",
                         metrics={
-                            "username": subscription_id[:4],
+                            "username": username,
                             "password": password,
-                            "mount_path": f"/home/{subscription_id}/{game_type}",
-                            "server_path": f"/srv/allservers/{subscription_id}",
+                            "mount_path": mount_path(username),
+                            "server_path": f"{SERVERS_ROOT}/{subscription_id}",
                         },
                     )
 
@@ -207,8 +262,36 @@ class SFTPManager:
                     error=str(e),
                 )
 
-    def _update_docker_compose(self, game_type: str, subscription_id: str):
+    def _add_user_live(self, game_type: str, subscription_id: str) -> ServerResult:
+        """Add a user to the running container, no restart"""
+        with FileLock(str(self.provision_lock)):
+            compose_backup, users_backup = self._backup_config_files()
+            password = self._generate_secure_password()
+            try:
+                self._apply_live_changes({subscription_id: password}, [])
+            except Exception:
+                self._restore_from_backup(compose_backup, users_backup)
+                raise
+        self._cleanup_old_backups()
+        username = self.registry.username_for(subscription_id)
+        return ServerResult(
+            action="sftp_update",
+            subscription_id=subscription_id,
+            status="completed",
+            metrics={
+                "username": username,
+                "password": password,
+                "mount_path": mount_path(username),
+                "server_path": f"{SERVERS_ROOT}/{subscription_id}",
+            },
+        )
+
+    def _update_docker_compose(self, subscription_id: str, username: str):
         """Update docker-compose.yml with new volume mapping"""
+        self._apply_compose_changes({subscription_id: username}, [])
+
+    def _apply_compose_changes(self, added: Dict[str, str], removed: List[str]):
+        """Add (subscription -> username) and remove volumes with one rewrite"""
         tmp_path = ""
         try:
             # Load current configuration
@@ -223,15 +306,23 @@ class SFTPManager:
             if "volumes" not in config["services"]["sftp"]:
                 config["services"]["sftp"]["volumes"] = []
 
-            # Create new volume mapping
-            new_volume = (
-                f"/srv/allservers/{subscription_id}:/home/{subscription_id}/server:rw"
-            )
+            # Filter out volumes of removed subscriptions
+            existing_volumes = [
+                vol
+                for vol in config["services"]["sftp"]["volumes"]
+                if not any(subscription_id in vol for subscription_id in removed)
+            ]
+
+            for subscription_id, username in added.items():
+                # Create new volume mapping
+                new_volume = (
+                    f"{SERVERS_ROOT}/{subscription_id}:{mount_path(username)}:rw"
+                )
 
-            # Check if volume already exists
-            existing_volumes = config["services"]["sftp"]["volumes"]
-            if not any(subscription_id in vol for vol in existing_volumes):
-                existing_volumes.append(new_volume)
+                # Check if volume already exists
+                if not any(subscription_id in vol for vol in existing_volumes):
+                    existing_volumes.append(new_volume)
+            config["services"]["sftp"]["volumes"] = existing_volumes
 
             # Write updated configuration atomically
 
@@ -244,7 +335,7 @@ class SFTPManager:
             # Atomic move
             shutil.move(tmp_path, self.docker_compose_sftp)
             self.logger.info(
-                f"Updated docker-compose.yml with volume for {subscription_id}"
+                f"Updated docker-compose.yml: +{len(added)} -{len(removed)} volumes"
             )
 
         except Exception as e:
@@ -253,46 +344,35 @@ class SFTPManager:
                 pathlib.Path(tmp_path).unlink()
             raise SFTPConfigurationError(f"Failed to update docker-compose.yml: {e}")
 
-    def _add_user_to_conf(self, subscription_id: str) -> str:
+    def _add_user_to_conf(
+        self, subscription_id: str, password: Optional[str] = None
+    ) -> str:
         """Add user to users.conf file"""
-        tmp_path = ""
+        password = password or self._generate_secure_password()
+        self._apply_users_conf_changes({subscription_id: password}, [])
+        return password
+
+    def _apply_users_conf_changes(
+        self,
+        added: Dict[str, str],
+        removed: List[str],
+        usernames: Optional[Dict[str, str]] = None,
+    ) -> Dict[str, SFTPUser]:
+        """Add users (subscription -> password) and remove users
+
+        Returns the users.conf user written for every added subscription.
+        """
         try:
-            # Generate secure password
-            password = self._generate_secure_password()
-
-            # Get next available UID/GID
-            uid, gid = self._get_next_user_ids()
-
-            # Create user configuration line
-            # Format: username:password:uid:gid:home_dir:shell:chroot_dir
-            user_line = (
-                f"{subscription_id[:4]}:{password}:{uid}:{gid}:::{subscription_id}\n"
+            self.registry.remove_many(removed)
+            users = self.registry.add_many(added, usernames)
+        except OSError as e:
+            raise SFTPConfigurationError(f"Failed to update users.conf: {e}")
+        for subscription_id, user in users.items():
+            self.logger.info(
+                f"Added SFTP user {user.username} for {subscription_id} "
+                f"with UID {user.uid}"
             )
-
-            # Append to users.conf atomically
-            with tempfile.NamedTemporaryFile(
-                mode="w", delete=False, dir=self.sftp_path, suffix=".tmp"
-            ) as tmp_file:
-                # Copy existing content
-                if self.users_conf.exists():
-                    with open(self.users_conf, "r") as existing:
-                        tmp_file.write(existing.read())
-
-                # Add new user
-                tmp_file.write(user_line)
-                tmp_path = tmp_file.name
-
-            # Atomic move
-            shutil.move(tmp_path, self.users_conf)
-            self.logger.info(f"Added SFTP user {subscription_id} with UID {uid}")
-
-            return password
-
-        except Exception as e:
-            # Clean up temp file if it exists
-            if "tmp_path" in locals() and pathlib.Path(tmp_path).exists():
-                pathlib.Path(tmp_path).unlink()
-            raise SFTPConfigurationError(f"Failed to add user to users.conf: {e}")
+        return users
 
     def run_command(self, cmd: str) -> Tuple[int, str, str]:
         """Execute shell command"""
@@ -316,11 +396,221 @@ class SFTPManager:
             self.logger.error(f"Error executing command: {e}")
             return 1, "", str(e)
 
+    # Live provisioning
+
+    def _has_homes_mount(self) -> bool:
+        """True when the compose file mounts the host's homes dir on /home"""
+        try:
+            with open(self.docker_compose_sftp, "r") as f:
+                service = (yaml.safe_load(f) or {}).get("services", {}).get("sftp", {})
+        except (OSError, yaml.YAMLError):
+            return False
+        return any(
+            isinstance(vol, dict)
+            and vol.get("source") == SFTP_HOMES
+            and vol.get("target") == "/home"
+            for vol in service.get("volumes", [])
+        )
+
+    def _live_mode(self) -> bool:
+        """Users can be changed in the running container without a restart"""
+        return self._has_homes_mount() and self._sftp_container_running()
+
+    def _run_on_host(self, script: str, *args: str) -> Tuple[int, str]:
+        """Run a shell script on the host with positional args"""
+        return_code, stdout, stderr = self.run_command(
+            shlex.join(["sh", "-c", script, "sh", *args])
+        )
+        return return_code, stdout + stderr
+
+    def _bind_home(self, user: SFTPUser):
+        code, output = self._run_on_host(
+            HOST_BIND_SCRIPT,
+            SFTP_HOMES,
+            SERVERS_ROOT,
+            user.username,
+            user.subscription_id,
+        )
+        if code != 0:
+            raise SFTPConfigurationError(
+                f"Failed to mount server dir of {user.subscription_id}: "
+                f"{output.strip()}"
+            )
+
+    def _share_homes(self) -> bool:
+        """Make the homes dir a shared mount, True if it was not mounted yet"""
+        code, output = self._run_on_host(HOST_SHARE_SCRIPT, SFTP_HOMES)
+        if code != 0:
+            raise SFTPConfigurationError(
+                f"Failed to mount {SFTP_HOMES}: {output.strip()}"
+            )
+        return "mounted" in output.split()
+
+    def mount_homes(self) -> ServerResult:
+        """
+        Bind every user's server dir under the homes dir again, as needed
+        after a host reboot
+
+        A container started before the homes dir was mounted does not see
+        mounts made under it, so it is restarted once in that case.
+        """
+        if not self._has_homes_mount():
+            return ServerResult(
+                action="sftp_mount", subscription_id="", status="idle"
+            )
+        with self.lock, FileLock(str(self.provision_lock)):
+            try:
+                remounted = self._share_homes()
+                users = self.registry.users()
+                for user in users:
+                    self._bind_home(user)
+            except SFTPConfigurationError as e:
+                self.logger.error(str(e))
+                return ServerResult(
+                    action="sftp_mount",
+                    subscription_id="",
+                    status="failed",
+                    error=str(e),
+                )
+            if remounted and self._sftp_container_running():
+                restart_result = self._restart_sftp_server()
+                if restart_result.status != "running":
+                    return restart_result
+                self.restart_marker.touch()
+        return ServerResult(
+            action="sftp_mount",
+            subscription_id="",
+            status="completed",
+            metrics={"users": len(users)},
+        )
+
+    def _exec_in_sftp(self, script: str, *args: str) -> Tuple[int, str]:
+        """Run a shell script in the sftp container with positional args"""
+        cmd = ["sh", "-c", script, "sh", *args]
+        if self.docker is not None:
+            try:
+                return self.docker.exec_run(SFTP_CONTAINER, cmd)
+            except DockerAPIError as e:
+                self.logger.warning(f"Docker API exec failed, using CLI: {e}")
+        return_code, stdout, stderr = self.run_command(
+            shlex.join(["docker", "exec", SFTP_CONTAINER, *cmd])
+        )
+        return return_code, stdout + stderr
+
+    def _apply_live_changes(
+        self,
+        added: Dict[str, str],
+        removed: List[str],
+        usernames: Optional[Dict[str, str]] = None,
+    ):
+        """Write users.conf and apply the same changes in the running container"""
+        removed_users = self._usernames(removed)
+        users = self._apply_users_conf_changes(added, removed, usernames)
+        for subscription_id, username in removed_users.items():
+            code, output = self._exec_in_sftp(LIVE_REMOVE_SCRIPT, username)
+            if code == 0:
+                code, output = self._run_on_host(
+                    HOST_UNBIND_SCRIPT, SFTP_HOMES, username
+                )
+            if code != 0:
+                raise SFTPConfigurationError(
+                    f"Failed to remove SFTP user {subscription_id}: {output.strip()}"
+                )
+        for subscription_id, user in users.items():
+            self._bind_home(user)
+            code, output = self._exec_in_sftp(
+                LIVE_ADD_SCRIPT, user.entry, user.username
+            )
+            if code != 0:
+                raise SFTPConfigurationError(
+                    f"Failed to add SFTP user {subscription_id}: {output.strip()}"
+                )
+
+    def _usernames(self, subscription_ids: List[str]) -> Dict[str, str]:
+        """Usernames in users.conf of the given subscriptions"""
+        usernames = {}
+        for subscription_id in subscription_ids:
+            user = self.registry.get(subscription_id)
+            if user is not None:
+                usernames[subscription_id] = user.username
+        return usernames
+
+    def migrate_to_live_provisioning(self) -> ServerResult:
+        """
+        Replace per-subscription volumes with the host's homes dir
+
+        Every user's server dir is bound under the homes dir before one last
+        restart; every later user change is applied live. Also moves servers
+        off the earlier layout that mounted all of /srv/allservers with
+        SYS_ADMIN.
+        """
+        with self.lock, FileLock(str(self.provision_lock)):
+            if self._has_homes_mount():
+                return ServerResult(
+                    action="sftp_migrate", subscription_id="", status="already_exists"
+                )
+
+            compose_backup, users_backup = self._backup_config_files()
+            tmp_path = ""
+            try:
+                self._share_homes()
+                for user in self.registry.users():
+                    self._bind_home(user)
+
+                with open(self.docker_compose_sftp, "r") as f:
+                    config = yaml.safe_load(f)
+                service = config.setdefault("services", {}).setdefault("sftp", {})
+                volumes = [
+                    vol
+                    for vol in service.get("volumes", [])
+                    if not str(vol).startswith(f"{SERVERS_ROOT}/")
+                    and not str(vol).startswith(f"{SERVERS_ROOT}:")
+                ]
+                init_volume = f"{self.sftp_path / 'init.sh'}:/etc/sftp.d/init.sh:ro"
+                if not any("/etc/sftp.d/init.sh" in str(vol) for vol in volumes):
+                    volumes.append(init_volume)
+                volumes.append(HOMES_VOLUME)
+                service["volumes"] = volumes
+                cap_add = [
+                    cap for cap in service.pop("cap_add", []) if cap != "SYS_ADMIN"
+                ]
+                if cap_add:
+                    service["cap_add"] = cap_add
+
+                with tempfile.NamedTemporaryFile(
+                    mode="w", delete=False, dir=self.sftp_path, suffix=".tmp"
+                ) as tmp_file:
+                    yaml.dump(config, tmp_file, default_flow_style=False, indent=2)
+                    tmp_path = tmp_file.name
+                shutil.move(tmp_path, self.docker_compose_sftp)
+
+                restart_result = self._restart_sftp_server()
+            except Exception as e:
+                if tmp_path and pathlib.Path(tmp_path).exists():
+                    pathlib.Path(tmp_path).unlink()
+                self._restore_from_backup(compose_backup, users_backup)
+                self.logger.error(f"Failed to migrate SFTP server: {e}")
+                return ServerResult(
+                    action="sftp_migrate",
+                    subscription_id="",
+                    status="failed",
+                    error=str(e),
+                )
+            if restart_result.status != "running":
+                self._restore_from_backup(compose_backup, users_backup)
+                return restart_result
+            self.restart_marker.touch()
+
+        self.logger.info("SFTP server migrated to live provisioning")
+        return ServerResult(
+            action="sftp_migrate", subscription_id="", status="completed"
+        )
+
     def _restart_sftp_server(self) -> ServerResult:
         """Restart SFTP server with proper error handling"""
         try:
             # Stop existing container (ignore errors if not running)
-            self.run_command("docker rm -f sftpserver")
+            self._remove_sftp_container()
 
             # Bring down compose stack
             down_cmd = f"docker compose -f {self.docker_compose_sftp} down"
@@ -342,10 +632,7 @@ class SFTPManager:
                 )
 
             # Verify container is running
-            verify_cmd = "docker ps --filter name=sftpserver --format '{{.Status}}'"
-            return_code, stdout, stderr = self.run_command(verify_cmd)
-
-            if return_code == 0 and stdout.strip():
+            if self._sftp_container_running():
                 self.logger.info("SFTP server restarted successfully")
                 return ServerResult(
                     action="sftp_restart",
@@ -369,6 +656,30 @@ class SFTPManager:
                 error=str(e),
             )
 
+    def _remove_sftp_container(self):
+        """Force remove the sftp container, via the Engine API when available"""
+        if self.docker is not None:
+            try:
+                self.docker.remove_container(SFTP_CONTAINER, force=True)
+                return
+            except DockerAPIError as e:
+                self.logger.warning(f"Docker API remove failed, using CLI: {e}")
+        self.run_command("docker rm -f sftpserver")
+
+    def _sftp_container_running(self) -> bool:
+        """Check that the sftp container is up"""
+        if self.docker is not None:
+            try:
+                state = self.docker.inspect_container(SFTP_CONTAINER)["State"]
+                return bool(state.get("Running"))
+            except DockerAPIError as e:
+                if e.status == 404:
+                    return False
+                self.logger.warning(f"Docker API inspect failed, using CLI: {e}")
+        verify_cmd = "docker ps --filter name=sftpserver --format '{{.Status}}'"
+        return_code, stdout, _ = self.run_command(verify_cmd)
+        return return_code == 0 and bool(stdout.strip())
+
     def _cleanup_old_backups(self, keep_count: int = 5):
         """Clean up old backup files, keeping only the most recent ones"""
         try:
@@ -407,6 +718,20 @@ class SFTPManager:
                         status="not_found",
                     )
 
+                if self._live_mode():
+                    with FileLock(str(self.provision_lock)):
+                        compose_backup, users_backup = self._backup_config_files()
+                        try:
+                            self._apply_live_changes({}, [subscription_id])
+                        except Exception:
+                            self._restore_from_backup(compose_backup, users_backup)
+                            raise
+                    return ServerResult(
+                        action="sftp_remove",
+                        subscription_id=subscription_id,
+                        status="removed",
+                    )
+
                 # Create backups
                 compose_backup, users_backup = self._backup_config_files()
 
@@ -445,45 +770,229 @@ class SFTPManager:
 
     def _remove_from_docker_compose(self, subscription_id: str):
         """Remove volume mapping from docker-compose.yml"""
-        with open(self.docker_compose_sftp, "r") as f:
-            config = yaml.safe_load(f)
-
-        if (
-            "services" in config
-            and "sftp" in config["services"]
-            and "volumes" in config["services"]["sftp"]
-        ):
-            # Filter out volumes containing the subscription_id
-            original_volumes = config["services"]["sftp"]["volumes"]
-            filtered_volumes = [
-                vol for vol in original_volumes if subscription_id not in vol
-            ]
-            config["services"]["sftp"]["volumes"] = filtered_volumes
-
-            # Write atomically
-            with tempfile.NamedTemporaryFile(
-                mode="w", delete=False, dir=self.sftp_path, suffix=".tmp"
-            ) as tmp_file:
-                yaml.dump(config, tmp_file, default_flow_style=False, indent=2)
-                tmp_path = tmp_file.name
-
-            shutil.move(tmp_path, self.docker_compose_sftp)
+        self._apply_compose_changes([], [subscription_id])
 
     def _remove_from_users_conf(self, subscription_id: str):
         """Remove user from users.conf"""
-        with open(self.users_conf, "r") as f:
-            lines = f.readlines()
+        self._apply_users_conf_changes({}, [subscription_id])
 
-        # Filter out lines containing the subscription_id
-        filtered_lines = [
-            line for line in lines if not line.startswith(f"{subscription_id}:")
-        ]
+    # Batched provisioning
 
-        # Write atomically
+    def _pending_ops(self) -> List[Tuple[pathlib.Path, Dict]]:
+        """Queued operations, oldest first"""
+        ops = []
+        for path in sorted(self.pending_path.glob("*.json")):
+            try:
+                with open(path) as f:
+                    ops.append((path, json.load(f)))
+            except (OSError, ValueError) as e:
+                self.logger.warning(f"Skipping unreadable SFTP op {path}: {e}")
+        return ops
+
+    def _queue_op(self, op: Dict):
+        """Persist one operation for the next flush"""
+        self.pending_path.mkdir(exist_ok=True)
+        name = f"{time.time_ns()}-{secrets.token_hex(4)}.json"
         with tempfile.NamedTemporaryFile(
-            mode="w", delete=False, dir=self.sftp_path, suffix=".tmp"
+            mode="w", delete=False, dir=self.pending_path, suffix=".tmp"
         ) as tmp_file:
-            tmp_file.writelines(filtered_lines)
+            json.dump(op, tmp_file)
             tmp_path = tmp_file.name
+        shutil.move(tmp_path, self.pending_path / name)
+
+    def queue_user_volume(self, game_type: str, subscription_id: str) -> ServerResult:
+        """
+        Queue a user and volume mapping for the next batched flush
+
+        The password is generated now so credentials can be returned right
+        away; the user becomes usable once the batch is applied. When users
+        can be added live there is nothing to batch and it is added at once.
+        """
+        if self._live_mode():
+            return self.add_user_volume(game_type, subscription_id)
+
+        if not subscription_id or not game_type:
+            return ServerResult(
+                action="sftp_update",
+                subscription_id=subscription_id,
+                status="failed",
+                error="Invalid subscription_id or game_type",
+            )
+
+        with self.lock, FileLock(str(self.provision_lock)):
+            if self._user_exists(subscription_id):
+                return ServerResult(
+                    action="sftp_update",
+                    subscription_id=subscription_id,
+                    status="already_exists",
+                )
+
+            password = username = None
+            promised = set()
+            for _, op in self._pending_ops():
+                if op["op"] == "add" and op.get("username"):
+                    promised.add(op["username"])
+                if op["subscription_id"] == subscription_id:
+                    password = op.get("password") if op["op"] == "add" else None
+                    username = op.get("username") if op["op"] == "add" else None
+            if password is None or username is None:
+                password = password or self._generate_secure_password()
+                # Unique among users and the adds queued before this one
+                username = self.registry.username_for(subscription_id, promised)
+                self._queue_op(
+                    {
+                        "op": "add",
+                        "game_type": game_type,
+                        "subscription_id": subscription_id,
+                        "password": password,
+                        "username": username,
+                    }
+                )
+
+        return ServerResult(
+            action="sftp_update",
+            subscription_id=subscription_id,
+            status="queued",
+            metrics={
+                "username": username,
+                "password": password,
+                "mount_path": mount_path(username),
+                "server_path": f"{SERVERS_ROOT}/{subscription_id}",
+            },
+        )
+
+    def queue_user_removal(self, subscription_id: str) -> ServerResult:
+        """Queue removal of a user for the next batched flush"""
+        if self._live_mode():
+            return self.remove_user_volume(subscription_id)
+
+        with self.lock, FileLock(str(self.provision_lock)):
+            self._queue_op({"op": "remove", "subscription_id": subscription_id})
+        return ServerResult(
+            action="sftp_remove",
+            subscription_id=subscription_id,
+            status="queued",
+        )
+
+    def flush_pending(self, min_interval: float = 0) -> ServerResult:
+        """
+        Apply every queued add and remove as one config transaction
+
+        Args:
+            min_interval: Minimum seconds between two SFTP restarts; a flush
+                inside that window is deferred
+
+        Returns:
+            ServerResult: Result of the batch, with counts in metrics
+        """
+        with self.lock, FileLock(str(self.provision_lock)):
+            ops = self._pending_ops()
+            if not ops:
+                return ServerResult(
+                    action="sftp_flush", subscription_id="", status="idle"
+                )
+
+            live = self._live_mode()
+            try:
+                last_restart = self.restart_marker.stat().st_mtime
+            except FileNotFoundError:
+                last_restart = 0
+            if not live and time.time() - last_restart < min_interval:
+                return ServerResult(
+                    action="sftp_flush",
+                    subscription_id="",
+                    status="deferred",
+                    metrics={"pending": len(ops)},
+                )
+
+            # Later ops win; an add followed by a remove cancels out
+            final: Dict[str, Dict] = {}
+            for _, op in ops:
+                final[op["subscription_id"]] = op
+            added = {
+                sub: op["password"]
+                for sub, op in final.items()
+                if op["op"] == "add" and not self._user_exists(sub)
+            }
+            removed = [sub for sub, op in final.items() if op["op"] == "remove"]
+            usernames = {
+                sub: final[sub]["username"]
+                for sub in added
+                if final[sub].get("username")
+            }
 
-        shutil.move(tmp_path, self.users_conf)
+            if (added or removed) and live:
+                compose_backup, users_backup = self._backup_config_files()
+                try:
+                    self._apply_live_changes(added, removed, usernames)
+                except Exception as e:
+                    self._restore_from_backup(compose_backup, users_backup)
+                    self.logger.error(f"Failed to apply SFTP batch: {e}")
+                    return ServerResult(
+                        action="sftp_flush",
+                        subscription_id="",
+                        status="failed",
+                        error=str(e),
+                    )
+                self._cleanup_old_backups()
+            elif added or removed:
+                compose_backup, users_backup = self._backup_config_files()
+                try:
+                    users = self._apply_users_conf_changes(added, removed, usernames)
+                    self._apply_compose_changes(
+                        {sub: user.username for sub, user in users.items()}, removed
+                    )
+                    restart_result = self._restart_sftp_server()
+                except Exception as e:
+                    self._restore_from_backup(compose_backup, users_backup)
+                    self.logger.error(f"Failed to apply SFTP batch: {e}")
+                    return ServerResult(
+                        action="sftp_flush",
+                        subscription_id="",
+                        status="failed",
+                        error=str(e),
+                    )
+                if restart_result.status != "running":
+                    self._restore_from_backup(compose_backup, users_backup)
+                    return restart_result
+                self.restart_marker.touch()
+                self._cleanup_old_backups()
+
+            for path, _ in ops:
+                path.unlink(missing_ok=True)
+
+        self.logger.info(
+            f"Applied SFTP batch: {len(added)} added, {len(removed)} removed"
+        )
+        return ServerResult(
+            action="sftp_flush",
+            subscription_id="",
+            status="completed",
+            metrics={"added": len(added), "removed": len(removed)},
+        )
+
+    def start_batch_flusher(self, interval: float) -> threading.Thread:
+        """Flush queued changes at most once every `interval` seconds"""
+
+        def run():
+            while not self._flusher_stop.wait(interval):
+                try:
+                    self.flush_pending(min_interval=interval)
+                except Exception as e:
+                    self.logger.error(f"SFTP batch flush failed: {e}")
+
+        self._flusher_stop.clear()
+        self._flusher = threading.Thread(
+            target=run, name="sftp-batch-flusher", daemon=True
+        )
+        self._flusher.start()
+        return self._flusher
+
+    def stop_batch_flusher(self) -> Optional[ServerResult]:
+        """Stop the flusher, waiting for a running flush, and apply what is left"""
+        if self._flusher is None:
+            return None
+        self._flusher_stop.set()
+        self._flusher.join()
+        self._flusher = None
+        return self.flush_pending()
@@ -0,0 +1,325 @@
+"""
+Indexed view of the SFTP users.conf shared by every manager process.
+
+The file stays in the atmoz/sftp format, one `user:pass:uid:gid:::subscription`
+line per user. It is loaded once into dicts keyed by username and by
+subscription and afterwards only the bytes appended since the last read are
+parsed, so lookups are O(1) however many users exist.
+
+Writes never rewrite the file:
+    add     appends the user's line
+    remove  turns the first byte of the user's line into '#', which atmoz and
+            init.sh skip, and appends a `#removed:<subscription>` tombstone so
+            other processes see the removal in their incremental read
+Once dead lines outnumber live ones (and exceed `compact_threshold`) the file
+is compacted into a fresh copy holding only live users.
+"""
+
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+from dataclasses import dataclass
+from typing import Container, Dict, Iterable, List, Optional, Tuple
+
+from filelock import FileLock
+
+logger = logging.getLogger("game-server-setup")
+
+TOMBSTONE = "#removed:"
+
+# First ids handed out on an empty file
+FIRST_UID = 1001
+FIRST_GID = 101
+
+# Usernames are the shortest prefix of the subscription id, at least this
+# long, that no other user has
+USERNAME_LENGTH = 4
+
+
+@dataclass
+class SFTPUser:
+    """One users.conf entry"""
+
+    username: str
+    password: str
+    uid: int
+    gid: int
+    subscription_id: str
+
+    @property
+    def entry(self) -> str:
+        """user:pass:uid:gid, the argument of atmoz's create-sftp-user"""
+        return f"{self.username}:{self.password}:{self.uid}:{self.gid}"
+
+    def line(self) -> str:
+        return f"{self.entry}:::{self.subscription_id}\n"
+
+
+def parse_line(line: str) -> Optional[SFTPUser]:
+    """SFTPUser of a users.conf line, None for comments and malformed lines"""
+    parts = line.strip().split(":")
+    if len(parts) < 4 or parts[0].startswith("#"):
+        return None
+    try:
+        uid, gid = int(parts[2]), int(parts[3])
+    except ValueError:
+        return None
+    # Entries written by hand may lack the trailing subscription field
+    subscription_id = parts[6] if len(parts) >= 7 and parts[6] else parts[0]
+    return SFTPUser(parts[0], parts[1], uid, gid, subscription_id)
+
+
+class SFTPUserRegistry:
+    """In-memory index of users.conf, kept in sync across processes"""
+
+    def __init__(
+        self,
+        users_conf: pathlib.Path,
+        lock_path: pathlib.Path,
+        compact_threshold: int = 256,
+    ):
+        self.users_conf = pathlib.Path(users_conf)
+        self.file_lock = FileLock(str(lock_path))
+        self.compact_threshold = compact_threshold
+        self._lock = threading.RLock()
+        self._by_subscription: Dict[str, SFTPUser] = {}
+        self._by_username: Dict[str, SFTPUser] = {}
+        # Byte offset of every live user's line, for in-place removal
+        self._offsets: Dict[str, int] = {}
+        self._max_ids: Optional[Tuple[int, int]] = None
+        self._dead_lines = 0
+        self._read_offset = 0
+        self._file_id: Tuple[int, int] = (-1, -1)
+        self._mtime_ns = -1
+
+    # Loading
+
+    def _reset(self):
+        self._by_subscription.clear()
+        self._by_username.clear()
+        self._offsets.clear()
+        self._max_ids = None
+        self._dead_lines = 0
+        self._read_offset = 0
+
+    def _refresh(self):
+        """Pick up changes made by this or any other process"""
+        try:
+            st = os.stat(self.users_conf)
+        except FileNotFoundError:
+            self._reset()
+            self._file_id = (-1, -1)
+            return
+        file_id = (st.st_dev, st.st_ino)
+        if file_id != self._file_id or st.st_size < self._read_offset:
+            # Replaced (compaction, restore) or truncated: read it all again
+            self._reset()
+        elif st.st_size == self._read_offset:
+            if st.st_mtime_ns == self._mtime_ns:
+                return
+            # Rewritten in place without growing, e.g. by hand
+            self._reset()
+        self._file_id = file_id
+        self._mtime_ns = st.st_mtime_ns
+        self._read_from(self._read_offset)
+
+    def _read_from(self, offset: int):
+        with open(self.users_conf, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        # A concurrent append may still be in flight; stop at the last newline
+        end = data.rfind(b"\n") + 1
+        for raw in data[:end].splitlines(keepends=True):
+            self._index_line(raw.decode(errors="replace"), offset)
+            offset += len(raw)
+        self._read_offset = offset
+
+    def _index_line(self, line: str, offset: int):
+        if line.startswith(TOMBSTONE):
+            self._drop(line[len(TOMBSTONE) :].strip())
+            self._dead_lines += 1
+            return
+        if line.startswith("#"):
+            # Removed in place; keep its ids out of circulation
+            self._dead_lines += 1
+            removed = parse_line(line[1:])
+            if removed is not None:
+                self._track_ids(removed)
+            return
+        user = parse_line(line)
+        if user is None:
+            return
+        previous = self._by_subscription.get(user.subscription_id)
+        if previous is not None:
+            # A later line for the same subscription wins
+            self._drop(user.subscription_id)
+            self._dead_lines += 1
+        self._by_subscription[user.subscription_id] = user
+        self._by_username[user.username] = user
+        self._offsets[user.subscription_id] = offset
+        self._track_ids(user)
+
+    def _track_ids(self, user: SFTPUser):
+        max_uid, max_gid = self._max_ids or (FIRST_UID - 1, FIRST_GID - 1)
+        self._max_ids = (max(max_uid, user.uid), max(max_gid, user.gid))
+
+    def _drop(self, subscription_id: str) -> Optional[SFTPUser]:
+        user = self._by_subscription.pop(subscription_id, None)
+        if user is not None:
+            self._offsets.pop(subscription_id, None)
+            if self._by_username.get(user.username) is user:
+                del self._by_username[user.username]
+        return user
+
+    # Lookups
+
+    def get(self, subscription_id: str) -> Optional[SFTPUser]:
+        with self._lock:
+            self._refresh()
+            return self._by_subscription.get(subscription_id)
+
+    def by_username(self, username: str) -> Optional[SFTPUser]:
+        with self._lock:
+            self._refresh()
+            return self._by_username.get(username)
+
+    def users(self) -> List[SFTPUser]:
+        with self._lock:
+            self._refresh()
+            return list(self._by_subscription.values())
+
+    def __contains__(self, subscription_id: str) -> bool:
+        return self.get(subscription_id) is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._by_subscription)
+
+    def _free_username(self, subscription_id: str, taken: Container[str]) -> str:
+        def free(name: str) -> bool:
+            return name not in self._by_username and name not in taken
+
+        for length in range(USERNAME_LENGTH, len(subscription_id) + 1):
+            if free(subscription_id[:length]):
+                return subscription_id[:length]
+        suffix = 2
+        while not free(f"{subscription_id}{suffix}"):
+            suffix += 1
+        return f"{subscription_id}{suffix}"
+
+    def username_for(self, subscription_id: str, taken: Container[str] = ()) -> str:
+        """Username of a subscription's user, or the one it would be given"""
+        with self._lock:
+            self._refresh()
+            user = self._by_subscription.get(subscription_id)
+            if user is not None:
+                return user.username
+            return self._free_username(subscription_id, taken)
+
+    def next_ids(self) -> Tuple[int, int]:
+        """Next free UID and GID, above every id still in the file"""
+        with self._lock:
+            self._refresh()
+            if self._max_ids is None:
+                return FIRST_UID, FIRST_GID
+            return self._max_ids[0] + 1, self._max_ids[1] + 1
+
+    # Writes
+
+    def add_many(
+        self, added: Dict[str, str], usernames: Optional[Dict[str, str]] = None
+    ) -> Dict[str, SFTPUser]:
+        """
+        Append users (subscription -> password), returns the new entries
+
+        usernames holds names promised earlier (queued adds); one that has
+        been taken since is replaced by a free one.
+        """
+        users = {}
+        with self._lock, self.file_lock:
+            self._refresh()
+            uid, gid = self.next_ids()
+            lines = []
+            taken = set()
+            for subscription_id, password in added.items():
+                if subscription_id in self._by_subscription:
+                    continue
+                username = (usernames or {}).get(subscription_id)
+                if not username or username in self._by_username or username in taken:
+                    username = self._free_username(subscription_id, taken)
+                taken.add(username)
+                user = SFTPUser(username, password, uid, gid, subscription_id)
+                users[subscription_id] = user
+                lines.append(user.line())
+                uid, gid = uid + 1, gid + 1
+            if lines:
+                self._append("".join(lines))
+        return users
+
+    def remove_many(self, subscription_ids: Iterable[str]) -> List[SFTPUser]:
+        """Comment out users in place and record tombstones"""
+        removed = []
+        with self._lock, self.file_lock:
+            self._refresh()
+            offsets = {
+                sub: self._offsets[sub]
+                for sub in subscription_ids
+                if sub in self._by_subscription
+            }
+            if not offsets:
+                return removed
+            with open(self.users_conf, "r+b") as f:
+                for offset in offsets.values():
+                    f.seek(offset)
+                    f.write(b"#")
+            removed = [self._by_subscription[sub] for sub in offsets]
+            self._append("".join(f"{TOMBSTONE}{sub}\n" for sub in offsets))
+            live = len(self._by_subscription)
+            if self._dead_lines > max(self.compact_threshold, live):
+                self._compact()
+        return removed
+
+    def _append(self, text: str):
+        if os.path.getsize(self.users_conf) > self._read_offset:
+            # Last line was written without a newline
+            text = "\n" + text
+        with open(self.users_conf, "a") as f:
+            f.write(text)
+        self._refresh()
+
+    def _compact(self):
+        """Rewrite the file with live users only; caller holds both locks"""
+        tmp_path = ""
+        try:
+            with tempfile.NamedTemporaryFile(
+                mode="w", delete=False, dir=self.users_conf.parent, suffix=".tmp"
+            ) as tmp_file:
+                for subscription_id in sorted(
+                    self._offsets, key=self._offsets.__getitem__
+                ):
+                    tmp_file.write(self._by_subscription[subscription_id].line())
+                tmp_path = tmp_file.name
+            shutil.copymode(self.users_conf, tmp_path)
+            os.replace(tmp_path, self.users_conf)
+        except OSError as e:
+            if tmp_path and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            logger.warning(f"Failed to compact {self.users_conf}: {e}")
+            return
+        logger.info(f"Compacted {self.users_conf}: {len(self._offsets)} users")
+        self._refresh()
+
+    def restore(self, backup: pathlib.Path):
+        """Replace users.conf with a backup copy"""
+        with self._lock, self.file_lock:
+            with tempfile.NamedTemporaryFile(
+                delete=False, dir=self.users_conf.parent, suffix=".tmp"
+            ) as tmp_file:
+                tmp_path = tmp_file.name
+            shutil.copy2(backup, tmp_path)
+            os.replace(tmp_path, self.users_conf)
+            self._refresh()
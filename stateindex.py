@@ -0,0 +1,188 @@
+"""
+Per-subscription state index.
+
+One SQLite row per subscription records what actions used to rediscover
+from compose file names and Docker on every run: game type, ports, compose
+path and hash, container id and IP, resource limits, last known status and
+last backup. Actions update it in a single transaction when they finish;
+the manager reconciles it against the compose files and Docker on start-up,
+so listings and lookups are index reads.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger("game-server-setup")
+
+COLUMNS = (
+    "game_type",
+    "ports",
+    "compose_file",
+    "compose_hash",
+    "env_hash",
+    "container_id",
+    "container_ip",
+    "memory",
+    "cpu",
+    "status",
+    "last_backup",
+    "last_backup_id",
+    "updated",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS subscriptions (
+    subscription_id TEXT PRIMARY KEY,
+    game_type TEXT,
+    ports TEXT,
+    compose_file TEXT,
+    compose_hash TEXT,
+    env_hash TEXT,
+    container_id TEXT,
+    container_ip TEXT,
+    memory TEXT,
+    cpu REAL,
+    status TEXT,
+    last_backup REAL,
+    last_backup_id TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS subscriptions_game ON subscriptions (game_type);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+# Columns added after the first release, created on older databases
+ADDED_COLUMNS = {"env_hash": "TEXT"}
+
+
+class StateIndex:
+    """SQLite index of subscription state keyed by subscription id"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db = sqlite3.connect(
+            db_path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        existing = {
+            row["name"] for row in self._db.execute("PRAGMA table_info(subscriptions)")
+        }
+        for name, kind in ADDED_COLUMNS.items():
+            if name not in existing:
+                self._db.execute(f"ALTER TABLE subscriptions ADD COLUMN {name} {kind}")
+
+    @staticmethod
+    def _decode(row: sqlite3.Row) -> Dict:
+        entry = dict(row)
+        entry["ports"] = json.loads(entry["ports"]) if entry["ports"] else None
+        return entry
+
+    def _upsert(self, subscription_id: str, fields: Dict):
+        """Set the given columns, leaving the others as they are"""
+        unknown = set(fields) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown state fields: {sorted(unknown)}")
+        fields = dict(fields, updated=time.time())
+        if "ports" in fields and fields["ports"] is not None:
+            fields["ports"] = json.dumps(fields["ports"])
+        names = list(fields)
+        self._db.execute(
+            f"INSERT INTO subscriptions (subscription_id, {', '.join(names)}) "
+            f"VALUES (?, {', '.join('?' * len(names))}) "
+            f"ON CONFLICT (subscription_id) DO UPDATE SET "
+            f"{', '.join(f'{n} = excluded.{n}' for n in names)}",
+            [subscription_id] + [fields[n] for n in names],
+        )
+
+    # Reads
+
+    def get(self, subscription_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM subscriptions WHERE subscription_id = ?",
+                (subscription_id,),
+            ).fetchone()
+        return self._decode(row) if row is not None else None
+
+    def list(self, game_type: Optional[str] = None) -> List[Dict]:
+        """Every indexed subscription, optionally of one game type"""
+        query = "SELECT * FROM subscriptions"
+        params: tuple = ()
+        if game_type:
+            query += " WHERE game_type = ?"
+            params = (game_type,)
+        with self._lock:
+            rows = self._db.execute(query + " ORDER BY subscription_id", params)
+            return [self._decode(row) for row in rows.fetchall()]
+
+    def reconciled_at(self) -> Optional[float]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM meta WHERE key = 'reconciled'"
+            ).fetchone()
+        return float(row["value"]) if row is not None else None
+
+    # Writes
+
+    def update(self, subscription_id: str, **fields):
+        """Set columns of one subscription, creating its row if needed"""
+        self.update_many({subscription_id: fields})
+
+    def update_many(self, updates: Dict[str, Dict]):
+        """Set columns of several subscriptions in one transaction"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for subscription_id, fields in updates.items():
+                    self._upsert(subscription_id, fields)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def reconcile(self, observed: Dict[str, Dict]) -> Dict[str, List[str]]:
+        """
+        Replace the index's view with what exists on disk and in Docker
+
+        observed maps every existing subscription to the columns found for
+        it; rows of subscriptions missing from it are dropped, columns not
+        observed (limits, last backup) are kept.
+        """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                known = {
+                    row["subscription_id"]
+                    for row in self._db.execute(
+                        "SELECT subscription_id FROM subscriptions"
+                    )
+                }
+                removed = sorted(known - set(observed))
+                self._db.executemany(
+                    "DELETE FROM subscriptions WHERE subscription_id = ?",
+                    [(sub,) for sub in removed],
+                )
+                for subscription_id, fields in observed.items():
+                    self._upsert(subscription_id, fields)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) "
+                    "VALUES ('reconciled', ?)",
+                    (str(time.time()),),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        added = sorted(set(observed) - known)
+        if added or removed:
+            logger.info(f"State index reconciled: added {added}, removed {removed}")
+        return {"added": added, "removed": removed}
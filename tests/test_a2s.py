@@ -0,0 +1,168 @@
+import asyncio
+import socket
+import struct
+import threading
+
+import pytest
+
+from a2s import (
+    HEADER,
+    INFO_REQUEST,
+    A2SError,
+    is_info_request,
+    parse_info,
+    player_counts,
+    probe_many,
+    query_info,
+    wait_ready,
+)
+
+CHALLENGE = b"\x0a\x0b\x0c\x0d"
+
+
+def info_response(players: int = 3, max_players: int = 10) -> bytes:
+    fields = (b"My server", b"", b"valheim", b"Valheim")
+    strings = b"".join(field + b"\x00" for field in fields)
+    return (
+        HEADER
+        + b"I\x11"
+        + strings
+        + struct.pack("<hBBB", 0, players, max_players, 0)
+        + b"d"
+    )
+
+
+class Responder(threading.Thread):
+    """
+    Local A2S server on UDP: answers an unchallenged query with a
+    challenge, ignores the first `silent` queries, then answers
+    """
+
+    def __init__(self, silent: int = 0, challenge: bool = True, players: int = 3):
+        super().__init__(daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.silent = silent
+        self.challenge = challenge
+        self.players = players
+        self.requests = []
+
+    def run(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(1400)
+            except OSError:
+                return
+            self.requests.append(data)
+            if not is_info_request(data) or self.silent > 0:
+                self.silent -= 1
+                continue
+            if self.challenge and data != INFO_REQUEST + CHALLENGE:
+                self.sock.sendto(HEADER + b"A" + CHALLENGE, addr)
+            else:
+                self.sock.sendto(info_response(self.players), addr)
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def responder():
+    servers = []
+
+    def start(**kwargs):
+        server = Responder(**kwargs)
+        server.start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+def free_udp_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_parse_info():
+    info = parse_info(info_response(players=4, max_players=64))
+    assert info["name"] == "My server"
+    assert info["folder"] == "valheim"
+    assert (info["players"], info["max_players"]) == (4, 64)
+
+
+@pytest.mark.parametrize(
+    "packet", [b"", b"garbage", HEADER + b"A1234", info_response()[:12]]
+)
+def test_parse_info_rejects_other_packets(packet):
+    with pytest.raises(A2SError):
+        parse_info(packet)
+
+
+def test_is_info_request():
+    assert is_info_request(INFO_REQUEST)
+    assert is_info_request(INFO_REQUEST + CHALLENGE)
+    assert not is_info_request(HEADER + b"U" + CHALLENGE)
+    assert not is_info_request(b"\x16\x03\x01")
+
+
+def test_query_follows_the_challenge(responder):
+    server = responder()
+    info = asyncio.run(query_info("127.0.0.1", server.port))
+    assert info["players"] == 3
+    assert server.requests == [INFO_REQUEST, INFO_REQUEST + CHALLENGE]
+
+
+def test_query_without_challenge(responder):
+    server = responder(challenge=False)
+    assert asyncio.run(query_info("127.0.0.1", server.port))["max_players"] == 10
+    assert server.requests == [INFO_REQUEST]
+
+
+def test_query_times_out(responder):
+    server = responder(silent=10)
+    with pytest.raises(A2SError):
+        asyncio.run(query_info("127.0.0.1", server.port, timeout=0.2))
+
+
+def test_wait_ready_retries_until_the_server_answers(responder):
+    server = responder(silent=2)
+    result = asyncio.run(
+        wait_ready(
+            "127.0.0.1",
+            server.port,
+            timeout=5,
+            query_timeout=0.2,
+            initial_delay=0.05,
+        )
+    )
+    assert result["ready"] is True
+    assert result["attempts"] == 3
+    assert result["players"] == 3
+
+
+def test_wait_ready_gives_up():
+    result = asyncio.run(
+        wait_ready(
+            "127.0.0.1",
+            free_udp_port(),
+            timeout=0.5,
+            query_timeout=0.1,
+            initial_delay=0.05,
+        )
+    )
+    assert result["ready"] is False
+    assert result["attempts"] >= 2
+
+
+def test_probe_many_and_player_counts(responder):
+    up = responder(players=5)
+    targets = {"up": ("127.0.0.1", up.port), "down": ("127.0.0.1", free_udp_port())}
+    results = probe_many(targets, timeout=0.5, query_timeout=0.1, initial_delay=0.05)
+    assert results["up"]["ready"] is True
+    assert results["down"]["ready"] is False
+    assert player_counts(targets, query_timeout=0.2) == {"up": 5}
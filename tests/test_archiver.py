@@ -0,0 +1,96 @@
+import gzip
+import io
+import os
+import random
+import tarfile
+
+import pytest
+
+import archiver
+from archiver import (
+    ArchiveError,
+    ParallelCompressor,
+    block_compressor,
+    extract_archive,
+    write_archive,
+)
+
+
+@pytest.fixture
+def source(tmp_path):
+    root = tmp_path / "server"
+    (root / "saves").mkdir(parents=True)
+    (root / "saves" / "world.db").write_bytes(random.Random(1).randbytes(300_000))
+    (root / "saves" / "world.fwl").write_bytes(b"meta" * 1000)
+    (root / "server.log").write_text("log\n")
+    return root
+
+
+def test_blocks_are_independent_gzip_members():
+    out = io.BytesIO()
+    stream = ParallelCompressor(out, block_compressor("gzip", 6), 4, block_size=1000)
+    data = random.Random(2).randbytes(10_500)
+    for offset in range(0, len(data), 777):
+        stream.write(data[offset : offset + 777])
+    stream.close()
+    assert stream.bytes_in == len(data)
+    assert stream.bytes_out == len(out.getvalue())
+    # Eleven members read back in order as one stream
+    assert out.getvalue().count(b"\x1f\x8b\x08") >= 11
+    assert gzip.decompress(out.getvalue()) == data
+
+
+def test_archive_roundtrip_with_excludes(source, tmp_path):
+    target = tmp_path / "backup.tar.gz"
+    metrics = write_archive(
+        str(source), str(target), exclude=["*.log"], workers=3, arcname="live"
+    )
+    assert metrics["size"] == os.path.getsize(target)
+    with tarfile.open(target) as tar:
+        names = set(tar.getnames())
+    assert "live/saves/world.db" in names
+    assert "live/server.log" not in names
+
+    restored = tmp_path / "restored"
+    result = extract_archive(str(target), str(restored), strip="live")
+    assert result["files"] == 2
+    for name in ("world.db", "world.fwl"):
+        assert (restored / "saves" / name).read_bytes() == (
+            source / "saves" / name
+        ).read_bytes()
+
+
+def test_archive_inside_its_source_leaves_no_temp_file(source):
+    target = source / "backup.tar.gz"
+    write_archive(str(source), str(target), exclude=["backup-*"])
+    assert [name for name in os.listdir(source) if name.endswith(".tmp")] == []
+    with tarfile.open(target) as tar:
+        assert not any(name.endswith(".tmp") for name in tar.getnames())
+
+
+def test_failed_archive_removes_temp_file(source, tmp_path, monkeypatch):
+    def broken(codec, level):
+        def compress(block):
+            raise OSError("disk full")
+
+        return compress
+
+    monkeypatch.setattr(archiver, "block_compressor", broken)
+    with pytest.raises(ArchiveError):
+        write_archive(str(source), str(tmp_path / "backup.tar.gz"))
+    assert os.listdir(tmp_path) == ["server"]
+
+
+def test_unknown_codec():
+    with pytest.raises(ArchiveError):
+        block_compressor("lz4", 1)
+
+
+def test_corrupt_member_fails_extraction(source, tmp_path):
+    target = tmp_path / "backup.tar.gz"
+    write_archive(str(source), str(target))
+    data = bytearray(target.read_bytes())
+    data[len(data) // 2] ^= 0xFF
+    target.write_bytes(bytes(data))
+    with pytest.raises(ArchiveError):
+        extract_archive(str(target), str(tmp_path / "restored"))
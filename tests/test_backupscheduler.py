@@ -0,0 +1,155 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from backupscheduler import BackupScheduler, schedule_offset
+from customdataclasses import ServerResult
+from offload import TokenBucket
+
+INTERVAL = 3600
+NEVER_QUIET = (0, 0)
+ALWAYS_QUIET = (0, 24)
+
+
+class FakeManager:
+    def __init__(self, root, subscriptions):
+        self.backup_store = SimpleNamespace(root=str(root))
+        self.subscriptions = subscriptions
+        self.status = "completed"
+        self.reported = []
+
+    def list_subscriptions(self):
+        return [("valheim", sub, f"{sub}.yml") for sub in self.subscriptions]
+
+    def backup(self, subscription_id, game_type, throttle=None):
+        return ServerResult(
+            action="backup", subscription_id=subscription_id, status=self.status
+        )
+
+    def record(self, result, game_type):
+        pass
+
+    def report(self, result):
+        self.reported.append(result)
+
+
+class RecordingExecutor:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, *args):
+        self.submitted.append(args[1])
+
+    def shutdown(self, **kwargs):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def server_dirs_exist(monkeypatch):
+    monkeypatch.setattr("backupscheduler.os.path.isdir", lambda path: True)
+
+
+def make_scheduler(tmp_path, subscriptions, **kwargs):
+    manager = FakeManager(tmp_path, subscriptions)
+    kwargs.setdefault("quiet_hours", NEVER_QUIET)
+    scheduler = BackupScheduler(
+        manager, str(tmp_path / "schedule.json"), interval=INTERVAL, **kwargs
+    )
+    scheduler.executor.shutdown()
+    scheduler.executor = RecordingExecutor()
+    return scheduler
+
+
+def seen_long_ago(scheduler, subscriptions, **entry):
+    for sub in subscriptions:
+        scheduler._state[sub] = {"first_seen": 0, **entry}
+
+
+def test_offsets_are_stable_and_spread():
+    offsets = {schedule_offset(f"sub-{i}", INTERVAL) for i in range(100)}
+    assert schedule_offset("sub-1", INTERVAL) == schedule_offset("sub-1", INTERVAL)
+    assert all(0 <= offset < INTERVAL for offset in offsets)
+    assert len(offsets) > 90
+
+
+def test_slot_starts_at_the_subscription_offset(tmp_path):
+    scheduler = make_scheduler(tmp_path, [])
+    now = 1_000_000.0
+    slot = scheduler.due_since("sub", now)
+    assert now - INTERVAL < slot <= now
+    assert slot % INTERVAL == schedule_offset("sub", INTERVAL)
+
+
+def test_new_subscription_waits_for_its_first_slot(tmp_path):
+    scheduler = make_scheduler(tmp_path, ["sub"])
+    now = 1_000_000.0
+    scheduler.schedule_once(now)
+    assert scheduler.executor.submitted == []
+    scheduler.schedule_once(now + INTERVAL)
+    assert scheduler.executor.submitted == ["sub"]
+    # Running backups are not scheduled again
+    scheduler.schedule_once(now + 2 * INTERVAL)
+    assert scheduler.executor.submitted == ["sub"]
+
+
+def test_fleet_and_disk_caps(tmp_path):
+    subs = [f"sub-{i}" for i in range(5)]
+    scheduler = make_scheduler(tmp_path, subs, max_concurrent=3, per_disk=2)
+    seen_long_ago(scheduler, subs)
+    scheduler.schedule_once(1_000_000.0)
+    # One store, so the per-disk cap binds before the fleet cap
+    assert len(scheduler.executor.submitted) == 2
+    assert scheduler.running() == set(scheduler.executor.submitted)
+
+
+def test_large_backups_wait_for_quiet_hours(tmp_path):
+    subs = ["small", "large", "stale"]
+    scheduler = make_scheduler(tmp_path, subs, max_concurrent=3, per_disk=3)
+    now = 1_000_000.0
+    seen_long_ago(scheduler, subs, last_success=now - 60)
+    scheduler._state["large"]["duration"] = 600
+    scheduler._state["stale"].update(duration=600, last_success=0)
+    scheduler.schedule_once(now)
+    assert sorted(scheduler.executor.submitted) == ["small", "stale"]
+
+
+def test_quiet_hours_run_longest_first(tmp_path):
+    subs = ["short", "long", "medium"]
+    scheduler = make_scheduler(
+        tmp_path, subs, quiet_hours=ALWAYS_QUIET, max_concurrent=3, per_disk=3
+    )
+    seen_long_ago(scheduler, subs)
+    for sub, duration in (("short", 1), ("long", 900), ("medium", 60)):
+        scheduler._state[sub]["duration"] = duration
+    scheduler.schedule_once(1_000_000.0)
+    assert scheduler.executor.submitted == ["long", "medium", "short"]
+
+
+def test_run_tracks_duration_and_frees_the_slot(tmp_path):
+    scheduler = make_scheduler(tmp_path, ["sub"])
+    scheduler._running["sub"] = None
+    scheduler._state["sub"] = {"duration": 100.0}
+    scheduler._run_backup("valheim", "sub")
+    entry = scheduler.state()["sub"]
+    assert scheduler.running() == set()
+    assert entry["status"] == "completed"
+    assert entry["duration"] == pytest.approx(70.0, abs=0.1)
+    assert len(scheduler.manager.reported) == 1
+
+    scheduler.manager.status = "failed"
+    scheduler._run_backup("valheim", "sub")
+    after = make_scheduler(tmp_path, ["sub"]).state()["sub"]
+    assert after["status"] == "failed"
+    assert after["last_success"] == entry["last_success"]
+    assert after["duration"] == entry["duration"]
+
+
+def test_token_bucket_caps_the_rate():
+    bucket = TokenBucket(rate=1_000_000, burst=100_000)
+    started = time.monotonic()
+    for _ in range(4):
+        bucket.consume(100_000)
+    elapsed = time.monotonic() - started
+    # The burst is free, the other 300 KB take 0.3s
+    assert 0.25 < elapsed < 1.0
@@ -0,0 +1,173 @@
+import io
+import os
+import random
+
+import pytest
+
+from backupstore import (
+    MAX_CHUNK,
+    MIN_CHUNK,
+    BackupError,
+    BackupStore,
+    RetentionPolicy,
+    chunk_boundaries,
+    iter_chunks,
+)
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+def random_bytes(size: int, seed: int = 1) -> bytes:
+    return random.Random(seed).randbytes(size)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BackupStore(str(tmp_path / "store"), workers=2)
+
+
+@pytest.fixture
+def source(tmp_path):
+    root = tmp_path / "server"
+    (root / "saves").mkdir(parents=True)
+    (root / "saves" / "world.db").write_bytes(random_bytes(3 * MAX_CHUNK))
+    (root / "saves" / "world.fwl").write_bytes(b"meta")
+    (root / "saves" / "world.db.new").write_bytes(b"partial")
+    return root
+
+
+def backup_at(monkeypatch, store, timestamp, source, **kwargs):
+    monkeypatch.setattr("backupstore.time.time", lambda: timestamp)
+    return store.backup("sub", str(source), **kwargs)
+
+
+def test_chunks_cover_data_within_size_bounds():
+    data = random_bytes(2 * 1024 * 1024)
+    cuts = list(chunk_boundaries(data))
+    assert cuts[0][0] == 0 and cuts[-1][1] == len(data)
+    assert all(end == start for (_, end), (start, _) in zip(cuts, cuts[1:]))
+    assert all(MIN_CHUNK < end - start <= MAX_CHUNK for start, end in cuts[:-1])
+
+
+def test_chunk_cuts_follow_content_not_offsets():
+    data = random_bytes(1024 * 1024)
+    edited = b"x" * 100 + data
+    cuts = [data[s:e] for s, e in chunk_boundaries(data)]
+    shifted = [edited[s:e] for s, e in chunk_boundaries(edited)]
+    # Only the chunk holding the insertion changes
+    assert len(cuts) > 2
+    assert shifted[1:] == cuts[1:]
+
+
+@pytest.mark.parametrize("read_size", [4096, MIN_CHUNK + 1, MAX_CHUNK, 10**6])
+def test_iter_chunks_matches_whole_content_cuts(read_size):
+    data = random_bytes(3 * 1024 * 1024 + 123)
+    expected = [data[s:e] for s, e in chunk_boundaries(data)]
+    assert list(iter_chunks(io.BytesIO(data), read_size)) == expected
+
+
+def test_iter_chunks_of_empty_file():
+    assert list(iter_chunks(io.BytesIO(b""))) == []
+
+
+def test_retention_keeps_newest_per_period():
+    now = 100 * DAY
+    policy = RetentionPolicy(hourly=2, daily=2, weekly=1)
+    timestamps = [now - i * HOUR for i in range(72)]
+    kept = policy.keep(timestamps)
+    # Two newest hours, plus the newest of the previous day
+    assert kept == {now, now - HOUR, now - (now % DAY) - HOUR}
+    assert policy.keep([]) == set()
+
+
+def test_backup_and_restore_roundtrip(store, source, tmp_path):
+    manifest = store.backup("sub", str(source), ["saves"], exclude=["*.new"])
+    assert manifest["file_count"] == 2
+    assert manifest["files_reused"] == 0
+    assert manifest["bytes_total"] == 3 * MAX_CHUNK + 4
+
+    target = tmp_path / "restored"
+    result = store.restore("sub", manifest["id"], str(target))
+    assert result["files"] == 2
+    for name in ("world.db", "world.fwl"):
+        original = source / "saves" / name
+        restored = target / "saves" / name
+        assert restored.read_bytes() == original.read_bytes()
+        assert os.stat(restored).st_mtime_ns == os.stat(original).st_mtime_ns
+    assert not (target / "saves" / "world.db.new").exists()
+
+
+def test_unchanged_files_are_reused_and_edits_dedup(
+    monkeypatch, store, source
+):
+    first = backup_at(monkeypatch, store, 1000.0, source)
+    second = backup_at(monkeypatch, store, 2000.0, source)
+    assert second["files_reused"] == second["file_count"]
+    assert second["bytes_read"] == 0
+
+    world = source / "saves" / "world.db"
+    data = bytearray(world.read_bytes())
+    data[-10:] = b"0123456789"
+    world.write_bytes(bytes(data))
+    third = backup_at(monkeypatch, store, 3000.0, source)
+    assert third["bytes_read"] == len(data)
+    assert 0 < third["chunks_new"] < third["chunks_total"]
+    assert first["id"] != second["id"] != third["id"]
+
+
+def test_find_backup_by_id_and_time(monkeypatch, store, source):
+    first = backup_at(monkeypatch, store, 1000.0, source)
+    second = backup_at(monkeypatch, store, 2000.0, source)
+    assert store.find_backup("sub") == second["id"]
+    assert store.find_backup("sub", first["id"]) == first["id"]
+    assert store.find_backup("sub", "1500") == first["id"]
+    assert store.find_backup("sub", "1970-01-01T00:40:00") == second["id"]
+    with pytest.raises(BackupError):
+        store.find_backup("sub", "999")
+
+
+def test_prune_then_gc_drops_only_unreferenced_chunks(
+    monkeypatch, store, source, tmp_path
+):
+    store.policy = RetentionPolicy(hourly=1, daily=0, weekly=0)
+    world = source / "saves" / "world.db"
+    old = backup_at(monkeypatch, store, 10 * HOUR, source)
+    world.write_bytes(random_bytes(3 * MAX_CHUNK, seed=2))
+    protected = backup_at(monkeypatch, store, 11 * HOUR, source)
+    world.write_bytes(random_bytes(3 * MAX_CHUNK, seed=3))
+    newest = backup_at(monkeypatch, store, 12 * HOUR, source)
+
+    assert store.prune("sub", protected=[protected["id"]]) == [old["id"]]
+    assert [b["id"] for b in store.list_backups("sub")] == [
+        protected["id"],
+        newest["id"],
+    ]
+    assert store.gc()["chunks_removed"] > 0
+    assert store.gc()["chunks_removed"] == 0
+    for backup in (protected, newest):
+        store.restore("sub", backup["id"], str(tmp_path / backup["id"]))
+
+
+def test_gc_keeps_everything_when_a_manifest_is_unreadable(store, source):
+    manifest = store.backup("sub", str(source))
+    with open(store.manifest_path("sub", "broken"), "w") as f:
+        f.write("{")
+    os.unlink(store.manifest_path("sub", manifest["id"]))
+    assert store.gc() == {"chunks_removed": 0, "bytes_freed": 0}
+
+
+def test_corrupt_chunk_fails_restore(store, source, tmp_path):
+    manifest = store.backup("sub", str(source))
+    digest = store.load_manifest("sub", manifest["id"])["files"][0]["chunks"][0]
+    with open(store.chunk_path(digest), "wb") as f:
+        f.write(b"garbage")
+    with pytest.raises(BackupError):
+        store.restore("sub", manifest["id"], str(tmp_path / "restored"))
+
+
+def test_throttle_sees_every_byte_read(store, source):
+    read = []
+    manifest = store.backup("sub", str(source), throttle=read.append)
+    assert sum(read) == manifest["bytes_read"] == manifest["bytes_total"]
+    assert max(read) <= MAX_CHUNK
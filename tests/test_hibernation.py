@@ -0,0 +1,98 @@
+import socket
+import threading
+
+import pytest
+
+from a2s import info_request
+from hibernation import WakeListener, log_players
+from ValheimHandler import ValheimHandler
+
+STEAM_CHALLENGE = bytes([32]) + bytes(511)
+
+
+@pytest.fixture
+def listener():
+    woken = []
+    event = threading.Event()
+
+    def wake(subscription_id):
+        woken.append(subscription_id)
+        event.set()
+
+    listener = WakeListener(wake)
+    listener.woken = woken
+    listener.event = event
+    listener.start()
+    yield listener
+    listener.stop()
+
+
+def free_udp_ports(count: int):
+    socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(count)]
+    for sock in socks:
+        sock.bind(("127.0.0.1", 0))
+    ports = [sock.getsockname()[1] for sock in socks]
+    for sock in socks:
+        sock.close()
+    return ports
+
+
+def send(port: int, data: bytes):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.sendto(data, ("127.0.0.1", port))
+
+
+@pytest.mark.parametrize(
+    "index, packet, wakes",
+    [
+        (0, STEAM_CHALLENGE, True),
+        (0, bytes([34]) + bytes(600), True),
+        (0, bytes([32]) + bytes(100), False),
+        (0, info_request(), False),
+        (1, info_request(), True),
+        (1, info_request(b"\x01\x02\x03\x04"), True),
+        (1, STEAM_CHALLENGE, False),
+        (1, b"\x00" * 64, False),
+    ],
+)
+def test_valheim_wake_packets(index, packet, wakes):
+    assert ValheimHandler().is_wake_packet(index, packet) is wakes
+
+
+def test_stray_packets_do_not_wake(listener):
+    game, query = free_udp_ports(2)
+    listener.listen("sub", [game, query], ValheimHandler().is_wake_packet)
+    send(game, b"GET / HTTP/1.1\r\n\r\n")
+    send(query, b"\x00" * 64)
+    assert not listener.event.wait(0.3)
+    assert listener.listening() == ["sub"]
+
+    send(query, info_request())
+    assert listener.event.wait(5)
+    assert listener.woken == ["sub"]
+    assert listener.listening() == []
+
+
+def test_wake_frees_the_ports(listener):
+    game, query = free_udp_ports(2)
+    listener.listen("sub", [game, query], ValheimHandler().is_wake_packet)
+    send(game, STEAM_CHALLENGE)
+    assert listener.event.wait(5)
+    # The game server can bind them again
+    listener.listen("sub", [game, query], ValheimHandler().is_wake_packet)
+    assert listener.release("sub")
+
+
+def test_log_players(tmp_path):
+    log = tmp_path / "valheim.log"
+    log.write_text(
+        "06/19/2025 10:00:00: Got connection SteamID 1\n"
+        "06/19/2025 10:01:00: Got connection SteamID 2\n"
+        "06/19/2025 10:05:00: Closing socket 1\n"
+    )
+    players, last_activity = log_players(str(log))
+    assert players == 1
+    assert last_activity is not None
+    with open(log, "a") as f:
+        f.write("06/19/2025 10:05:10: Connections 0 ZDOS:130588  sent:0 recv:422\n")
+    assert log_players(str(log))[0] == 0
@@ -0,0 +1,203 @@
+import hashlib
+import random
+import threading
+
+import pytest
+
+from backupstore import BackupStore
+from offload import MIN_PART_SIZE, OffloadError, Offloader, OffloadQueue
+
+
+class FakeS3:
+    """In-memory bucket with the calls Offloader makes"""
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.puts = []
+        self.fail_parts = set()
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = bytes(Body)
+        self.puts.append(Key)
+
+    def head_object(self, Bucket, Key):
+        return {"ContentLength": len(self.objects[Key]), "ETag": "etag"}
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber in self.fail_parts:
+            self.fail_parts.discard(PartNumber)
+            raise OSError("connection reset")
+        etag = hashlib.md5(Body).hexdigest()
+        self.uploads[UploadId][PartNumber] = (etag, bytes(Body))
+        return {"ETag": etag}
+
+    def list_parts(self, Bucket, Key, UploadId):
+        parts = self.uploads[UploadId]
+        return {
+            "Parts": [{"PartNumber": n, "ETag": e} for n, (e, _) in parts.items()],
+            "IsTruncated": False,
+        }
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[Key] = b"".join(
+            parts[p["PartNumber"]][1] for p in MultipartUpload["Parts"]
+        )
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+
+@pytest.fixture
+def s3():
+    return FakeS3()
+
+
+@pytest.fixture
+def offloader(tmp_path, s3):
+    return Offloader(s3, "bucket", str(tmp_path / "offload.json"), prefix="host/")
+
+
+def test_queue_runs_each_item_once_in_order():
+    ran = []
+    started = threading.Event()
+    gate = threading.Event()
+
+    def offload(subscription_id, kind):
+        started.set()
+        gate.wait()
+        ran.append((subscription_id, kind))
+
+    queue = OffloadQueue(offload)
+    queue.put("first", "dedup")
+    assert started.wait(5)
+    for item in [("a", "dedup"), ("b", "archive"), ("a", "dedup"), ("b", "archive")]:
+        queue.put(*item)
+    assert queue.pending() == [("a", "dedup"), ("b", "archive")]
+    gate.set()
+    assert queue.wait_idle(5)
+    assert ran == [("first", "dedup"), ("a", "dedup"), ("b", "archive")]
+    assert queue.pending() == []
+    queue.stop()
+
+
+def test_queue_survives_failing_offloads():
+    ran = []
+
+    def offload(subscription_id, kind):
+        ran.append(subscription_id)
+        if subscription_id == "bad":
+            raise OffloadError("endpoint down")
+
+    queue = OffloadQueue(offload)
+    queue.put("bad", "dedup")
+    queue.put("good", "dedup")
+    assert queue.wait_idle(5)
+    assert ran == ["bad", "good"]
+    queue.stop()
+
+
+def test_stop_finishes_current_and_drops_the_rest():
+    started = threading.Event()
+    release = threading.Event()
+    ran = []
+
+    def offload(subscription_id, kind):
+        started.set()
+        release.wait()
+        ran.append(subscription_id)
+
+    queue = OffloadQueue(offload)
+    queue.put("first", "dedup")
+    started.wait(5)
+    queue.put("second", "dedup")
+    stopper = threading.Thread(target=queue.stop)
+    stopper.start()
+    release.set()
+    stopper.join(5)
+    assert ran == ["first"]
+    # Nothing is queued once stopped
+    queue.put("third", "dedup")
+    assert ("third", "dedup") not in queue.pending()
+
+
+def test_stop_before_any_put():
+    OffloadQueue(lambda subscription_id, kind: None).stop()
+
+
+def test_small_file_is_put_and_confirmed_once(offloader, s3, tmp_path):
+    path = tmp_path / "manifest.json"
+    path.write_bytes(b"{}")
+    assert offloader.upload_file(str(path), "manifests/sub/a.json")["bytes"] == 2
+    assert offloader.is_offloaded("host/manifests/sub/a.json")
+    assert offloader.upload_file(str(path), "manifests/sub/a.json")["bytes"] == 0
+    assert s3.puts == ["host/manifests/sub/a.json"]
+
+
+def test_multipart_upload_resumes_after_a_failed_part(tmp_path, s3):
+    data = random.Random(1).randbytes(2 * MIN_PART_SIZE + 1000)
+    path = tmp_path / "backup.tar.gz"
+    path.write_bytes(data)
+    state = str(tmp_path / "offload.json")
+    s3.fail_parts = {2}
+    with pytest.raises(OffloadError):
+        Offloader(s3, "bucket", state, workers=1, part_size=MIN_PART_SIZE).upload_file(
+            str(path), "big"
+        )
+
+    # A new process picks up the recorded upload
+    offloader = Offloader(s3, "bucket", state, workers=2, part_size=MIN_PART_SIZE)
+    stats = offloader.upload_file(str(path), "big")
+    assert stats["parts"] == 3
+    assert stats["parts_resumed"] >= 1
+    assert stats["bytes"] < len(data)
+    assert s3.objects["big"] == data
+    assert s3.uploads == {}
+
+
+def test_changed_file_restarts_its_upload(tmp_path, s3):
+    path = tmp_path / "backup.tar.gz"
+    path.write_bytes(random.Random(1).randbytes(2 * MIN_PART_SIZE))
+    state = str(tmp_path / "offload.json")
+    s3.fail_parts = {2}
+    with pytest.raises(OffloadError):
+        Offloader(s3, "bucket", state, workers=1, part_size=MIN_PART_SIZE).upload_file(
+            str(path), "big"
+        )
+
+    data = random.Random(2).randbytes(2 * MIN_PART_SIZE + 10)
+    path.write_bytes(data)
+    offloader = Offloader(s3, "bucket", state, part_size=MIN_PART_SIZE)
+    stats = offloader.upload_file(str(path), "big")
+    assert stats["parts_resumed"] == 0
+    assert s3.objects["big"] == data
+    assert s3.uploads == {}
+
+
+def test_dedup_offload_sends_chunks_before_manifest(tmp_path, offloader, s3):
+    source = tmp_path / "server"
+    source.mkdir()
+    (source / "world.db").write_bytes(random.Random(3).randbytes(600_000))
+    store = BackupStore(str(tmp_path / "store"))
+    backup_id = store.backup("sub", str(source))["id"]
+    assert offloader.pending_backups(store, "sub") == {backup_id}
+
+    summary = offloader.offload_dedup(store, "sub")
+    manifest_key = f"host/manifests/sub/{backup_id}.json"
+    assert summary["backups"] == [backup_id]
+    assert s3.puts[-1] == manifest_key
+    assert all(key.startswith("host/chunks/") for key in s3.puts[:-1])
+    assert summary["chunks"] == len(s3.puts) - 1
+    assert offloader.pending_backups(store, "sub") == set()
+
+    # Unchanged files reuse their chunks, so only the manifest goes up
+    store.backup("sub", str(source))
+    puts = len(s3.puts)
+    assert offloader.offload_dedup(store, "sub")["chunks"] == 0
+    assert len(s3.puts) == puts + 1
@@ -0,0 +1,158 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from outbox import LEASE, Outbox
+
+
+def open_outbox(tmp_path, **kwargs):
+    return Outbox(str(tmp_path / "outbox.db"), "http://backend/results", **kwargs)
+
+
+class FakeBackend:
+    """Replaces Outbox._post; rejects batches holding a poisoned result"""
+
+    def __init__(self, status=200, poisoned=()):
+        self.status = status
+        self.poisoned = set(poisoned)
+        self.batches = []
+
+    def __call__(self, rows):
+        payloads = [json.loads(row[2]) for row in rows]
+        self.batches.append([p["n"] for p in payloads])
+        if self.status >= 500:
+            return False, True, f"HTTP {self.status}"
+        if any(p["n"] in self.poisoned for p in payloads):
+            return False, False, "HTTP 422"
+        return True, False, ""
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    return open_outbox(tmp_path, base_backoff=10)
+
+
+def install(outbox, backend):
+    outbox._post = backend
+    return backend
+
+
+def test_put_adds_idempotency_keys(outbox):
+    keys = outbox.put([{"n": 1}, {"n": 2}])
+    rows = outbox._claim()
+    assert [row[1] for row in rows] == keys
+    assert json.loads(rows[0][2]) == {"n": 1, "idempotency_key": keys[0]}
+
+
+def test_delivered_rows_are_deleted(outbox):
+    backend = install(outbox, FakeBackend())
+    outbox.put([{"n": n} for n in range(3)])
+    assert outbox.send_due() == 3
+    assert backend.batches == [[0, 1, 2]]
+    assert outbox.stats() == {"pending": 0, "dead": 0}
+    assert outbox.next_due() is None
+
+
+def test_claimed_rows_are_leased_from_other_senders(outbox, tmp_path):
+    outbox.put({"n": 1})
+    other = open_outbox(tmp_path)
+    before = time.time()
+    assert len(outbox._claim()) == 1
+    assert other._claim() == []
+    assert other.next_due() >= before + LEASE
+
+
+def test_failed_batch_backs_off(outbox):
+    backend = install(outbox, FakeBackend(status=503))
+    outbox.put([{"n": 1}, {"n": 2}])
+    before = time.time()
+    assert outbox.send_due() is None
+    # First retry after base_backoff * 2, jittered down to half of it
+    due = outbox.next_due()
+    assert before + 10 <= due <= time.time() + 20
+    assert outbox.send_due() == 0
+    assert backend.batches == [[1, 2]]
+    assert outbox.stats() == {"pending": 2, "dead": 0}
+
+
+def test_rows_die_after_max_attempts(tmp_path):
+    outbox = open_outbox(tmp_path, base_backoff=0, max_attempts=3)
+    install(outbox, FakeBackend(status=500))
+    outbox.put({"n": 1})
+    for _ in range(3):
+        assert outbox.send_due() is None
+    assert outbox.stats() == {"pending": 0, "dead": 1}
+
+
+def test_rejected_batch_is_bisected_to_the_bad_row(outbox):
+    backend = install(outbox, FakeBackend(poisoned={5}))
+    outbox.put([{"n": n} for n in range(8)])
+    assert outbox.send_due() == 8
+    assert backend.batches[0] == list(range(8))
+    assert [5] in backend.batches
+    delivered = [n for batch in backend.batches[1:] if 5 not in batch for n in batch]
+    assert sorted(delivered) == [0, 1, 2, 3, 4, 6, 7]
+    assert outbox.stats() == {"pending": 0, "dead": 1}
+    (error,) = outbox._db.execute("SELECT last_error FROM outbox").fetchone()
+    assert error == "HTTP 422"
+
+
+def test_outage_during_bisection_retries_the_rest(outbox):
+    backend = install(outbox, FakeBackend(poisoned={0}))
+
+    def post(rows):
+        result = backend(rows)
+        backend.status = 503
+        return result
+
+    outbox._post = post
+    outbox.put([{"n": n} for n in range(4)])
+    assert outbox.send_due() is None
+    assert outbox.stats() == {"pending": 4, "dead": 0}
+
+
+def test_flush_stops_on_failure(outbox):
+    backend = install(outbox, FakeBackend())
+    outbox.batch_size = 2
+    outbox.put([{"n": n} for n in range(5)])
+    assert outbox.flush(5) == 5
+    assert backend.batches == [[0, 1], [2, 3], [4]]
+    backend.status = 503
+    outbox.put({"n": 9})
+    assert outbox.flush(5) == 0
+
+
+def test_post_sends_json_list_with_batch_key(tmp_path):
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            received.append((self.headers["Idempotency-Key"], json.loads(body)))
+            self.send_response(200 if len(received) == 1 else 400)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        outbox = Outbox(
+            str(tmp_path / "outbox.db"),
+            f"http://127.0.0.1:{server.server_port}/results",
+        )
+        outbox.put([{"n": 1}, {"n": 2}])
+        rows = outbox._claim()
+        assert outbox._post(rows) == (True, False, "")
+        assert outbox._post(rows)[:2] == (False, False)
+    finally:
+        server.shutdown()
+    (key, body), (resent_key, _) = received
+    assert [item["n"] for item in body] == [1, 2]
+    # A resent batch carries the same key for the backend to deduplicate
+    assert key == resent_key
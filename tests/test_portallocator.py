@@ -0,0 +1,163 @@
+import pytest
+
+import gregistry
+import portallocator
+import setup_server
+from customdataclasses import ServerResult
+from portallocator import PortAllocationError, PortAllocator
+
+
+@pytest.fixture
+def bound(monkeypatch):
+    """Ports the allocator sees as bound on the host"""
+    ports = set()
+    monkeypatch.setattr(portallocator, "listening_ports", lambda: ports)
+    return ports
+
+
+@pytest.fixture
+def allocator(tmp_path, bound):
+    return PortAllocator(str(tmp_path / "ports.json"), start=3000, end=3010)
+
+
+def test_reserve_takes_first_free_ports(allocator):
+    assert allocator.reserve("a", 2) == [3000, 3001]
+    assert allocator.reserve("b", 2) == [3002, 3003]
+
+
+def test_reserve_reuses_existing_reservation(allocator):
+    ports = allocator.reserve("a", 2)
+    assert allocator.reserve("a", 2) == ports
+
+
+def test_reserve_skips_bound_ports(allocator, bound):
+    bound.update({3000, 3002})
+    assert allocator.reserve("a", 2) == [3001, 3003]
+
+
+def test_contiguous_reserve_needs_adjacent_run(allocator, bound):
+    bound.update({3001, 3004})
+    assert allocator.reserve("a", 2, contiguous=True) == [3002, 3003]
+    assert allocator.reserve("b", 3, contiguous=True) == [3005, 3006, 3007]
+    with pytest.raises(PortAllocationError):
+        allocator.reserve("c", 3, contiguous=True)
+
+
+def test_reserve_fails_when_range_is_full(allocator):
+    allocator.reserve("a", 9)
+    with pytest.raises(PortAllocationError):
+        allocator.reserve("b", 2)
+
+
+def test_reservations_persist_across_instances(allocator, tmp_path):
+    ports = allocator.reserve("a", 2)
+    other = PortAllocator(str(tmp_path / "ports.json"), start=3000, end=3010)
+    assert other.reserved("a") == ports
+    assert other.reserve("b", 1) == [3002]
+
+
+def test_reserve_many_never_hands_out_a_port_twice(allocator):
+    allocator.reserve("a", 1)
+    allocated = allocator.reserve_many({"a": 1, "b": 2, "c": 2}, contiguous=True)
+    assert allocated == {"a": [3000], "b": [3001, 3002], "c": [3003, 3004]}
+    assert allocator.reservations() == allocated
+
+
+def test_adopt_refuses_ports_held_by_another(allocator):
+    allocator.reserve("a", 2)
+    with pytest.raises(PortAllocationError):
+        allocator.adopt("b", [3001, 3005])
+    assert allocator.adopt("b", [3005, 3006]) == [3005, 3006]
+    # An existing reservation wins over the ports offered
+    assert allocator.adopt("b", [3007]) == [3005, 3006]
+
+
+def test_release_frees_ports_for_reuse(allocator):
+    allocator.reserve("a", 2)
+    allocator.reserve("b", 2)
+    assert allocator.release("a") == [3000, 3001]
+    assert allocator.release("a") == []
+    assert allocator.reserve("c", 2) == [3000, 3001]
+
+
+def test_reconcile_adopts_releases_and_reports_unbound(allocator, bound):
+    allocator.reserve("gone", 1)
+    bound.add(3005)
+    result = allocator.reconcile({"kept": [3005, 3006], "down": [3007]})
+    assert result["released"] == ["gone"]
+    assert sorted(result["adopted"]) == ["down", "kept"]
+    assert result["unbound"] == ["down"]
+    assert allocator.reservations() == {"kept": [3005, 3006], "down": [3007]}
+
+
+class FakeManager:
+    """Just enough of GameServerManager for setup_server.handle start"""
+
+    def __init__(self, allocator, fail_at=None):
+        self.registry = gregistry.GameRegistry()
+        self.port_allocator = allocator
+        self.fail_at = fail_at
+        self.reported = []
+
+    def _step(self, name):
+        if self.fail_at == name:
+            raise RuntimeError(f"{name} broke")
+
+    def create_compose_file(self, subscription_id, ports, memory, cpu, game_type):
+        self._step("compose")
+        return "compose.yml"
+
+    def update_sftp_server(self, game_type, subscription_id):
+        self._step("sftp")
+        return ServerResult(
+            action="sftp", subscription_id=subscription_id, status="running"
+        )
+
+    def start_server(self, compose_file, subscription_id, ports):
+        self._step("start")
+        status = "failed" if self.fail_at == "status" else "running"
+        return ServerResult(
+            action="start", subscription_id=subscription_id, status=status
+        )
+
+    def await_ready(self, pending):
+        pass
+
+    def record(self, result, game_type, **kwargs):
+        pass
+
+    def report(self, result):
+        self.reported.append(result)
+
+
+START = ["start", "--subscription-id", "sub", "--game-type", "valheim"]
+
+
+@pytest.mark.parametrize("fail_at", ["compose", "sftp", "start", "status"])
+def test_failed_start_releases_fresh_reservation(allocator, fail_at):
+    manager = FakeManager(allocator, fail_at)
+    result = setup_server.handle(manager, START)
+    assert result.status == "failed"
+    assert manager.reported == [result]
+    assert allocator.reserved("sub") is None
+
+
+def test_failed_start_keeps_existing_reservation(allocator):
+    ports = allocator.reserve("sub", 2, contiguous=True)
+    result = setup_server.handle(FakeManager(allocator, "start"), START)
+    assert result.status == "failed"
+    assert allocator.reserved("sub") == ports
+
+
+def test_reservation_error_is_a_failed_result(allocator):
+    allocator.reserve("other", 9)
+    result = setup_server.handle(FakeManager(allocator), START)
+    assert result.status == "failed"
+    assert "adjacent free ports" in result.error
+    assert allocator.reserved("sub") is None
+
+
+def test_start_keeps_reservation(allocator):
+    result = setup_server.handle(FakeManager(allocator), START)
+    assert result.status == "running"
+    assert allocator.reserved("sub") == [3000, 3001]
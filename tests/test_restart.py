@@ -0,0 +1,133 @@
+import pytest
+
+import gregistry
+import setup_server
+from customdataclasses import ServerResult
+from portallocator import PortAllocationError
+from stateindex import StateIndex
+
+SUB = "sub"
+PORTS = [3000, 3001]
+
+
+class FakeManager(setup_server.GameServerManager):
+    """The real restart logic over a fake Docker host"""
+
+    def __init__(self, state_path):
+        self.registry = gregistry.GameRegistry()
+        self.state = StateIndex(state_path)
+        self.hibernator = None
+        self.containers = {}
+        self.calls = []
+        self.port_error = None
+
+    def ensure_ports(self, subscription_id, game_type):
+        if self.port_error:
+            raise PortAllocationError(self.port_error)
+        return PORTS
+
+    def project_containers(self):
+        return self.containers
+
+    def _result(self, status="running"):
+        return ServerResult(
+            action="start", subscription_id=SUB, status=status, container_id="c2"
+        )
+
+    def stop_server(self, subscription_id, game_type=None):
+        self.calls.append("stop")
+        self.containers.pop(subscription_id, None)
+        return ServerResult(action="stop", subscription_id=SUB, status="stopped")
+
+    def start_server(self, compose_file, subscription_id, ports):
+        self.calls.append("start")
+        self.containers[subscription_id] = ("c2", "running")
+        return self._result()
+
+    def _restart_container(self, subscription_id, container_id, ports):
+        self.calls.append(f"restart {container_id}")
+        return self._result()
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.setattr(setup_server, "subscription_path", str(tmp_path))
+    manager = FakeManager(str(tmp_path / "state.db"))
+    compose = manager.compose_path(SUB, "valheim")
+    with open(compose, "w") as f:
+        f.write("services: {}\n")
+    with open(manager.env_path(SUB, "valheim"), "w") as f:
+        f.write("SERVER_NAME=one\n")
+    # Started once, so the index holds the hashes it started with
+    manager.containers[SUB] = ("c1", "running")
+    manager.record(
+        ServerResult(
+            action="start", subscription_id=SUB, status="running", container_id="c1"
+        ),
+        "valheim",
+    )
+    return manager
+
+
+def restart(manager, force=False):
+    return manager.restart_server(SUB, "valheim", force=force)
+
+
+def test_unchanged_running_server_is_left_alone(manager):
+    result = restart(manager)
+    assert result.status == "running"
+    assert result.metrics == {"restart": "skipped"}
+    assert result.container_id == "c1"
+    assert manager.calls == []
+
+
+def test_force_restarts_in_place(manager):
+    assert restart(manager, force=True).metrics["restart"] == "in_place"
+    assert manager.calls == ["restart c1"]
+
+
+def test_stopped_container_restarts_in_place(manager):
+    manager.containers[SUB] = ("c1", "exited")
+    assert restart(manager).metrics["restart"] == "in_place"
+    assert manager.calls == ["restart c1"]
+
+
+def test_env_change_updates_the_container(manager):
+    with open(manager.env_path(SUB, "valheim"), "w") as f:
+        f.write("SERVER_NAME=two\n")
+    assert restart(manager).metrics["restart"] == "update"
+    assert manager.calls == ["start"]
+
+
+def test_compose_change_recreates(manager):
+    with open(manager.compose_path(SUB, "valheim"), "a") as f:
+        f.write("# changed\n")
+    assert restart(manager).metrics["restart"] == "recreate"
+    assert manager.calls == ["stop", "start"]
+
+
+def test_missing_container_recreates(manager):
+    manager.containers.clear()
+    assert restart(manager).metrics["restart"] == "recreate"
+    assert manager.calls == ["stop", "start"]
+
+
+def test_recorded_restart_is_skipped_next_time(manager):
+    with open(manager.env_path(SUB, "valheim"), "w") as f:
+        f.write("SERVER_NAME=two\n")
+    manager.record(restart(manager), "valheim")
+    assert restart(manager).metrics["restart"] == "skipped"
+
+
+def test_missing_compose_file(manager):
+    result = manager.restart_server("other", "valheim")
+    assert result.status == "not_found"
+    assert manager.calls == []
+
+
+def test_port_clash_fails_the_restart(manager):
+    manager.port_error = "Ports [3000] of sub are reserved by other"
+    result = restart(manager, force=True)
+    assert result.status == "failed"
+    assert "reserved by other" in result.error
+    assert manager.calls == []
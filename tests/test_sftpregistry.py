@@ -0,0 +1,110 @@
+import pytest
+
+from sftpregistry import FIRST_GID, FIRST_UID, SFTPUserRegistry, parse_line
+
+
+@pytest.fixture
+def users_conf(tmp_path):
+    path = tmp_path / "users.conf"
+    path.write_text("")
+    return path
+
+
+def open_registry(users_conf, **kwargs):
+    return SFTPUserRegistry(users_conf, users_conf.parent / ".users.lock", **kwargs)
+
+
+@pytest.fixture
+def registry(users_conf):
+    return open_registry(users_conf)
+
+
+def live_lines(users_conf):
+    return [
+        line for line in users_conf.read_text().splitlines() if parse_line(line)
+    ]
+
+
+def test_parse_line():
+    user = parse_line("abcd:pw:1001:101:::abcdef\n")
+    assert (user.username, user.uid, user.gid, user.subscription_id) == (
+        "abcd",
+        1001,
+        101,
+        "abcdef",
+    )
+    # Hand-written entries without a subscription field
+    assert parse_line("bob:pw:1002:102").subscription_id == "bob"
+    assert parse_line("#abcd:pw:1001:101:::abcdef") is None
+    assert parse_line("abcd:pw:x:101") is None
+
+
+def test_add_assigns_increasing_ids(registry):
+    users = registry.add_many({"sub-one": "a", "sub-two": "b"})
+    assert [(u.uid, u.gid) for u in users.values()] == [
+        (FIRST_UID, FIRST_GID),
+        (FIRST_UID + 1, FIRST_GID + 1),
+    ]
+    assert registry.next_ids() == (FIRST_UID + 2, FIRST_GID + 2)
+    # Already present subscriptions are skipped
+    assert registry.add_many({"sub-one": "c"}) == {}
+
+
+def test_usernames_are_shortest_unique_prefix(registry):
+    users = registry.add_many({"abcdef1": "a", "abcdef2": "b", "abcd": "c"})
+    assert users["abcdef1"].username == "abcd"
+    assert users["abcdef2"].username == "abcde"
+    # Every prefix is taken, so a numeric suffix is used
+    assert users["abcd"].username == "abcd2"
+    assert registry.by_username("abcde").subscription_id == "abcdef2"
+
+
+def test_promised_username_taken_since_is_replaced(registry):
+    promised = registry.username_for("abcdef1")
+    registry.add_many({"abcdef2": "b"})
+    users = registry.add_many({"abcdef1": "a"}, {"abcdef1": promised})
+    assert promised == "abcd"
+    assert users["abcdef1"].username == "abcde"
+
+
+def test_remove_comments_out_and_appends_tombstone(registry, users_conf):
+    registry.add_many({"sub-one": "a", "sub-two": "b"})
+    removed = registry.remove_many(["sub-one", "missing"])
+    assert [u.subscription_id for u in removed] == ["sub-one"]
+    lines = users_conf.read_text().splitlines()
+    # The first byte is overwritten, so the line keeps its length
+    assert lines[0] == "#ub-:a:1001:101:::sub-one"
+    assert lines[-1] == "#removed:sub-one"
+    assert "sub-one" not in registry
+    assert len(registry) == 1
+
+
+def test_removed_ids_are_not_reused(registry):
+    registry.add_many({"sub-one": "a", "sub-two": "b"})
+    registry.remove_many(["sub-two"])
+    assert registry.next_ids() == (FIRST_UID + 2, FIRST_GID + 2)
+
+
+def test_other_process_sees_adds_and_removals(registry, users_conf):
+    other = open_registry(users_conf)
+    assert len(other) == 0
+    registry.add_many({"sub-one": "a", "sub-two": "b"})
+    assert other.get("sub-two").uid == FIRST_UID + 1
+    registry.remove_many(["sub-one"])
+    assert "sub-one" not in other
+    assert [u.subscription_id for u in other.users()] == ["sub-two"]
+
+
+def test_compaction_keeps_only_live_users(users_conf):
+    registry = open_registry(users_conf, compact_threshold=2)
+    registry.add_many({f"sub-{i}": "pw" for i in range(4)})
+    other = open_registry(users_conf)
+    assert len(other) == 4
+    registry.remove_many(["sub-0"])
+    assert len(users_conf.read_text().splitlines()) == 5
+    # Four dead lines against two live users triggers the rewrite
+    registry.remove_many(["sub-1", "sub-2"])
+    assert users_conf.read_text().splitlines() == live_lines(users_conf)
+    assert len(live_lines(users_conf)) == 1
+    assert [u.subscription_id for u in other.users()] == ["sub-3"]
+    assert registry.next_ids() == (FIRST_UID + 4, FIRST_GID + 4)
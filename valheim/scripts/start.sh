@@ -3,6 +3,19 @@ set -e
 
 cd /valheim
 
+# Optional arguments. CROSSPLAY is true/false, MODIFIER holds space separated
+# <key>:<value> pairs and SETKEY space separated keys
+set --
+if [ "${CROSSPLAY}" = "true" ]; then
+    set -- "$@" -crossplay
+fi
+for modifier in ${MODIFIER}; do
+    set -- "$@" -modifier "${modifier%%:*}" "${modifier#*:}"
+done
+for key in ${SETKEY}; do
+    set -- "$@" -setkey "${key}"
+done
+
 exec ./valheim_server.x86_64 -nographics -batchmode \
     -name       "${SERVER_NAME}" \
     -port       "${PORT}" \
@@ -15,7 +28,5 @@ exec ./valheim_server.x86_64 -nographics -batchmode \
     -backups    "${BACKUPS}" \
     -backupshort "${BACKUPSHORT}" \
     -backuplong  "${BACKUPLONG}" \
-    -crossplay  "${CROSSPLAY}" \
     -preset     "${PRESET}" \
-    -modifier   "${MODIFIER}" \
-    -setkey     "${SETKEY}"
+    "$@"
@@ -214,7 +214,8 @@ func inspectQueue(w http.ResponseWriter, req *http.Request) {
 
 		for _, v := range res {
 
-			s := strings.Split(v, ":")
+			// The job payload is JSON and contains ':' itself
+			s := strings.SplitN(v, ":", 2)
 			if len(s) > 1 {
 				id := s[0]
 				job := s[1]